@@ -1,23 +1,24 @@
 import os
-from llm.gemini import LLM as GeminiLLM
-from llm.openai import LLM as OpenAILLM
-from llm.watsonx import LLM as WatsonxLLM
 
 from dotenv import load_dotenv
 load_dotenv()
 
 
 def get_llm(provider: str):
+    # only the SDK of the selected provider is imported
     provider = provider.lower()
     if provider == "gemini":
+        from llm.gemini import LLM as GeminiLLM
         api_key = os.getenv("LLM_GEMINI_API_KEY")
         model = os.getenv("LLM_GEMINI_MODEL")
         return GeminiLLM(api_key=api_key, model=model)
     elif provider == "openai":
+        from llm.openai import LLM as OpenAILLM
         api_key = os.getenv("LLM_OPENAI_API_KEY")
         model = os.getenv("LLM_OPENAI_MODEL")
         return OpenAILLM(api_key=api_key, model=model)
     elif provider == "watsonx":
+        from llm.watsonx import LLM as WatsonxLLM
         api_key = os.getenv("LLM_WATSONX_API_KEY")
         project_id = os.getenv("LLM_WATSONX_PROJECT_ID")
         url = os.getenv("LLM_WATSONX_URL")
@@ -1,13 +1,23 @@
 import os
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, UploadFile, Form, File, Query
 from typing import List, Optional
 from fastapi.responses import JSONResponse
+from fastapi.encoders import jsonable_encoder
 from langchain.agents import create_agent
-from langgraph.store.memory import InMemoryStore
+from utils.memory_store import create_memory_store
 from llm import get_llm
 from tools import get_tools
-from tools.multi_cloud_tools import list_all_cloud_resources
+from tools.multi_cloud_tools import get_all_cloud_resources, list_all_cloud_resources
+from tools.intent_router import IntentRouter
+from tools.middleware import ParallelToolMiddleware, parse_tool_timeouts
+from tools.plan_execute import PlanExecutor
 from tools.memory_tools import Context
+from tools.cache import tool_cache
+from utils.ingestion import IngestionQueue, IngestionQueueFull, create_ingestion_job_store
+from utils.upload import save_upload, remove_upload, UploadTooLarge
+from utils.lazy import Lazy
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -15,25 +25,124 @@ load_dotenv()
 LLM_PROVIDER = os.getenv("LLM_PROVIDER", "gemini")
 CLOUD_PROVIDERS = os.getenv("CLOUD_PROVIDERS", "gcp").lower()
 VECTORSTORE = os.getenv("VECTORSTORE_CLASS", "chroma").lower()
+FAST_PATH_ENABLED = os.getenv("FAST_PATH_ENABLED", "true").lower() == "true"
+FAST_PATH_SIMILARITY_THRESHOLD = float(os.getenv("FAST_PATH_SIMILARITY_THRESHOLD", "0.75"))
+TOOL_MAX_CONCURRENCY = int(os.getenv("TOOL_MAX_CONCURRENCY", "8"))
+TOOL_TIMEOUT_SECONDS = float(os.getenv("TOOL_TIMEOUT_SECONDS", "30"))
+TOOL_TIMEOUTS = parse_tool_timeouts(os.getenv("TOOL_TIMEOUTS"))
+PLAN_MAX_RETRIES = int(os.getenv("PLAN_MAX_RETRIES", "2"))
+INGESTION_MAX_QUEUE_SIZE = int(os.getenv("INGESTION_MAX_QUEUE_SIZE", "16"))
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "1"))
+UPLOAD_DIR = "./temp_uploads"
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_KB", "1024")) * 1024
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_MB", "100")) * 1024 * 1024
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_MB", "500")) * 1024 * 1024
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "false").lower() == "true"
+WARMUP_COMPONENTS = ["llm", "agent", "plan", "rag"]
 
-# Initialize
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if WARMUP_ON_STARTUP:
+        # in the background, requests are accepted meanwhile
+        asyncio.get_running_loop().run_in_executor(None, warmup, WARMUP_COMPONENTS)
+    yield
+
+
+# Initialize (LLM SDK, agent, embedding model and vectorstore are loaded on first use)
 # Server
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 # LLM
-llm = get_llm(LLM_PROVIDER)
+llm = Lazy(lambda: get_llm(LLM_PROVIDER), name="llm")
 # Tool
 tools, rag_tool_instance = get_tools(CLOUD_PROVIDERS, VECTORSTORE)
-# store
-store = InMemoryStore()
+
+
+# Document ingestion (runs off the request path)
+def ingest_uploads(file_paths: List[str], on_file_done, sources=None, hashes=None, namespace=None) -> dict:
+    def on_upload_done(file_path: str, ok: bool):
+        remove_upload(file_path, upload_dir=UPLOAD_DIR)
+        on_file_done(file_path, ok)
+
+    try:
+        return rag_tool_instance.add_files(file_paths=file_paths, on_file_done=on_upload_done, sources=sources, hashes=hashes, namespace=namespace)
+    finally:
+        for file_path in file_paths:
+            remove_upload(file_path, upload_dir=UPLOAD_DIR)
+
+
+ingestion_queue = IngestionQueue(
+    ingest_func=ingest_uploads,
+    max_queue_size=INGESTION_MAX_QUEUE_SIZE,
+    num_workers=INGESTION_WORKERS,
+    # status and progress polls may reach any uvicorn worker
+    job_store=create_ingestion_job_store()
+) if rag_tool_instance else None
+# store (user facts are searched with the embedding model of the vectorstore, or its own when there is none)
+def memory_embeddings():
+    if rag_tool_instance:
+        return rag_tool_instance.embeddings
+    from utils.embedding_backends import create_embeddings
+    return create_embeddings()
+
+
+store = create_memory_store(embeddings_factory=memory_embeddings)
 # Agent
-agent = create_agent(tools=tools, llm=llm, store=store)
+agent = Lazy(lambda: create_agent(
+    tools=tools,
+    llm=llm.get(),
+    store=store,
+    middleware=[
+        ParallelToolMiddleware(
+            max_concurrency=TOOL_MAX_CONCURRENCY,
+            default_timeout=TOOL_TIMEOUT_SECONDS,
+            timeouts=TOOL_TIMEOUTS
+        )
+    ]
+), name="agent")
+# Fast path for literal commands
+intent_router = IntentRouter(
+    providers=[p.strip() for p in CLOUD_PROVIDERS.split(",")],
+    embeddings_factory=(lambda: rag_tool_instance.embeddings) if rag_tool_instance else None,
+    similarity_threshold=FAST_PATH_SIMILARITY_THRESHOLD
+) if FAST_PATH_ENABLED else None
+# Plan-and-execute mode
+plan_executor = Lazy(lambda: PlanExecutor(
+    llm=llm.get(),
+    providers=[p.strip() for p in CLOUD_PROVIDERS.split(",")],
+    extra_tools=[list_all_cloud_resources] + ([rag_tool_instance.rag_tool] if rag_tool_instance else []),
+    max_concurrency=TOOL_MAX_CONCURRENCY,
+    max_retries=PLAN_MAX_RETRIES,
+    default_timeout=TOOL_TIMEOUT_SECONDS,
+    timeouts=TOOL_TIMEOUTS
+), name="plan_executor")
+
+
+def warmup(components: List[str]) -> dict:
+    """
+    Load the lazily initialized components and return their load times in seconds.
+    遅延初期化しているコンポーネントを読み込み、読み込み時間（秒）を返す
+    """
+    loaded = {}
+    for component in components:
+        if component == "rag":
+            if not rag_tool_instance:
+                continue
+            loaded["rag"] = rag_tool_instance.warmup()
+        else:
+            lazy = {"llm": llm, "agent": agent, "plan": plan_executor}[component]
+            lazy.get()
+            loaded[component] = lazy.seconds
+    return loaded
 
 
 @app.post("/chat")
 async def chat(
     user_id: str = Form(..., description="User ID"),
     query: Optional[str] = Form(None),
-    files: Optional[List[UploadFile]] = File(None)
+    files: Optional[List[UploadFile]] = File(None),
+    mode: str = Form("agent", description="agent or plan"),
+    tenant_id: Optional[str] = Form(None, description="team sharing documents (defaults to user_id)")
 ):
     """
     Received query, return LLM agent response
@@ -42,36 +151,75 @@ async def chat(
     Args:
         - query: str, user's request
         - files: List[UploadFile], uploaded files
+        - mode: str, "agent" (one tool call per LLM step) or "plan" (plan once, run the steps in parallel)
+        - tenant_id: str, documents are stored and searched per tenant (defaults to user_id)
     """
     reply = ""
+    response = None
+    plan = None
+    job_id = None
+    uploads = []
 
     # using vectorstore & uploaded files
-    if files and rag_tool_instance:
-        file_paths = []
-        for f in files:
-            save_path = f"./temp_uploads/{f.filename}"
-            os.makedirs(os.path.dirname(save_path), exist_ok=True)
-            with open(save_path, "wb") as buffer:
-                buffer.write(await f.read())
-            file_paths.append(save_path)
-        reply += rag_tool_instance.add_document(file_paths=file_paths)
-
-    if query:
-        response = await agent.ainvoke(
+    if files and ingestion_queue:
+        remaining = UPLOAD_MAX_REQUEST_BYTES
+        try:
+            for f in files:
+                saved = await save_upload(
+                    f,
+                    upload_dir=UPLOAD_DIR,
+                    chunk_size=UPLOAD_CHUNK_BYTES,
+                    max_file_bytes=UPLOAD_MAX_FILE_BYTES,
+                    max_total_bytes=remaining
+                )
+                remaining -= saved.size
+                uploads.append(saved)
+            job = ingestion_queue.submit(
+                [u.path for u in uploads],
+                sources={u.path: u.filename for u in uploads},
+                hashes={u.path: u.sha256 for u in uploads},
+                namespace=rag_tool_instance.namespace_for(user_id, tenant_id)
+            )
+        except UploadTooLarge as e:
+            for u in uploads:
+                remove_upload(u.path, upload_dir=UPLOAD_DIR)
+            return JSONResponse({"reply": str(e)}, status_code=413)
+        except IngestionQueueFull as e:
+            for u in uploads:
+                remove_upload(u.path, upload_dir=UPLOAD_DIR)
+            return JSONResponse({"reply": str(e)}, status_code=429, headers={"Retry-After": "30"})
+        job_id = job.job_id
+        reply += f"Files queued for ingestion (job_id: {job_id}). "
+
+    # literal commands are answered without the LLM
+    routed = await intent_router.route(query) if query and intent_router else None
+    if routed:
+        reply += routed["reply"]
+    elif query and mode == "plan":
+        executor = plan_executor.get() if plan_executor.loaded else await asyncio.to_thread(plan_executor.get)
+        result = await executor.run(query, context=Context(user_id=user_id, tenant_id=tenant_id))
+        reply += result["reply"]
+        plan = result["plan"]
+    elif query:
+        chat_agent = agent.get() if agent.loaded else await asyncio.to_thread(agent.get)
+        response = await chat_agent.ainvoke(
             {
                 "messages": [{
                     "role": "user",
                     "content": query
                 }]
             },
-            context=Context(user_id=user_id)
+            context=Context(user_id=user_id, tenant_id=tenant_id)
         )
         reply = response.get("output", str(response)) if isinstance(response, dict) else str(response)
 
-    return JSONResponse({
+    return JSONResponse(jsonable_encoder({
         "reply": reply,
-        "sources": getattr(response, "artifact", None)
-    })
+        "sources": getattr(response, "artifact", None),
+        "plan": plan,
+        "job_id": job_id,
+        "files": [{"filename": u.filename, "sha256": u.sha256, "size": u.size} for u in uploads]
+    }))
 
 
 @app.get("/cloud-resources")
@@ -87,5 +235,152 @@ async def cloud_resources(providers: Optional[str] = Query(None, description="co
     else:
         providers_list = [p.strip() for p in providers.split(",") if p.strip()]
 
-    summary = list_all_cloud_resources(providers_list)
+    summary = get_all_cloud_resources(providers_list)
     return JSONResponse(summary)
+
+
+@app.post("/warmup")
+async def warmup_components(components: Optional[str] = Query(None, description="comma-separated list of llm, agent, plan, rag (default: all)")):
+    """
+    Load lazily initialized components before the first request needs them
+
+    Args:
+        - components: str, "llm,agent,plan,rag"
+    """
+    names = [c.strip().lower() for c in components.split(",") if c.strip()] if components else WARMUP_COMPONENTS
+    unknown = [name for name in names if name not in WARMUP_COMPONENTS]
+    if unknown:
+        return JSONResponse({"error": f"unknown components: {', '.join(unknown)}"}, status_code=400)
+    loaded = await asyncio.to_thread(warmup, names)
+    return JSONResponse({"loaded": loaded})
+
+
+@app.get("/ingest")
+async def ingest_stats():
+    """
+    Return depth of the ingestion queue, counts of jobs by status and embedding throughput
+    """
+    if not ingestion_queue:
+        return JSONResponse({"error": "vectorstore is not enabled"}, status_code=404)
+    # stats never load the vectorstore
+    return JSONResponse({
+        **ingestion_queue.stats(),
+        **(await asyncio.to_thread(rag_tool_instance.stats))
+    })
+
+
+@app.get("/ingest/{job_id}")
+async def ingest_status(job_id: str):
+    """
+    Return status of the ingestion job
+
+    Args:
+        - job_id: str, job ID returned by /chat
+    """
+    job = ingestion_queue.get(job_id) if ingestion_queue else None
+    if job is None:
+        return JSONResponse({"error": f"job {job_id} not found"}, status_code=404)
+    return JSONResponse(job.to_dict())
+
+
+@app.get("/ingest/{job_id}/progress")
+async def ingest_progress(job_id: str):
+    """
+    Return progress of the ingestion job
+
+    Args:
+        - job_id: str, job ID returned by /chat
+    """
+    job = ingestion_queue.get(job_id) if ingestion_queue else None
+    if job is None:
+        return JSONResponse({"error": f"job {job_id} not found"}, status_code=404)
+    return JSONResponse({
+        "job_id": job.job_id,
+        "status": job.status,
+        "files_done": job.files_done,
+        "files_total": job.files_total,
+        "progress": job.progress
+    })
+
+
+@app.get("/documents")
+async def list_documents(
+    cursor: int = Query(0, ge=0, description="offset returned as next_cursor by the previous page"),
+    limit: int = Query(100, ge=1, le=1000),
+    include_content: bool = Query(False, description="include chunk texts"),
+    tenant_id: Optional[str] = Query(None, description="tenant store (default: the shared store)")
+):
+    """
+    Return one page of the chunks in the vectorstore
+
+    Args:
+        - cursor: int, offset of the page
+        - limit: int, max number of chunks
+        - include_content: bool, include chunk texts (IDs and metadata only by default)
+        - tenant_id: str, tenant store to list
+    """
+    if not rag_tool_instance:
+        return JSONResponse({"error": "vectorstore is not enabled"}, status_code=404)
+    page = await asyncio.to_thread(rag_tool_instance.documents_page, cursor, limit, include_content, tenant_id)
+    items = page["items"]
+    return JSONResponse({
+        "items": items,
+        "count": len(items),
+        "total": page["total"],
+        "next_cursor": cursor + limit if len(items) == limit else None
+    })
+
+
+@app.post("/documents/gc")
+async def documents_gc(
+    include_unmanaged: bool = Query(False, description="also delete chunks of sources not in the manifest"),
+    tenant_id: Optional[str] = Query(None, description="tenant store (default: the shared store)")
+):
+    """
+    Delete chunks not referenced by the document manifest
+
+    Args:
+        - include_unmanaged: bool, also delete chunks ingested before the manifest existed
+        - tenant_id: str, tenant store to clean up
+    """
+    if not rag_tool_instance:
+        return JSONResponse({"error": "vectorstore is not enabled"}, status_code=404)
+    deleted = await asyncio.to_thread(rag_tool_instance.gc, include_unmanaged, tenant_id)
+    return JSONResponse({"deleted": deleted})
+
+
+@app.get("/documents/storage")
+async def documents_storage(
+    sample: int = Query(5000, ge=100, le=100000, description="chunks used to measure recall"),
+    k: int = Query(10, ge=1, le=100),
+    tenant_id: Optional[str] = Query(None, description="tenant store (default: the shared store)")
+):
+    """
+    Return bytes per vector of the vectorstore and recall@k of its vector storage (VECTOR_STORAGE) against exact float32 search
+
+    Args:
+        - sample: int, number of chunks used to measure recall
+        - k: int, recall cutoff
+        - tenant_id: str, tenant store to measure
+    """
+    if not rag_tool_instance:
+        return JSONResponse({"error": "vectorstore is not enabled"}, status_code=404)
+    return JSONResponse(await asyncio.to_thread(rag_tool_instance.storage_stats, sample, k, tenant_id))
+
+
+@app.get("/tool-cache/stats")
+async def tool_cache_stats():
+    """
+    Return hit-rate statistics of the tool result cache
+    """
+    return JSONResponse(tool_cache.stats())
+
+
+@app.get("/memory/stats")
+async def memory_stats():
+    """
+    Return cache and write-behind statistics of the agent memory store
+    """
+    if not hasattr(store, "stats"):
+        return JSONResponse({"error": "memory store has no statistics"}, status_code=404)
+    return JSONResponse(store.stats())
@@ -0,0 +1,118 @@
+"""
+Check retrieval quality and speed of an embedding backend against the full precision torch model.
+埋め込みバックエンドの検索品質と速度を、フル精度のtorchモデルと比較する
+
+Usage (from the backend directory):
+    python -m scripts.check_embedding_parity docs/*.pdf --backend onnx-int8
+    python -m scripts.check_embedding_parity docs/*.pdf --backend torch-int8 --queries queries.txt --k 5
+
+Chunks of the files are embedded by both models and every query is searched by brute force.
+Recall@k is the share of the baseline top-k chunks that the candidate also returns in its top-k.
+Without --queries, the first sentence of sampled chunks is used as the query.
+The script exits with status 1 when the mean recall@k is below --min-recall.
+"""
+import os
+import sys
+import time
+import argparse
+from itertools import islice
+from typing import List, Tuple
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.document_loader import ChunkSettings, iter_chunks  # noqa: E402
+from utils.embedding_backends import BACKENDS, DEFAULT_MODEL, create_embeddings  # noqa: E402
+
+
+def load_chunks(file_paths: List[str], model_name: str, max_chunks: int) -> List[str]:
+    settings = ChunkSettings(tokenizer_name=model_name)
+    texts = []
+    for file_path in file_paths:
+        texts.extend(doc.page_content for doc in islice(iter_chunks(file_path, settings), max_chunks - len(texts)))
+        if len(texts) >= max_chunks:
+            break
+    return texts
+
+
+def sample_queries(texts: List[str], count: int) -> List[str]:
+    step = max(len(texts) // count, 1)
+    queries = []
+    for text in texts[::step][:count]:
+        sentence = text.replace('\n', ' ').split('. ')[0].split('。')[0]
+        queries.append(sentence[:200])
+    return queries
+
+
+def embed(embeddings, texts: List[str], queries: List[str]) -> Tuple[np.ndarray, np.ndarray, float]:
+    # warm up outside the measurement (lazy session creation, kernel selection)
+    embeddings.embed_documents(texts[:8])
+    start = time.perf_counter()
+    documents = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    elapsed = time.perf_counter() - start
+    query_vectors = np.asarray([embeddings.embed_query(query) for query in queries], dtype=np.float32)
+    return documents, query_vectors, elapsed
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def top_k(documents: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    scores = normalize(queries) @ normalize(documents).T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare an embedding backend with the full precision torch model.')
+    parser.add_argument('files', nargs='+', help='documents to chunk and embed')
+    parser.add_argument('--backend', default='onnx-int8', choices=BACKENDS)
+    parser.add_argument('--baseline', default='torch', choices=BACKENDS)
+    parser.add_argument('--model', default=os.getenv('EMBEDDING_MODEL') or DEFAULT_MODEL)
+    parser.add_argument('--queries', help='file with one query per line (default: sampled from the chunks)')
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--max-chunks', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--min-recall', type=float, default=0.9)
+    args = parser.parse_args()
+
+    texts = load_chunks(args.files, args.model, args.max_chunks)
+    if len(texts) <= args.k:
+        parser.error(f'need more than {args.k} chunks, got {len(texts)}')
+    if args.queries:
+        with open(args.queries, 'r', encoding='utf-8') as f:
+            queries = [line.strip() for line in f if line.strip()]
+    else:
+        queries = sample_queries(texts, 100)
+
+    results = {}
+    for backend in (args.baseline, args.backend):
+        start = time.perf_counter()
+        embeddings = create_embeddings(backend=backend, model_name=args.model, num_threads=args.threads)
+        if args.threads and backend.startswith('torch'):
+            import torch
+            torch.set_num_threads(args.threads)
+        load_seconds = time.perf_counter() - start
+        documents, query_vectors, seconds = embed(embeddings, texts, queries)
+        results[backend] = (documents, query_vectors, seconds)
+        print(f'{backend:>10}: load {load_seconds:.1f}s, {len(texts)} chunks in {seconds:.2f}s ({len(texts) / seconds:.1f} chunks/sec)')
+
+    base_documents, base_queries, base_seconds = results[args.baseline]
+    documents, query_vectors, seconds = results[args.backend]
+    cosine = np.sum(normalize(base_documents) * normalize(documents), axis=1)
+    expected = top_k(base_documents, base_queries, args.k)
+    actual = top_k(documents, query_vectors, args.k)
+    recall = np.mean([len(set(e) & set(a)) / args.k for e, a in zip(expected, actual)])
+    top1 = np.mean(expected[:, 0] == actual[:, 0])
+
+    print(f'chunks: {len(texts)}, queries: {len(queries)}')
+    print(f'vector cosine to {args.baseline}: mean {cosine.mean():.4f}, min {cosine.min():.4f}')
+    print(f'recall@{args.k}: {recall:.4f}, top-1 agreement: {top1:.4f}')
+    print(f'speedup: {base_seconds / seconds:.2f}x')
+    if recall < args.min_recall:
+        print(f'FAILED: recall@{args.k} {recall:.4f} < {args.min_recall}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
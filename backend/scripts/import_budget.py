@@ -0,0 +1,79 @@
+"""
+Report where the time of importing the app goes and check it against a budget.
+アプリのインポート時間の内訳を表示し、予算内かどうかを確認する
+
+Usage (from the backend directory):
+    python -m scripts.import_budget
+    python -m scripts.import_budget --module main --budget-ms 1000 --top 20
+
+The module is imported in a fresh interpreter with -X importtime. The report lists the
+top-level packages by cumulative import time. The script exits with status 1 when the
+total exceeds --budget-ms.
+"""
+import os
+import re
+import sys
+import argparse
+import subprocess
+from typing import Dict, List, Tuple
+
+BACKEND_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# import time:   self [us] | cumulative | imported package
+LINE_PATTERN = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def measure(module: str) -> List[Tuple[int, int, int, str]]:
+    """
+    Import the module in a new interpreter and return (self us, cumulative us, depth, name) per imported module.
+    新しいインタプリタでモジュールをインポートし、モジュール毎の(自身の時間, 累積時間, 深さ, 名前)を返す
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=BACKEND_DIRECTORY, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr)
+        raise SystemExit(f'failed to import {module}')
+    rows = []
+    for line in result.stderr.splitlines():
+        m = LINE_PATTERN.match(line)
+        if m:
+            rows.append((int(m.group(1)), int(m.group(2)), len(m.group(3)) // 2, m.group(4)))
+    return rows
+
+
+def by_package(rows: List[Tuple[int, int, int, str]]) -> Dict[str, int]:
+    # self time summed per top-level package (cumulative times of nested imports would double count)
+    totals = {}
+    for self_us, _, _, name in rows:
+        package = name.split('.')[0]
+        totals[package] = totals.get(package, 0) + self_us
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report import time of the app against a budget.')
+    parser.add_argument('--module', default='main')
+    parser.add_argument('--budget-ms', type=float, default=1000.0)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    rows = measure(args.module)
+    total_ms = sum(self_us for self_us, _, _, _ in rows) / 1000
+    print(f'import {args.module}: {total_ms:.0f} ms ({len(rows)} modules, budget {args.budget_ms:.0f} ms)')
+    print(f'{"package":<40} {"ms":>8} {"share":>7}')
+    for package, self_us in sorted(by_package(rows).items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f'{package:<40} {self_us / 1000:>8.1f} {self_us / 1000 / total_ms:>7.1%}')
+
+    heavy = ('torch', 'transformers', 'sentence_transformers', 'onnxruntime', 'faiss', 'chromadb', 'pymilvus',
+             'langchain_google_genai', 'langchain_openai', 'google', 'boto3', 'azure', 'ibm_vpc', 'ibm_boto3')
+    eager = sorted({name.split('.')[0] for _, _, _, name in rows if name.split('.')[0] in heavy})
+    if eager:
+        print(f'loaded at import (expected on first use): {", ".join(eager)}')
+    if total_ms > args.budget_ms:
+        print(f'FAILED: {total_ms:.0f} ms > {args.budget_ms:.0f} ms')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
-from utils.embedding import supported_vectorstore_class
+from utils.retrieval import supported_vectorstore_class
 from tools.memory_tools import get_memory_tools
 from tools.multi_cloud_tools import list_all_cloud_resources
 from tools.utils import get_cloud_tools
+from tools.cache import tool_cache, TOOL_CACHE_ENABLED
 
 
 def get_tools(providers: str, vectorstore_class: str = "chroma"):
@@ -15,11 +16,15 @@ def get_tools(providers: str, vectorstore_class: str = "chroma"):
     tools.extend(get_cloud_tools(providers=_providers))
     tools.append(list_all_cloud_resources)
 
-    # vectorstore
+    # vectorstore (the embedding model and the store are loaded on first use)
     rag_tool_instance = None
     if vectorstore_class in supported_vectorstore_class:
         from tools.rag_tools import create_rag_tool_instance
         rag_tool_instance = create_rag_tool_instance(vectorstore_class=vectorstore_class)
         tools.append(rag_tool_instance.rag_tool)
 
+    # memoize read-only tools
+    if TOOL_CACHE_ENABLED:
+        tools = tool_cache.wrap_tools(tools)
+
     return tools, rag_tool_instance
\ No newline at end of file
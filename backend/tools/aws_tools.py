@@ -1,10 +1,10 @@
 import os
 from threading import Lock
 from langchain.tools import tool
-import boto3
 from pydantic import BaseModel, Field
 from datetime import datetime, timedelta, timezone
 from typing import Optional
+from tools.utils import ListInput, compact_list
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -23,6 +23,7 @@ class AWSClientManager:
         with cls._lock:
             if cls._ec2_client is None:
                 region = os.getenv("AWS_REGION", "us-east-1")
+                import boto3
                 cls._ec2_client = boto3.client("ec2", region_name=region)
             return cls._ec2_client
 
@@ -31,6 +32,7 @@ class AWSClientManager:
         with cls._lock:
             if cls._s3_client is None:
                 region = os.getenv("AWS_REGION", "us-east-1")
+                import boto3
                 cls._s3_client = boto3.client("s3", region_name=region)
             return cls._s3_client
 
@@ -39,6 +41,7 @@ class AWSClientManager:
         with cls._lock:
             if cls._cloudwatch_client is None:
                 region = os.getenv("AWS_REGION", "us-east-1")
+                import boto3
                 cls._cloudwatch_client = boto3.client("cloudwatch", region_name=region)
             return cls._cloudwatch_client
 
@@ -46,22 +49,33 @@ class AWSClientManager:
 # ----------------------------
 # VM Operations
 # ----------------------------
-@tool
-def list_vms(_: str) -> list[str]:
+def get_vm_names() -> list[str]:
     """
-    Return a list of running EC2 instances.
-    稼働中のEC2インスタンスをリストで返す
+    Return names of all running EC2 instances.
+    稼働中の全EC2インスタンス名を返す
     """
     client = AWSClientManager.get_ec2_client()
-    response = client.describe_instances(Filters=[{"Name": "instance-state-name", "Values": ["running"]}])
+    paginator = client.get_paginator("describe_instances")
+    pages = paginator.paginate(Filters=[{"Name": "instance-state-name", "Values": ["running"]}])
     instances = [
         next((tag["Value"] for tag in instance.get("Tags", []) if tag["Key"] == "Name"), instance["InstanceId"])
-        for reservation in response["Reservations"]
+        for page in pages
+        for reservation in page["Reservations"]
         for instance in reservation["Instances"]
     ]
     return instances or []
 
 
+@tool(args_schema=ListInput)
+def list_vms(name_filter: Optional[str] = None, sort: Optional[str] = None, limit: Optional[int] = None,
+             cursor: Optional[str] = None, summarize: bool = False) -> dict:
+    """
+    Return running EC2 instances (counts, a page of names and a cursor for the next page).
+    稼働中のEC2インスタンスを返す（件数・名前の1ページ分・次ページのカーソル）
+    """
+    return compact_list(get_vm_names(), name_filter=name_filter, sort=sort, limit=limit, cursor=cursor, summarize=summarize)
+
+
 @tool
 def start_vm(instance_id: str) -> str:
     """
@@ -87,11 +101,10 @@ def stop_vm(instance_id: str) -> str:
 # ----------------------------
 # Storage Operations
 # ----------------------------
-@tool
-def list_buckets(_: str) -> list[str]:
+def get_bucket_names() -> list[str]:
     """
-    Return a list of S3 buckets.
-    S3バケットの一覧をリストで返す
+    Return names of all S3 buckets.
+    全S3バケット名を返す
     """
     client = AWSClientManager.get_s3_client()
     response = client.list_buckets()
@@ -99,6 +112,16 @@ def list_buckets(_: str) -> list[str]:
     return buckets or []
 
 
+@tool(args_schema=ListInput)
+def list_buckets(name_filter: Optional[str] = None, sort: Optional[str] = None, limit: Optional[int] = None,
+                 cursor: Optional[str] = None, summarize: bool = False) -> dict:
+    """
+    Return S3 buckets (counts, a page of names and a cursor for the next page).
+    S3バケットを返す（件数・名前の1ページ分・次ページのカーソル）
+    """
+    return compact_list(get_bucket_names(), name_filter=name_filter, sort=sort, limit=limit, cursor=cursor, summarize=summarize)
+
+
 @tool
 def create_bucket(bucket_name: str) -> str:
     """
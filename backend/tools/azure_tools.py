@@ -1,14 +1,10 @@
 import os
-from threading import Lock
+from threading import RLock
 from langchain.tools import tool
 from pydantic import BaseModel, Field
-from azure.identity import DefaultAzureCredential
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.storage import StorageManagementClient
-from azure.storage.blob import BlobServiceClient
-from azure.mgmt.monitor import MonitorManagementClient
 from datetime import datetime, timedelta, timezone
 from typing import Optional
+from tools.utils import ListInput, compact_list
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -17,7 +13,8 @@ load_dotenv()
 # Azure Client Manager
 # ----------------------------
 class AzureClientManager:
-    _lock = Lock()
+    # reentrant: client getters call get_credential while holding it
+    _lock = RLock()
     _compute_client = None
     _storage_client = None
     _monitor_client = None
@@ -28,6 +25,7 @@ class AzureClientManager:
     def get_credential(cls):
         with cls._lock:
             if cls._credential is None:
+                from azure.identity import DefaultAzureCredential
                 cls._credential = DefaultAzureCredential()
             return cls._credential
 
@@ -37,6 +35,7 @@ class AzureClientManager:
             if cls._compute_client is None:
                 credential = cls.get_credential()
                 subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
+                from azure.mgmt.compute import ComputeManagementClient
                 cls._compute_client = ComputeManagementClient(credential, subscription_id)
             return cls._compute_client
 
@@ -46,6 +45,7 @@ class AzureClientManager:
             if cls._storage_client is None:
                 credential = cls.get_credential()
                 subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
+                from azure.mgmt.storage import StorageManagementClient
                 cls._storage_client = StorageManagementClient(credential, subscription_id)
             return cls._storage_client
 
@@ -55,6 +55,7 @@ class AzureClientManager:
             if cls._monitor_client is None:
                 credential = cls.get_credential()
                 subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
+                from azure.mgmt.monitor import MonitorManagementClient
                 cls._monitor_client = MonitorManagementClient(credential, subscription_id)
             return cls._monitor_client
 
@@ -66,11 +67,12 @@ class AzureClientManager:
         return keys.keys[0].value
 
     @classmethod
-    def get_blob_service_client(cls, account_name: str) -> BlobServiceClient:
+    def get_blob_service_client(cls, account_name: str):
         with cls._lock:
             if account_name not in cls._blob_clients:
                 account_key = cls.get_storage_account_key(account_name)
                 conn_str = f"DefaultEndpointsProtocol=https;AccountName={account_name};AccountKey={account_key};EndpointSuffix=core.windows.net"
+                from azure.storage.blob import BlobServiceClient
                 cls._blob_clients[account_name] = BlobServiceClient.from_connection_string(conn_str)
             return cls._blob_clients[account_name]
 
@@ -78,11 +80,10 @@ class AzureClientManager:
 # ----------------------------
 # VM Operations
 # ----------------------------
-@tool
-def list_vms(_: str) -> list[str]:
+def get_vm_names() -> list[str]:
     """
-    Return a list of running VM instances.
-    稼働中のVMインスタンスを返す
+    Return names of all VM instances.
+    全VMインスタンス名を返す
     """
     resource_group = os.getenv("AZURE_RESOURCE_GROUP")
     client = AzureClientManager.get_compute_client()
@@ -90,6 +91,16 @@ def list_vms(_: str) -> list[str]:
     return [vm.name for vm in vms] or []
 
 
+@tool(args_schema=ListInput)
+def list_vms(name_filter: Optional[str] = None, sort: Optional[str] = None, limit: Optional[int] = None,
+             cursor: Optional[str] = None, summarize: bool = False) -> dict:
+    """
+    Return VM instances in any state (counts, a page of names and a cursor for the next page).
+    状態を問わずVMインスタンスを返す（件数・名前の1ページ分・次ページのカーソル）
+    """
+    return compact_list(get_vm_names(), name_filter=name_filter, sort=sort, limit=limit, cursor=cursor, summarize=summarize)
+
+
 @tool
 def start_vm(vm_name: str) -> str:
     """
@@ -117,17 +128,30 @@ def stop_vm(vm_name: str) -> str:
 # ----------------------------
 # Storage Operations
 # ----------------------------
-@tool
-def list_buckets(account_name: str) -> list[str]:
+def get_bucket_names(account_name: str) -> list[str]:
     """
-    List containers in the given Storage Account.
-    コンテナの一覧を返す
+    Return names of all containers in the given Storage Account.
+    全コンテナ名を返す
     """
     blob_service = AzureClientManager.get_blob_service_client(account_name)
     containers = [c.name for c in blob_service.list_containers()]
     return containers
 
 
+class ListBucketsInput(ListInput):
+    account_name: str = Field(..., description="Azure Storage Account name")
+
+
+@tool(args_schema=ListBucketsInput)
+def list_buckets(account_name: str, name_filter: Optional[str] = None, sort: Optional[str] = None, limit: Optional[int] = None,
+                 cursor: Optional[str] = None, summarize: bool = False) -> dict:
+    """
+    List containers in the given Storage Account (counts, a page of names and a cursor for the next page).
+    コンテナを返す（件数・名前の1ページ分・次ページのカーソル）
+    """
+    return compact_list(get_bucket_names(account_name), name_filter=name_filter, sort=sort, limit=limit, cursor=cursor, summarize=summarize)
+
+
 @tool
 def create_bucket(account_name: str, container_name: str) -> str:
     """
@@ -0,0 +1,218 @@
+import copy
+import json
+import os
+import time
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+from typing import Dict, List, Optional
+from tools.utils import is_mutating_tool
+from dotenv import load_dotenv
+load_dotenv()
+
+
+# TTL (seconds) of read-only tools. Tools not listed here are never cached.
+DEFAULT_TOOL_TTLS = {
+    "list_vms": 30,
+    "list_buckets": 60,
+    "list_vm_cpu_usage": 15,
+    "list_all_cloud_resources": 30,
+    # rag_tool is cached by the vectorstore per index version (utils/retrieval.py)
+}
+
+# providers whose results contain resources of every cloud
+AGGREGATE_PROVIDERS = {"multi_cloud"}
+CLOUD_PROVIDERS = {"aws", "azure", "gcp", "ibmcloud"}
+
+
+def get_tool_provider(tool) -> str:
+    """
+    Return the provider of the tool from its module name (e.g. tools.aws_tools -> aws).
+    ツールのモジュール名からプロバイダ名を返す
+    """
+    func = getattr(tool, "func", None) or getattr(tool, "coroutine", None)
+    module = getattr(func, "__module__", "") or ""
+    name = module.rsplit(".", 1)[-1]
+    return name[:-len("_tools")] if name.endswith("_tools") else name
+
+
+def _copy(value):
+    # cached lists and dicts are shared, callers get their own copy
+    return copy.deepcopy(value) if isinstance(value, (list, dict)) else value
+
+
+def _make_key(provider: str, name: str, args: tuple, kwargs: dict) -> str:
+    payload = {"args": list(args), "kwargs": kwargs}
+    return f"{provider}:{name}:{json.dumps(payload, sort_keys=True, default=str)}"
+
+
+# ----------------------------
+# Tool Result Cache
+# ----------------------------
+class ToolResultCache:
+    """
+    LRU + TTL memoization of read-only tool results.
+    読み取り専用ツールの結果をTTL付きLRUでキャッシュする
+
+    When a mutating tool of a provider succeeds, cached entries of the provider are invalidated.
+    Each provider has a generation, bumped when a mutation starts and when it is invalidated;
+    a read result is stored only if the generation did not change while the read ran, so reads overlapping a mutation are not cached.
+    変更系ツールが成功した場合、同じプロバイダのキャッシュを破棄する。
+    プロバイダ毎の世代を変更の開始時と破棄時に進め、読み取り中に世代が変わった結果は保存しない
+    """
+
+    def __init__(self, max_entries: int = 1024, ttls: Optional[Dict[str, float]] = None):
+        self.max_entries = max_entries
+        self.ttls = dict(DEFAULT_TOOL_TTLS if ttls is None else ttls)
+        self._entries = OrderedDict()  # key -> (provider, expires_at, value)
+        self._generations = {}  # provider -> generation
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return False, None
+            _, expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self._misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return True, _copy(value)
+
+    def generation(self, provider: str) -> int:
+        with self._lock:
+            return self._generations.get(provider, 0)
+
+    @staticmethod
+    def _targets(provider: str) -> set:
+        # a change of a cloud provider also changes the multi cloud summary
+        return {provider} | AGGREGATE_PROVIDERS if provider in CLOUD_PROVIDERS else {provider}
+
+    def _bump(self, targets: set):
+        for target in targets:
+            self._generations[target] = self._generations.get(target, 0) + 1
+
+    def begin_mutation(self, provider: str):
+        """
+        Stop storing reads of the provider which are in flight (they may predate the mutation).
+        実行中のプロバイダの読み取り結果を保存しないようにする（変更前の状態の可能性がある）
+        """
+        with self._lock:
+            self._bump(self._targets(provider))
+
+    def set(self, key: str, provider: str, value, ttl: float, generation: Optional[int] = None):
+        """
+        Store a read result. With generation, nothing is stored if the provider changed since the read started.
+        読み取り結果を保存する。generationを指定した場合、読み取り開始後にプロバイダが変更されていれば保存しない
+        """
+        with self._lock:
+            if generation is not None and self._generations.get(provider, 0) != generation:
+                return
+            self._entries[key] = (provider, time.monotonic() + ttl, _copy(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_provider(self, provider: str):
+        """
+        Drop cached entries of the provider (and of the multi cloud summary for cloud providers).
+        プロバイダのキャッシュを破棄する
+        """
+        targets = self._targets(provider)
+        with self._lock:
+            for key in [k for k, v in self._entries.items() if v[0] in targets]:
+                del self._entries[key]
+            # reads started during the mutation are not stored either
+            self._bump(targets)
+            self._invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Return hit-rate statistics.
+        ヒット率などの統計情報を返す
+        """
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / total, 4) if total else 0.0,
+                "invalidations": self._invalidations,
+            }
+
+    # ----------------------------
+    # Tool wrapping
+    # ----------------------------
+    def wrap_tool(self, tool):
+        """
+        Return a copy of the tool whose results are memoized or which invalidates the cache.
+        キャッシュ対応したツールのコピーを返す
+        """
+        if getattr(tool, "func", None) is None:
+            return tool
+        provider = get_tool_provider(tool)
+        name = tool.name
+        func = tool.func
+
+        if is_mutating_tool(name):
+            @wraps(func)
+            def mutating(*args, **kwargs):
+                self.begin_mutation(provider)
+                # a failed mutation changed nothing, the cache is kept
+                result = func(*args, **kwargs)
+                self.invalidate_provider(provider)
+                return result
+            return tool.model_copy(update={"func": mutating})
+
+        ttl = self.ttls.get(name)
+        if not ttl:
+            return tool
+
+        @wraps(func)
+        def memoized(*args, **kwargs):
+            key = _make_key(provider, name, args, kwargs)
+            hit, value = self.get(key)
+            if hit:
+                return value
+            generation = self.generation(provider)
+            value = func(*args, **kwargs)
+            self.set(key, provider, value, ttl, generation=generation)
+            return value
+        return tool.model_copy(update={"func": memoized})
+
+    def wrap_tools(self, tools: List) -> List:
+        return [self.wrap_tool(tool) for tool in tools]
+
+
+def parse_tool_ttls(value: Optional[str]) -> Dict[str, float]:
+    """
+    Parse TTL overrides such as "list_vms=10,rag_tool=600".
+    TTL設定文字列を解析する
+    """
+    ttls = dict(DEFAULT_TOOL_TTLS)
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        name, seconds = item.split("=", 1)
+        ttls[name.strip()] = float(seconds)
+    return ttls
+
+
+TOOL_CACHE_ENABLED = os.getenv("TOOL_CACHE_ENABLED", "true").lower() == "true"
+tool_cache = ToolResultCache(
+    max_entries=int(os.getenv("TOOL_CACHE_MAX_ENTRIES", "1024")),
+    ttls=parse_tool_ttls(os.getenv("TOOL_CACHE_TTLS"))
+)
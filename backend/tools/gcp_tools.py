@@ -1,10 +1,10 @@
 import os
 from threading import Lock
 from langchain.tools import tool
-from google.cloud import compute_v1, storage, monitoring_v3
 from pydantic import BaseModel, Field
 from datetime import datetime, timedelta, timezone
 from typing import Optional
+from tools.utils import ListInput, compact_list
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -22,6 +22,7 @@ class GCPClientManager:
     def get_compute_client(cls):
         with cls._lock:
             if cls._compute_client is None:
+                from google.cloud import compute_v1
                 cls._compute_client = compute_v1.InstancesClient()
             return cls._compute_client
 
@@ -30,6 +31,7 @@ class GCPClientManager:
         with cls._lock:
             if cls._storage_client is None:
                 project_id = os.getenv("GCP_PROJECT_ID")
+                from google.cloud import storage
                 cls._storage_client = storage.Client(project=project_id)
             return cls._storage_client
 
@@ -37,6 +39,7 @@ class GCPClientManager:
     def get_monitoring_client(cls):
         with cls._lock:
             if cls._monitoring_client is None:
+                from google.cloud import monitoring_v3
                 cls._monitoring_client = monitoring_v3.MetricServiceClient()
             return cls._monitoring_client
 
@@ -44,11 +47,10 @@ class GCPClientManager:
 # ----------------------------
 # VM Operations
 # ----------------------------
-@tool
-def list_vms(_: str) -> list[str]:
+def get_vm_names() -> list[str]:
     """
-    Return a list of running VM instances.
-    稼働中のVMインスタンスを返す
+    Return names of all VM instances.
+    全VMインスタンス名を返す
     """
     project_id = os.getenv("GCP_PROJECT_ID")
     zone = os.getenv("GCP_ZONE", "us-central1-a")
@@ -57,6 +59,16 @@ def list_vms(_: str) -> list[str]:
     return [vm.name for vm in vms] or []
 
 
+@tool(args_schema=ListInput)
+def list_vms(name_filter: Optional[str] = None, sort: Optional[str] = None, limit: Optional[int] = None,
+             cursor: Optional[str] = None, summarize: bool = False) -> dict:
+    """
+    Return VM instances in any state (counts, a page of names and a cursor for the next page).
+    状態を問わずVMインスタンスを返す（件数・名前の1ページ分・次ページのカーソル）
+    """
+    return compact_list(get_vm_names(), name_filter=name_filter, sort=sort, limit=limit, cursor=cursor, summarize=summarize)
+
+
 @tool
 def start_vm(instance_name: str) -> str:
     """
@@ -86,17 +98,26 @@ def stop_vm(instance_name: str) -> str:
 # ----------------------------
 # Storage Operations
 # ----------------------------
-@tool
-def list_buckets(_: str) -> list[str]:
+def get_bucket_names() -> list[str]:
     """
-    List all storage buckets.
-    Storageバケットの一覧を返す
+    Return names of all storage buckets.
+    全Storageバケット名を返す
     """
     client = GCPClientManager.get_storage_client()
     buckets = client.list_buckets()
     return [b.name for b in buckets] or []
 
 
+@tool(args_schema=ListInput)
+def list_buckets(name_filter: Optional[str] = None, sort: Optional[str] = None, limit: Optional[int] = None,
+                 cursor: Optional[str] = None, summarize: bool = False) -> dict:
+    """
+    List storage buckets (counts, a page of names and a cursor for the next page).
+    Storageバケットを返す（件数・名前の1ページ分・次ページのカーソル）
+    """
+    return compact_list(get_bucket_names(), name_filter=name_filter, sort=sort, limit=limit, cursor=cursor, summarize=summarize)
+
+
 @tool
 def create_bucket(bucket_name: str) -> str:
     """
@@ -142,6 +163,7 @@ def list_vm_cpu_usage(instance_name: str, n: int) -> str:
     Return average CPU usage for the specified VM in the past n minutes.
     指定VMの過去n分のCPU使用率平均を返す
     """
+    from google.cloud import monitoring_v3
     project_id = os.getenv("GCP_PROJECT_ID")
     client = GCPClientManager.get_monitoring_client()
     project_name = f"projects/{project_id}"
@@ -2,12 +2,8 @@ import os
 from threading import Lock
 from langchain.tools import tool
 from pydantic import BaseModel, Field
-from ibm_vpc import VpcV1
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-from ibm_cloud_sdk_core import ApiException
-import ibm_boto3
-from ibm_botocore.client import Config
 from typing import Optional
+from tools.utils import ListInput, compact_list
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -27,6 +23,8 @@ class IBMClientManager:
             api_key = os.getenv("IBM_API_KEY")
             region = os.getenv("IBM_REGION", "jp-tok")
             if cls._vpc_client is None:
+                from ibm_vpc import VpcV1
+                from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
                 authenticator = IAMAuthenticator(apikey=api_key)
                 client = VpcV1(authenticator=authenticator)
                 client.set_service_url(VpcV1.get_service_url_for_region(region))
@@ -45,6 +43,8 @@ class IBMClientManager:
             api_key = os.getenv("IBM_API_KEY")
             region = os.getenv("IBM_REGION", "jp-tok")
             if cls._cos_client is None:
+                import ibm_boto3
+                from ibm_botocore.client import Config
                 cls._cos_client = ibm_boto3.resource(
                     's3',
                     ibm_api_key_id=api_key,
@@ -64,6 +64,7 @@ class IBMClientManager:
 # ----------------------------
 def ibm_vpc_operation(func, *args, **kwargs):
     """Operate VPC function. When failed, retry."""
+    from ibm_cloud_sdk_core import ApiException
     try:
         client = IBMClientManager.get_vpc_client()
         return func(client, *args, **kwargs)
@@ -78,6 +79,7 @@ def ibm_vpc_operation(func, *args, **kwargs):
 
 def ibm_cos_operation(func, *args, **kwargs):
     """Operate COS function. When failed, retry."""
+    import ibm_boto3
     try:
         client = IBMClientManager.get_cos_client()
         return func(client, *args, **kwargs)
@@ -90,11 +92,10 @@ def ibm_cos_operation(func, *args, **kwargs):
 # ----------------------------
 # VM Operations
 # ----------------------------
-@tool
-def list_vms(_: str) -> str:
+def get_vm_names() -> list[str]:
     """
-    Return a list of running VM instances.
-    稼働中のVMインスタンスのリストを返す
+    Return names of all VM instances.
+    全VMインスタンス名を返す
     """
     vpc_instance_id = os.getenv("IBM_VPC_INSTANCE_ID")
 
@@ -105,6 +106,16 @@ def list_vms(_: str) -> str:
     return ibm_vpc_operation(_list, vpc_instance_id)
 
 
+@tool(args_schema=ListInput)
+def list_vms(name_filter: Optional[str] = None, sort: Optional[str] = None, limit: Optional[int] = None,
+             cursor: Optional[str] = None, summarize: bool = False) -> dict:
+    """
+    Return VM instances in any state (counts, a page of names and a cursor for the next page).
+    状態を問わずVMインスタンスを返す（件数・名前の1ページ分・次ページのカーソル）
+    """
+    return compact_list(get_vm_names(), name_filter=name_filter, sort=sort, limit=limit, cursor=cursor, summarize=summarize)
+
+
 @tool
 def start_vm(vm_name: str) -> str:
     """
@@ -146,17 +157,26 @@ def stop_vm(vm_name: str) -> str:
 # ----------------------------
 # Object Storage Operations
 # ----------------------------
-@tool
-def list_buckets(_: str) -> str:
+def get_bucket_names() -> list[str]:
     """
-    List all buckets in Object Storage.
-    バケット一覧
+    Return names of all buckets in Object Storage.
+    全バケット名
     """
     def _list(cos):
         return [b.name for b in cos.buckets.all()] or []
     return ibm_cos_operation(_list)
 
 
+@tool(args_schema=ListInput)
+def list_buckets(name_filter: Optional[str] = None, sort: Optional[str] = None, limit: Optional[int] = None,
+                 cursor: Optional[str] = None, summarize: bool = False) -> dict:
+    """
+    List buckets in Object Storage (counts, a page of names and a cursor for the next page).
+    バケット一覧（件数・名前の1ページ分・次ページのカーソル）
+    """
+    return compact_list(get_bucket_names(), name_filter=name_filter, sort=sort, limit=limit, cursor=cursor, summarize=summarize)
+
+
 @tool
 def create_bucket(bucket_name: str) -> str:
     """
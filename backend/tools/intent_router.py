@@ -0,0 +1,356 @@
+import asyncio
+import math
+import re
+import time
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Callable, Dict, List, Optional
+from tools.multi_cloud_tools import list_all_cloud_resources
+from tools.utils import get_cloud_tools_by_provider
+from tools.cache import tool_cache, TOOL_CACHE_ENABLED
+
+
+# ----------------------------
+# Intent definitions
+# ----------------------------
+# provider keywords
+PROVIDER_ALIASES = {
+    "aws": ["aws", "amazon", "ec2", "s3"],
+    "gcp": ["gcp", "google", "gce", "gcs"],
+    "azure": ["azure"],
+    "ibmcloud": ["ibmcloud", "ibm cloud", "ibm"],
+}
+
+PROVIDER_LABELS = {
+    "aws": "AWS",
+    "gcp": "GCP",
+    "azure": "Azure",
+    "ibmcloud": "IBM Cloud",
+}
+
+# example utterances for the nearest-neighbour classifier
+INTENT_EXAMPLES = {
+    "list_vms": [
+        "list vms",
+        "show my instances",
+        "what servers do I have",
+        "get all virtual machines",
+        "VM一覧を表示して",
+        "インスタンスを教えて",
+    ],
+    "list_buckets": [
+        "list buckets",
+        "show storage buckets",
+        "what buckets do I have",
+        "get object storage containers",
+        "バケット一覧を表示して",
+        "ストレージのバケットを教えて",
+    ],
+    "start_vm": [
+        "start vm web-1",
+        "boot instance app-server",
+        "power on the server db-1",
+        "VM web-1を起動して",
+    ],
+    "stop_vm": [
+        "stop vm web-1",
+        "shut down instance app-server",
+        "power off the server db-1",
+        "VM web-1を停止して",
+    ],
+    "list_all_cloud_resources": [
+        "show all cloud resources",
+        "summary of every resource across clouds",
+        "overview of all vms and buckets",
+        "全クラウドのリソースを表示して",
+    ],
+}
+
+# start/stop must be one imperative command covering the whole (lower-cased) input, e.g.
+# "start vm web-1 on aws", "please stop the instance i-123" or "aws の vm web-1を停止して"
+_TARGET = r"[\"']?[a-z0-9_\-\.]+[\"']?"
+_PROVIDER = "(?:" + "|".join(re.escape(alias) for aliases in PROVIDER_ALIASES.values() for alias in aliases) + r")(?:\s+cloud)?"
+_PROVIDER_SUFFIX = rf"(?:\s+(?:on|in)\s+(?:the\s+)?{_PROVIDER})?"
+_JA_PROVIDER = rf"(?:{_PROVIDER}\s*の\s*)?"
+_JA_SUFFIX = rf"(?:して(?:ください)?)?[。!！]?(?:\s*[\(（]\s*{_PROVIDER}\s*[\)）])?"
+
+
+def _command_rule(verbs: str, ja_verb: str):
+    return re.compile(
+        rf"^(?:please\s+)?(?:{verbs})\s+(?:the\s+)?(?:vm|instance|server|machine)\s+(?:named\s+|called\s+)?{_TARGET}{_PROVIDER_SUFFIX}(?:\s+please)?[.!]?$"
+        rf"|^{_JA_PROVIDER}(?:vm|インスタンス|サーバー?)\s*{_TARGET}\s*を\s*{ja_verb}{_JA_SUFFIX}$"
+    )
+
+
+# listings must also cover the whole input, e.g. "list vms on aws", "show me all my aws instances", "what buckets do I have"
+# or "aws の vm一覧を表示して"; a target, attribute or state ("show vm web-1 details", "show stopped instances") goes to the agent
+def _list_rule(nouns: str, ja_nouns: str):
+    return re.compile(
+        rf"^(?:please\s+)?(?:list|show|get|display)(?:\s+me)?(?:\s+(?:all|every|the|my|of))*\s+(?:{_PROVIDER}\s+)?(?:{nouns})"
+        rf"{_PROVIDER_SUFFIX}(?:\s+please)?[.!]?$"
+        rf"|^what\s+(?:{_PROVIDER}\s+)?(?:{nouns})\s+do\s+i\s+have{_PROVIDER_SUFFIX}[?？]?$"
+        rf"|^{_JA_PROVIDER}(?:{ja_nouns})\s*(?:の\s*)?(?:一覧\s*)?(?:を\s*)?(?:表示し|見せ|教え)て(?:ください)?[。!！]?(?:\s*[\(（]\s*{_PROVIDER}\s*[\)）])?$"
+        rf"|^{_JA_PROVIDER}(?:{ja_nouns})\s*(?:の\s*)?一覧[。!！]?$"
+    )
+
+
+INTENT_RULES = [
+    ("start_vm", _command_rule(r"start|boot|power\s+on", "起動")),
+    ("stop_vm", _command_rule(r"stop|shut\s*down|power\s+off|halt", "停止")),
+    ("list_all_cloud_resources", re.compile(r"\b(all|every)\b.*\bresources?\b|全クラウド|全リソース")),
+    ("list_vms", _list_rule(r"vms?|instances?|servers?|(?:virtual\s+)?machines?", r"vm|インスタンス|サーバー?|仮想マシン")),
+    ("list_buckets", _list_rule(r"(?:storage\s+)?buckets?|containers?", r"バケット|ストレージ")),
+]
+
+# target name of start/stop
+TARGET_PATTERNS = [
+    re.compile(r"\b(?:vm|instance|server|machine)\s+(?:named\s+|called\s+)?[\"']?([A-Za-z0-9_\-\.]+)[\"']?", re.IGNORECASE),
+    re.compile(r"[\"']([A-Za-z0-9_\-\.]+)[\"']"),
+    re.compile(r"(?:vm|VM|インスタンス)\s*([A-Za-z0-9_\-\.]+)\s*を"),
+]
+
+# words showing the request is not a single literal command
+COMPOUND_PATTERN = re.compile(r"\b(and|then|after|before|if|unless|where|which|that|more|less|than)\b|、|そして|してから|もし")
+
+# negations and questions are never executed as commands ("don't stop vm web-1", "how do I stop vm web-1?")
+NEGATION_PATTERN = re.compile(r"\b(not|no|never|don'?t|doesn'?t|didn'?t|can'?t|cannot|won'?t|shouldn'?t)\b|ない|ません|しないで|禁止")
+QUESTION_PATTERN = re.compile(
+    r"[?？]|^(how|why|what|when|who|whom|whose|did|does|do|can|could|should|would|will|is|are|was|were|has|have)\b|ですか|ますか|か[。]?$"
+)
+
+# attributes and states of resources: listings return names only, so such requests go to the agent
+# (checked for embedding matches too, e.g. "get cpu usage for instance i-123")
+ATTRIBUTE_PATTERN = re.compile(
+    r"\b(cpu|memory|ram|ip|address|logs?|details?|status|state|usage|metrics?|size|cost|price|type|zones?|regions?|tags?|disks?|"
+    r"network|config\w*|running|stopped|stopping|started|starting|terminated|pending|idle)\b|使用率|ログ|詳細|状態|稼働|停止中|アドレス|料金"
+)
+
+REQUIRED_TARGET = {"start_vm", "stop_vm"}
+LIST_INTENTS = {"list_vms", "list_buckets"}
+# intents changing resources: run only on an exact rule match, never on embedding similarity
+MUTATING_INTENTS = {"start_vm", "stop_vm"}
+# Azure needs a Storage Account name to list containers
+UNSUPPORTED = {("azure", "list_buckets")}
+
+
+@dataclass
+class IntentMatch:
+    intent: str
+    providers: List[str] = field(default_factory=list)
+    target: Optional[str] = None
+    confidence: float = 0.0
+    method: str = "rule"
+
+
+# ----------------------------
+# Intent Router
+# ----------------------------
+class IntentRouter:
+    """
+    Deterministic fast path answering common literal commands without the LLM.
+    よく使われる定型コマンドをLLMを通さずに直接ツールで処理する
+    """
+
+    # embeddings_factory: returns the embeddings on first fuzzy match (keeps the model out of startup)
+    def __init__(self, providers: List[str], embeddings=None, similarity_threshold: float = 0.75, margin: float = 0.05, max_words: int = 12,
+                 embeddings_factory: Optional[Callable[[], object]] = None):
+        self.providers = [p for p in providers if p]
+        self.tools = get_cloud_tools_by_provider(self.providers)
+        if TOOL_CACHE_ENABLED:
+            self.tools = {
+                provider: {name: tool_cache.wrap_tool(t) for name, t in provider_tools.items()}
+                for provider, provider_tools in self.tools.items()
+            }
+        self.embeddings = embeddings
+        self.embeddings_factory = embeddings_factory
+        self.similarity_threshold = similarity_threshold
+        self.margin = margin
+        self.max_words = max_words
+        self._example_vectors = None
+        self._lock = Lock()
+
+    # ----------------------------
+    # Classification
+    # ----------------------------
+    def _extract_providers(self, text: str) -> List[str]:
+        found = []
+        for provider, aliases in PROVIDER_ALIASES.items():
+            if any(re.search(rf"\b{re.escape(alias)}\b", text) for alias in aliases):
+                found.append(provider)
+        return found
+
+    def _extract_target(self, query: str) -> Optional[str]:
+        for pattern in TARGET_PATTERNS:
+            m = pattern.search(query)
+            if m and m.group(1).lower() not in {"on", "in", "the", "vm", "instance"}:
+                return m.group(1)
+        return None
+
+    def _match_rule(self, text: str) -> Optional[str]:
+        matched = [intent for intent, pattern in INTENT_RULES if pattern.search(text)]
+        # ambiguous requests go to the agent
+        if len(matched) == 1:
+            return matched[0]
+        if matched and matched[0] == "list_all_cloud_resources" and set(matched) <= {"list_all_cloud_resources", "list_vms", "list_buckets"}:
+            return matched[0]
+        return None
+
+    def _get_embeddings(self):
+        if self.embeddings is None and self.embeddings_factory is not None:
+            self.embeddings = self.embeddings_factory()
+        return self.embeddings
+
+    def _get_example_vectors(self):
+        with self._lock:
+            if self._example_vectors is None:
+                labels, texts = [], []
+                for intent, examples in INTENT_EXAMPLES.items():
+                    labels.extend([intent] * len(examples))
+                    texts.extend(examples)
+                self._example_vectors = list(zip(labels, self._get_embeddings().embed_documents(texts)))
+            return self._example_vectors
+
+    def _match_embedding(self, query: str):
+        embeddings = self._get_embeddings()
+        if embeddings is None:
+            return None, 0.0
+        query_vector = embeddings.embed_query(query)
+        best = {}
+        for intent, vector in self._get_example_vectors():
+            score = _cosine(query_vector, vector)
+            best[intent] = max(best.get(intent, -1.0), score)
+        ranked = sorted(best.items(), key=lambda x: x[1], reverse=True)
+        if not ranked:
+            return None, 0.0
+        top_intent, top_score = ranked[0]
+        second_score = ranked[1][1] if len(ranked) > 1 else -1.0
+        if top_score < self.similarity_threshold or top_score - second_score < self.margin:
+            return None, top_score
+        return top_intent, top_score
+
+    def match(self, query: str) -> Optional[IntentMatch]:
+        """
+        Classify the query. Return None when it is not a high-confidence literal command.
+        クエリを分類する。確信度が低い場合はNoneを返す
+
+        Args:
+            query: user's request
+
+        Returns:
+            IntentMatch or None
+        """
+        if not query:
+            return None
+        text = query.strip().lower()
+        if len(text.split()) > self.max_words or COMPOUND_PATTERN.search(text) or NEGATION_PATTERN.search(text):
+            return None
+
+        intent, confidence, method = self._match_rule(text), 1.0, "rule"
+        if intent is None:
+            intent, confidence = self._match_embedding(query)
+            method = "embedding"
+        if intent is None:
+            return None
+        # start/stop only through their anchored rules, and never for a question
+        if intent in MUTATING_INTENTS and (method != "rule" or QUESTION_PATTERN.search(text)):
+            return None
+        # listings answer with names only: not for one resource or its attributes
+        if intent in LIST_INTENTS and (ATTRIBUTE_PATTERN.search(text) or self._extract_target(query)):
+            return None
+
+        providers = self._extract_providers(text)
+        # a cloud the user named but which is not configured: never fall back to another one
+        if any(p not in self.tools for p in providers):
+            return None
+        if intent == "list_all_cloud_resources":
+            return IntentMatch(intent=intent, providers=providers or list(self.tools), confidence=confidence, method=method)
+
+        if not providers and len(self.tools) == 1:
+            providers = list(self.tools)
+        if len(providers) != 1 or (providers[0], intent) in UNSUPPORTED:
+            return None
+
+        target = None
+        if intent in REQUIRED_TARGET:
+            target = self._extract_target(query)
+            if not target:
+                return None
+        return IntentMatch(intent=intent, providers=providers, target=target, confidence=confidence, method=method)
+
+    # ----------------------------
+    # Execution
+    # ----------------------------
+    async def route(self, query: str) -> Optional[Dict]:
+        """
+        Answer the query with the matched tool, or return None to fall back to the agent.
+        一致したツールで直接回答する。該当しなければNoneを返しエージェントに委ねる
+
+        Args:
+            query: user's request
+
+        Returns:
+            {"reply": str, "intent": str, "providers": [...], "method": str, "elapsed_ms": float} or None
+        """
+        start = time.perf_counter()
+        # embedding classification is CPU work, keep it off the event loop
+        matched = await asyncio.to_thread(self.match, query)
+        if matched is None:
+            return None
+
+        try:
+            if matched.intent == "list_all_cloud_resources":
+                result = await list_all_cloud_resources.ainvoke({"providers": matched.providers})
+                reply = _format_summary(result)
+            else:
+                provider = matched.providers[0]
+                tool = self.tools[provider].get(matched.intent)
+                if tool is None:
+                    return None
+                result = await tool.ainvoke(matched.target if matched.intent in REQUIRED_TARGET else {})
+                reply = _format_result(matched.intent, provider, result)
+        except Exception:
+            # let the agent handle (and explain) tool errors
+            return None
+
+        return {
+            "reply": reply,
+            "intent": matched.intent,
+            "providers": matched.providers,
+            "method": matched.method,
+            "elapsed_ms": round((time.perf_counter() - start) * 1000, 2),
+        }
+
+
+def _cosine(a, b) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def _format_names(page: dict) -> str:
+    names = ", ".join(map(str, page.get("items") or []))
+    if page.get("next_cursor"):
+        names += f" ... ({page['count']} of {page['matched']} shown)"
+    return names
+
+
+def _format_result(intent: str, provider: str, result) -> str:
+    label = PROVIDER_LABELS.get(provider, provider)
+    if intent in {"list_vms", "list_buckets"}:
+        kind = "VMs" if intent == "list_vms" else "Buckets"
+        if not result.get("matched"):
+            return f"No {kind} found on {label}."
+        return f"{kind} on {label}: {_format_names(result)}"
+    return str(result)
+
+
+def _format_summary(summary: dict) -> str:
+    lines = []
+    for provider, info in summary.items():
+        if "error" in info:
+            lines.append(f"{provider}: error ({info['error']})")
+            continue
+        vms = info.get("vms", {}).get("total", 0)
+        buckets = info.get("buckets", {}).get("total", 0)
+        lines.append(f"{provider}: {vms} VMs / {buckets} buckets")
+    return "\n".join(lines)
@@ -1,33 +1,86 @@
+import os
+import json
 from dataclasses import dataclass
+from typing import Optional
 from langchain.tools import tool, ToolRuntime
+from langgraph.store.base import PutOp
+from dotenv import load_dotenv
+load_dotenv()
+
+# facts returned by get_user_info
+MEMORY_SEARCH_K = int(os.getenv("MEMORY_SEARCH_K", "5"))
 
 
 @dataclass
 class Context:
     user_id: str
+    # team sharing documents (defaults to the user)
+    tenant_id: Optional[str] = None
+
+
+def user_facts_namespace(user_id: str) -> tuple:
+    # one item per fact, keyed by its field (e.g. "email"), so saving a field again replaces the old fact
+    return ("users", user_id, "facts")
+
+
+def _fact_op(namespace: tuple, field, value) -> PutOp:
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+    return PutOp(namespace, str(field), {"field": str(field), "value": value, "text": f"{field}: {text}"})
+
+
+def _migrate_legacy_info(store, user_id: str, replaced=()) -> bool:
+    """
+    Move user info saved as one item before facts were indexed into per-field facts, then delete the old item.
+    Fields in replaced are being saved again and are not migrated. Returns whether there was an old item.
+    ファクト索引化以前に1項目として保存されたユーザー情報をフィールド毎のファクトに移し、旧項目を削除する
+    """
+    legacy = store.get(("users",), user_id)
+    if legacy is None:
+        return False
+    info = legacy.value if isinstance(legacy.value, dict) else {"info": legacy.value}
+    namespace = user_facts_namespace(user_id)
+    ops = [_fact_op(namespace, field, value) for field, value in info.items() if str(field) not in replaced]
+    # the facts are written in the same batch as the deletion of the old item
+    store.batch(ops + [PutOp(("users",), user_id, None)])
+    return True
 
 
 @tool
-def get_user_info(runtime: ToolRuntime[Context]) -> str:
+def get_user_info(query: str, runtime: ToolRuntime[Context]) -> str:
     """
-    Look up user info from agent memory.
-    エージェントのメモリからユーザーの情報を検索する
+    Look up the facts about the user relevant to the query from agent memory.
+    エージェントのメモリから、クエリに関連するユーザーの情報を検索する
+
+    Args:
+        query: what to know about the user, e.g. "preferred cloud region"
     """
     store = runtime.store
     user_id = runtime.context.user_id
-    user_info = store.get(("users",), user_id) 
-    return str(user_info.value) if user_info else "Unknown user"
+    # user info saved as one item before facts were indexed becomes searchable facts first
+    _migrate_legacy_info(store, user_id)
+    # most relevant first when the store has semantic search, otherwise the most recent
+    facts = store.search(user_facts_namespace(user_id), query=query, limit=MEMORY_SEARCH_K)
+    if facts:
+        return "\n".join(f"- {fact.value['text']}" for fact in facts)
+    return "Unknown user"
 
 
 @tool
 def save_user_info(user_info: dict, runtime: ToolRuntime[Context]) -> str:
     """
-    Save user info to agent memory.
-    エージェントのメモリにユーザー情報を保村する
+    Save user info to agent memory. Each field is saved as a separate fact.
+    エージェントのメモリにユーザー情報を保存する（フィールド毎に別の情報として保存）
+
+    Args:
+        user_info: facts about the user, e.g. {"name": "...", "preferred_region": "..."}
     """
     store = runtime.store
     user_id = runtime.context.user_id
-    store.put(("users",), user_id, user_info)
+    namespace = user_facts_namespace(user_id)
+    # keep the fields of user info saved as one item before facts were indexed
+    _migrate_legacy_info(store, user_id, replaced={str(field) for field in user_info})
+    # one batch, so the "text" fields are embedded together when written
+    store.batch([_fact_op(namespace, field, value) for field, value in user_info.items()])
     return "Successfully saved user info."
 
 
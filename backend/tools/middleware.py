@@ -0,0 +1,148 @@
+import asyncio
+import weakref
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextvars import copy_context
+from dataclasses import replace
+from functools import partial
+from threading import BoundedSemaphore, Lock
+from typing import Dict, Optional
+from langchain.agents.middleware import AgentMiddleware
+from langchain.messages import ToolMessage
+from tools.utils import is_mutating_tool
+
+
+def parse_tool_timeouts(value: Optional[str]) -> Dict[str, float]:
+    """
+    Parse per-tool timeouts such as "list_vm_cpu_usage=20,rag_tool=10".
+    ツール毎のタイムアウト設定文字列を解析する
+    """
+    timeouts = {}
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        name, seconds = item.split("=", 1)
+        timeouts[name.strip()] = float(seconds)
+    return timeouts
+
+
+class ParallelToolMiddleware(AgentMiddleware):
+    """
+    Run independent read-only tool calls of one agent step concurrently.
+    1ステップ内の読み取り専用ツール呼び出しを並列実行する
+
+    Read-only calls share a bounded pool and are cut off after their timeout.
+    A call cut off keeps its slot until it really finishes, so abandoned calls never exceed max_concurrency.
+    Mutating calls (start_vm, stop_vm, create_bucket, uploads) are serialized in the order the LLM emitted them.
+    They are serialized with each other only: reads of the same step still run concurrently with them,
+    so a read emitted next to a mutation may see the state before or after it.
+    読み取り専用の呼び出しは上限付きで並列実行し、タイムアウトで打ち切る。
+    打ち切った呼び出しも実際に終了するまで枠を占有するため、放置された呼び出しがmax_concurrencyを超えることはない。
+    変更系の呼び出しはLLMが出力した順に1つずつ実行する。
+    変更系同士のみを直列化するため、同じステップの読み取りは並行して実行され、変更の前後どちらの状態も返しうる。
+    """
+
+    def __init__(self, max_concurrency: int = 8, default_timeout: float = 30.0, timeouts: Optional[Dict[str, float]] = None):
+        super().__init__()
+        self.max_concurrency = max_concurrency
+        self.default_timeout = default_timeout
+        self.timeouts = timeouts or {}
+        # async (per event loop, dropped with the loop)
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._mutation_locks = weakref.WeakKeyDictionary()
+        # sync
+        self._sync_semaphore = BoundedSemaphore(max_concurrency)
+        self._sync_mutation_lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="tool")
+
+    def _get_timeout(self, name: str) -> float:
+        return self.timeouts.get(name, self.default_timeout)
+
+    def _get_async_primitives(self):
+        # asyncio primitives are bound to the running loop
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+            self._mutation_locks[loop] = asyncio.Lock()
+        return self._semaphores[loop], self._mutation_locks[loop]
+
+    @staticmethod
+    def _runs_in_thread(tool) -> bool:
+        # sync tools are run in a thread by ainvoke, which cancellation does not stop
+        return tool is not None and getattr(tool, "func", None) is not None and getattr(tool, "coroutine", None) is None
+
+    def _threaded(self, func, futures: list):
+        # run the sync tool in the bounded pool, keeping the future so the slot outlives a timeout
+        async def run(*args, **kwargs):
+            future = self._executor.submit(copy_context().run, partial(func, *args, **kwargs))
+            futures.append(future)
+            return await asyncio.wrap_future(future)
+        return run
+
+    @staticmethod
+    def _release_once(semaphore: asyncio.Semaphore, loop):
+        released = Lock()
+
+        def release(*_):
+            # called from the loop or from a tool thread
+            if not released.acquire(blocking=False) or loop.is_closed():
+                return
+            loop.call_soon_threadsafe(semaphore.release)
+        return release
+
+    def _timeout_message(self, request, timeout: float) -> ToolMessage:
+        tool_call = request.tool_call
+        return ToolMessage(
+            content=f"Tool '{tool_call['name']}' timed out after {timeout:.0f} seconds.",
+            tool_call_id=tool_call["id"],
+            name=tool_call["name"],
+            status="error",
+        )
+
+    def wrap_tool_call(self, request, handler):
+        name = request.tool_call["name"]
+        if is_mutating_tool(name):
+            with self._sync_mutation_lock:
+                return handler(request)
+
+        timeout = self._get_timeout(name)
+        self._sync_semaphore.acquire()
+        try:
+            future = self._executor.submit(handler, request)
+        except BaseException:
+            self._sync_semaphore.release()
+            raise
+        # the thread keeps running after a timeout, so the slot is released when the call finishes
+        future.add_done_callback(lambda _: self._sync_semaphore.release())
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            return self._timeout_message(request, timeout)
+
+    async def awrap_tool_call(self, request, handler):
+        name = request.tool_call["name"]
+        semaphore, mutation_lock = self._get_async_primitives()
+        if is_mutating_tool(name):
+            # asyncio.Lock is FIFO, so mutations keep the emitted order
+            async with mutation_lock:
+                return await handler(request)
+
+        timeout = self._get_timeout(name)
+        await semaphore.acquire()
+        release = self._release_once(semaphore, asyncio.get_running_loop())
+        futures = []
+        if self._runs_in_thread(request.tool):
+            request = replace(request, tool=request.tool.model_copy(update={"coroutine": self._threaded(request.tool.func, futures)}))
+        task = asyncio.ensure_future(handler(request))
+
+        def on_done(_):
+            # a cancelled task may leave its thread running: the slot is released when the thread ends
+            if futures:
+                futures[0].add_done_callback(release)
+            else:
+                release()
+        task.add_done_callback(on_done)
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout=timeout)
+        except asyncio.TimeoutError:
+            task.cancel()
+            return self._timeout_message(request, timeout)
@@ -1,12 +1,14 @@
+import os
 from langchain.tools import tool
+from pydantic import BaseModel, Field
 from typing import List, Optional
+from tools.utils import compact_list
 
 
-@tool
-def list_all_cloud_resources(providers: Optional[List[str]]) -> dict:
+def get_all_cloud_resources(providers: Optional[List[str]]) -> dict:
     """
-    Return a summary json object of all cloud resources (VMs and buckets) across all providers.
-    全クラウドのVMとバケットのサマリを返す
+    Return all cloud resources (VMs and buckets) across all providers.
+    全クラウドのVMとバケットを全件返す
 
     Args:
         providers: List of cloud providers("aws", "azure", "gcp", "ibmcloud").
@@ -22,43 +24,79 @@ def list_all_cloud_resources(providers: Optional[List[str]]) -> dict:
 
     summary = {}
     if "aws" in providers:
-        from tools.aws_tools import list_vms as aws_list_vms, list_buckets as aws_list_buckets
+        from tools.aws_tools import get_vm_names as aws_list_vms, get_bucket_names as aws_list_buckets
         try:
             summary["AWS"] = {
-                "vms": aws_list_vms(""),
-                "buckets": aws_list_buckets(""),
+                "vms": aws_list_vms(),
+                "buckets": aws_list_buckets(),
             }
         except Exception as e:
             summary["AWS"] = {"error": str(e)}
 
     if "azure" in providers:
-        from tools.azure_tools import list_vms as azure_list_vms, list_buckets as azure_list_buckets
+        from tools.azure_tools import get_vm_names as azure_list_vms, get_bucket_names as azure_list_buckets
         try:
             summary["Azure"] = {
-                "vms": azure_list_vms(""),
+                "vms": azure_list_vms(),
                 "buckets": azure_list_buckets(""),
             }
         except Exception as e:
             summary["Azure"] = {"error": str(e)}
 
     if "gcp" in providers:
-        from tools.gcp_tools import list_vms as gcp_list_vms, list_buckets as gcp_list_buckets
+        from tools.gcp_tools import get_vm_names as gcp_list_vms, get_bucket_names as gcp_list_buckets
         try:
             summary["GCP"] = {
-                "vms": gcp_list_vms(""),
-                "buckets": gcp_list_buckets(""),
+                "vms": gcp_list_vms(),
+                "buckets": gcp_list_buckets(),
             }
         except Exception as e:
             summary["GCP"] = {"error": str(e)}
 
     if "ibmcloud" in providers:
-        from tools.ibmcloud_tools import list_vms as ibm_list_vms, list_buckets as ibm_list_buckets
+        from tools.ibmcloud_tools import get_vm_names as ibm_list_vms, get_bucket_names as ibm_list_buckets
         try:
             summary["IBMCloud"] = {
-                "vms": ibm_list_vms(""),
-                "buckets": ibm_list_buckets(""),
+                "vms": ibm_list_vms(),
+                "buckets": ibm_list_buckets(),
             }
         except Exception as e:
             summary["IBMCloud"] = {"error": str(e)}
 
     return summary
+
+
+class ListAllCloudResourcesInput(BaseModel):
+    providers: Optional[List[str]] = Field(None, description="List of cloud providers('aws', 'azure', 'gcp', 'ibmcloud')")
+    name_filter: Optional[str] = Field(None, description="Substring or glob pattern (e.g. 'web-*') to filter names")
+    sort: Optional[str] = Field(None, description="'asc' or 'desc' to sort by name")
+    limit: Optional[int] = Field(None, description="Max number of names to return per list")
+    summarize: bool = Field(True, description="Return only counts without names (set False to get names)")
+
+
+@tool(args_schema=ListAllCloudResourcesInput)
+def list_all_cloud_resources(providers: Optional[List[str]] = None, name_filter: Optional[str] = None, sort: Optional[str] = None,
+                             limit: Optional[int] = None, summarize: bool = True) -> dict:
+    """
+    Return a compact summary of all cloud resources (VMs and buckets) across all providers.
+    Use list_vms / list_buckets with a cursor to page through a provider's resources.
+    全クラウドのVMとバケットのサマリを返す。詳細は各プロバイダのlist_vms / list_bucketsで取得する
+
+    Returns:
+        Result of cloud resources, structured JSON:
+            {
+                "AWS": {"vms": {"total": ..., "matched": ...}, "buckets": {...}},
+                "Azure": {"vms": {...}, "buckets": {...}},
+                ...
+            }
+    """
+    providers = providers or [p.strip() for p in os.getenv("CLOUD_PROVIDERS", "gcp").lower().split(",")]
+    summary = get_all_cloud_resources(providers)
+    for provider, info in summary.items():
+        if "error" in info:
+            continue
+        summary[provider] = {
+            kind: compact_list(names, name_filter=name_filter, sort=sort, limit=limit, summarize=summarize)
+            for kind, names in info.items()
+        }
+    return summary
@@ -0,0 +1,348 @@
+import asyncio
+import json
+import re
+import time
+from typing import Any, Dict, List, Optional
+from langchain.tools import ToolRuntime
+from pydantic import BaseModel, Field
+from tools.utils import get_cloud_tools_by_provider, is_mutating_tool
+from tools.cache import tool_cache, TOOL_CACHE_ENABLED
+
+
+PLAN_PROMPT = """You are a cloud operation planner.
+Break the user's request into tool invocations and return them as a dependency graph.
+- "tool" must be one of the tools below.
+- "depends_on" lists the ids of steps which must finish before the step starts. Leave it empty for independent steps so that they run in parallel.
+- To use the output of a previous step as an argument, set the argument value to "$<step id>", or to a path into it
+  such as "$s1.items[0]" or "$s1.matched".
+- To run a step once per item of a previous output, use "[*]" in the path, e.g. {{"instance_id": "$s1.items[*]"}}
+  runs the tool for every name listed by step s1 (at most one "[*]" argument per step). List tools return one page of
+  names, so narrow them with "name_filter" (e.g. "test") rather than relying on further pages.
+- Return an empty list of steps when no tool is needed.
+
+Tools:
+{catalog}
+
+Request:
+{query}
+"""
+
+SUMMARY_PROMPT = """You executed a plan of cloud operations for the user's request.
+Answer the request from the results below. If some steps failed or were skipped, explain it and suggest what to do next.
+Steps with status "unknown" timed out while changing resources: they may still be running, so tell the user to check them.
+
+Request:
+{query}
+
+Results:
+{results}
+"""
+
+
+class PlanStep(BaseModel):
+    id: str = Field(..., description="Unique step id, e.g. 's1'")
+    tool: str = Field(..., description="Tool name, e.g. 'aws.stop_vm'")
+    args: Dict[str, Any] = Field(default_factory=dict, description="Arguments of the tool")
+    depends_on: List[str] = Field(default_factory=list, description="Ids of steps which must finish first")
+
+
+class Plan(BaseModel):
+    steps: List[PlanStep] = Field(default_factory=list)
+
+
+class PlanError(ValueError):
+    pass
+
+
+# "$<step id>" followed by keys, indexes or "[*]" (one call per item), e.g. "$s1.items[*]"
+REFERENCE_PATTERN = re.compile(r"^\$([A-Za-z0-9_\-]+)((?:\.[A-Za-z0-9_\-]+|\[(?:\d+|\*)\])*)$")
+PATH_TOKEN_PATTERN = re.compile(r"\.([A-Za-z0-9_\-]+)|\[(\d+|\*)\]")
+
+
+def _parse_reference(value: str):
+    # (step id, [key, index or "*"]) of a reference
+    m = REFERENCE_PATTERN.match(value)
+    if m is None:
+        raise PlanError(f"Invalid reference '{value}': use \"$<step id>\" optionally followed by .key, [index] or [*].")
+    path = [key if key else (index if index == "*" else int(index)) for key, index in PATH_TOKEN_PATTERN.findall(m.group(2))]
+    return m.group(1), path
+
+
+def _project(value, path: list, reference: str):
+    # follow the path into a step output; "[*]" returns a list with the rest of the path applied to each item
+    container = None
+    for i, token in enumerate(path):
+        if isinstance(value, str) and value[:1] in "[{":
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        try:
+            if token == "*":
+                if not isinstance(value, list):
+                    raise PlanError(f"'{reference}': [*] applies to a list, got {type(value).__name__}.")
+                if isinstance(container, dict) and container.get("next_cursor"):
+                    # a fan-out over one page would silently miss the rest
+                    raise PlanError(f"'{reference}' covers only the first page of {container.get('matched')} items; narrow the list with name_filter.")
+                return [_project(item, path[i + 1:], reference) for item in value]
+            container = value
+            value = value[token]
+        except (KeyError, IndexError, TypeError):
+            raise PlanError(f"'{reference}' is not found in the output of the step.")
+    return value
+
+
+# ----------------------------
+# Plan Executor
+# ----------------------------
+class PlanExecutor:
+    """
+    Plan-and-execute mode: the LLM emits a DAG of tool invocations once, then independent branches run concurrently.
+    計画実行モード: LLMが一度だけツール呼び出しの依存グラフを作成し、独立したステップを並列に実行する
+
+    The LLM is called twice per request (plan and final summary) instead of once per tool call.
+    LLMの呼び出しはツール呼び出し毎ではなく、計画と最終要約の2回のみ
+    """
+
+    def __init__(self, llm, providers: List[str], extra_tools: Optional[List] = None, max_concurrency: int = 8,
+                 max_retries: int = 2, retry_backoff: float = 1.0, default_timeout: float = 30.0,
+                 timeouts: Optional[Dict[str, float]] = None):
+        # get_llm returns a wrapper holding the chat model in .llm
+        self.llm = getattr(llm, "llm", llm)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.default_timeout = default_timeout
+        self.timeouts = timeouts or {}
+        self.tools = self._build_catalog(providers, extra_tools or [])
+
+    def _build_catalog(self, providers: List[str], extra_tools: List) -> Dict[str, Any]:
+        # the same tool names exist on every provider, so cloud tools are qualified as "<provider>.<tool>"
+        catalog = {}
+        for provider, provider_tools in get_cloud_tools_by_provider(providers).items():
+            for name, t in provider_tools.items():
+                catalog[f"{provider}.{name}"] = t
+        for t in extra_tools:
+            catalog[t.name] = t
+        if TOOL_CACHE_ENABLED:
+            catalog = {name: tool_cache.wrap_tool(t) for name, t in catalog.items()}
+        return catalog
+
+    def _describe_tools(self) -> str:
+        lines = []
+        for name, t in self.tools.items():
+            args = json.dumps(t.args, ensure_ascii=False)
+            description = " ".join((t.description or "").split())
+            lines.append(f"- {name}: {description} args={args}")
+        return "\n".join(lines)
+
+    # ----------------------------
+    # Planning
+    # ----------------------------
+    async def plan(self, query: str) -> Plan:
+        """
+        Ask the LLM for a dependency graph of tool invocations.
+        LLMにツール呼び出しの依存グラフを作成させる
+        """
+        planner = self.llm.with_structured_output(Plan)
+        plan = await planner.ainvoke(PLAN_PROMPT.format(catalog=self._describe_tools(), query=query))
+        self.validate(plan)
+        return plan
+
+    @staticmethod
+    def _references(args: Dict[str, Any]) -> List[str]:
+        # ids of the steps whose output is used as an argument ("$<step id>...")
+        return [_parse_reference(value)[0] for value in args.values() if isinstance(value, str) and value.startswith("$")]
+
+    def validate(self, plan: Plan):
+        """
+        Check tool names, dependencies and cycles of the plan.
+        Steps referenced by "$<step id>" arguments are added to depends_on, so they finish first.
+        計画のツール名・依存関係・循環を検証する。"$<step id>"で参照するステップはdepends_onに追加する
+        """
+        ids = [step.id for step in plan.steps]
+        if len(ids) != len(set(ids)):
+            raise PlanError("Duplicated step ids in the plan.")
+        for step in plan.steps:
+            if step.tool not in self.tools:
+                raise PlanError(f"Unknown tool '{step.tool}' in step '{step.id}'.")
+            missing = [d for d in step.depends_on if d not in ids]
+            if missing:
+                raise PlanError(f"Step '{step.id}' depends on unknown steps: {missing}")
+            references = self._references(step.args)
+            if sum("*" in _parse_reference(value)[1] for value in step.args.values() if isinstance(value, str) and value.startswith("$")) > 1:
+                raise PlanError(f"Step '{step.id}' fans out over more than one argument.")
+            unknown = [r for r in references if r not in ids]
+            if unknown:
+                raise PlanError(f"Step '{step.id}' uses the output of unknown steps: {unknown}")
+            step.depends_on.extend(r for r in dict.fromkeys(references) if r not in step.depends_on)
+
+        # Kahn's algorithm
+        remaining = {step.id: set(step.depends_on) for step in plan.steps}
+        while remaining:
+            ready = [sid for sid, deps in remaining.items() if not deps]
+            if not ready:
+                raise PlanError(f"Cycle in the plan: {sorted(remaining)}")
+            for sid in ready:
+                del remaining[sid]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+    # ----------------------------
+    # Execution
+    # ----------------------------
+    def _resolve_args(self, args: Dict[str, Any], outputs: Dict[str, Any]):
+        """
+        Substitute references. Returns (args, fan_out): fan_out is (argument, values) for a "[*]" reference, else None.
+        参照を出力で置き換える。"[*]"の参照がある場合、fan_outは(引数名, 値のリスト)
+        """
+        resolved, fan_out = {}, None
+        for key, value in args.items():
+            if isinstance(value, str) and value.startswith("$"):
+                step_id, path = _parse_reference(value)
+                if step_id not in outputs:
+                    # never pass the placeholder itself to a tool
+                    raise PlanError(f"Output of step '{step_id}' used by argument '{key}' is not available.")
+                resolved[key] = _project(outputs[step_id], path, value)
+                if "*" in path:
+                    fan_out = (key, resolved[key])
+            else:
+                resolved[key] = value
+        return resolved, fan_out
+
+    @staticmethod
+    def _takes_runtime(tool) -> bool:
+        # tools reading the user context (e.g. rag_tool searching the user's tenant store)
+        return "runtime" in getattr(tool.args_schema, "model_fields", {})
+
+    async def _invoke(self, tool, args: Dict[str, Any], retries: int, timeout: float, mutating: bool, semaphore: asyncio.Semaphore) -> dict:
+        # one tool call with retries: {"status", "attempts", "output" or "error"}
+        call = {"attempts": 0}
+        async with semaphore:
+            for attempt in range(retries + 1):
+                call["attempts"] = attempt + 1
+                try:
+                    call["output"] = await asyncio.wait_for(tool.ainvoke(dict(args)), timeout=timeout)
+                    call["status"] = "succeeded"
+                    call.pop("error", None)
+                    return call
+                except asyncio.TimeoutError:
+                    if mutating:
+                        # the cloud call is not cancelled by the timeout, so its outcome is unknown
+                        call["status"] = "unknown"
+                        call["error"] = f"No result after {timeout:g} seconds, the operation may still be running."
+                        return call
+                    call["error"] = f"TimeoutError: no result after {timeout:g} seconds"
+                except Exception as e:
+                    call["error"] = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+                if attempt < retries:
+                    await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+        call["status"] = "failed"
+        return call
+
+    async def _run_step(self, step: PlanStep, outputs: Dict[str, Any], status: Dict[str, dict], semaphore: asyncio.Semaphore,
+                        runtime: Optional[ToolRuntime] = None):
+        tool = self.tools[step.tool]
+        name = step.tool.rsplit(".", 1)[-1]
+        mutating = is_mutating_tool(name)
+        # mutations are not idempotent, so they are never retried
+        retries = 0 if mutating else self.max_retries
+        timeout = self.timeouts.get(name, self.default_timeout)
+        state = status[step.id]
+
+        try:
+            args, fan_out = self._resolve_args(step.args, outputs)
+        except PlanError as e:
+            state["status"] = "failed"
+            state["error"] = str(e)
+            return
+        if self._takes_runtime(tool):
+            args["runtime"] = runtime
+
+        state["status"] = "running"
+        start = time.perf_counter()
+        if fan_out is None:
+            call = await self._invoke(tool, args, retries, timeout, mutating, semaphore)
+            state.update(call)
+        else:
+            key, values = fan_out
+            calls_args = [{**args, key: value} for value in values]
+            if mutating:
+                # one by one in the listed order, like the mutations of the agent
+                calls = [await self._invoke(tool, a, retries, timeout, mutating, semaphore) for a in calls_args]
+            else:
+                calls = await asyncio.gather(*(self._invoke(tool, a, retries, timeout, mutating, semaphore) for a in calls_args))
+            state["calls"] = [{"args": {key: value}, **call} for value, call in zip(values, calls)]
+            state["attempts"] = sum(call["attempts"] for call in calls)
+            statuses = {call["status"] for call in calls}
+            state["status"] = "failed" if "failed" in statuses else "unknown" if "unknown" in statuses else "succeeded"
+            if state["status"] == "succeeded":
+                state["output"] = [call["output"] for call in calls]
+            else:
+                state["error"] = f"{sum(call['status'] != 'succeeded' for call in calls)} of {len(calls)} calls did not succeed."
+        if state["status"] == "succeeded":
+            outputs[step.id] = state["output"]
+        state["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+    async def execute(self, plan: Plan, context=None) -> Dict[str, dict]:
+        """
+        Run the plan. Independent branches run concurrently; steps depending on a failed step are skipped.
+        A mutating step timing out is reported as "unknown" (it may still be running), not as failed.
+        計画を実行する。独立したステップは並列に実行し、失敗したステップに依存するステップはスキップする。
+        変更系のステップがタイムアウトした場合は、実行中の可能性があるため失敗ではなく"unknown"とする
+
+        Args:
+            plan: validated plan
+            context: user context (tools.memory_tools.Context) bound into the tools taking a runtime
+
+        Returns:
+            {step_id: {"tool", "args", "depends_on", "status", "attempts", "output", "error", "elapsed_ms"}},
+            fan-out steps also have "calls": [{"args", "status", "attempts", "output" or "error"}]
+        """
+        status = {
+            step.id: {"tool": step.tool, "args": step.args, "depends_on": step.depends_on, "status": "pending", "attempts": 0}
+            for step in plan.steps
+        }
+        outputs = {}
+        runtime = ToolRuntime(state=None, context=context, config={}, stream_writer=None, tool_call_id=None, store=None)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        tasks = {}
+
+        async def run(step: PlanStep):
+            if step.depends_on:
+                await asyncio.gather(*(tasks[d] for d in step.depends_on))
+            if any(status[d]["status"] != "succeeded" for d in step.depends_on):
+                status[step.id]["status"] = "skipped"
+                return
+            await self._run_step(step, outputs, status, semaphore, runtime)
+
+        # tasks start after this loop finishes, so every dependency task exists when awaited
+        for step in plan.steps:
+            tasks[step.id] = asyncio.ensure_future(run(step))
+        await asyncio.gather(*tasks.values())
+        return status
+
+    async def summarize(self, query: str, status: Dict[str, dict]) -> str:
+        results = json.dumps(status, ensure_ascii=False, default=str, indent=1)
+        response = await self.llm.ainvoke(SUMMARY_PROMPT.format(query=query, results=results))
+        return getattr(response, "content", str(response))
+
+    async def run(self, query: str, context=None) -> dict:
+        """
+        Plan, execute and summarize the request.
+        リクエストを計画・実行・要約する
+
+        Args:
+            query: user's request
+            context: user context (tools.memory_tools.Context), e.g. the tenant searched by rag_tool
+
+        Returns:
+            {"reply": str, "plan": {step_id: status}}
+        """
+        try:
+            plan = await self.plan(query)
+        except PlanError as e:
+            return {"reply": f"Failed to make a plan: {e}", "plan": {}}
+        status = await self.execute(plan, context)
+        reply = await self.summarize(query, status)
+        return {"reply": reply, "plan": status}
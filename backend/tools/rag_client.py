@@ -0,0 +1,113 @@
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+import httpx
+from langchain.tools import tool
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from tools.cache import tool_cache
+from tools.rag_tools import RAGToolClass, _serialize
+
+# ingestion of large files may take minutes
+RAG_SERVER_TIMEOUT_SECONDS = float(os.getenv("RAG_SERVER_TIMEOUT_SECONDS", "600"))
+
+
+def _create_client(url: str) -> httpx.Client:
+    parsed = urlparse(url)
+    if parsed.scheme == "unix":
+        return httpx.Client(transport=httpx.HTTPTransport(uds=parsed.path), base_url="http://rag-server", timeout=RAG_SERVER_TIMEOUT_SECONDS)
+    return httpx.Client(base_url=url, timeout=RAG_SERVER_TIMEOUT_SECONDS)
+
+
+class RemoteEmbeddings(Embeddings):
+    """
+    Embeddings computed by the shared RAG server.
+    共有RAGサーバーで計算するEmbeddings
+    """
+
+    def __init__(self, client: "RemoteRAGTool"):
+        self.client = client
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.client.post("/embed", {"texts": texts, "kind": "document"})["vectors"]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.client.post("/embed", {"texts": [text], "kind": "query"})["vectors"][0]
+
+
+class RemoteRAGTool:
+    """
+    RAGToolClass backed by the shared RAG server (tools/rag_server.py), so API workers hold no model or vectorstore.
+    共有RAGサーバーを利用するRAGToolClass（APIワーカーはモデルやベクターストアを保持しない）
+
+    Args:
+        url: unix:///path/to.sock or http://host:port
+    """
+
+    namespace_for = staticmethod(RAGToolClass.namespace_for)
+    # resolves the tenant from the runtime context and calls self.search
+    retrieve = RAGToolClass.retrieve
+
+    def __init__(self, url: str):
+        self.url = url
+        # connections are opened on first use, so workers start without the server
+        self._client = _create_client(url)
+        self.embeddings = RemoteEmbeddings(self)
+        self.rag_tool = tool("rag_tool", response_format="content_and_artifact")(self.retrieve)
+
+    def get(self, path: str, **params) -> dict:
+        response = self._client.get(path, params={key: value for key, value in params.items() if value is not None})
+        response.raise_for_status()
+        return response.json()
+
+    def post(self, path: str, payload: dict) -> dict:
+        response = self._client.post(path, json=payload)
+        response.raise_for_status()
+        return response.json()
+
+    def add_files(self, file_paths: List[str], page_split: bool = False, on_file_done: Optional[Callable[[str, bool], None]] = None,
+                  sources: Optional[Dict[str, str]] = None, hashes: Optional[Dict[str, str]] = None, namespace: Optional[str] = None) -> dict:
+        """
+        Add files to the vectorstore of the server (see RAGToolClass.add_files).
+        サーバーのベクターストアにファイルを追加します。
+        """
+        res = self.post("/add_files", {
+            "file_paths": file_paths, "page_split": page_split, "sources": sources, "hashes": hashes, "namespace": namespace
+        })
+        # files are reported once the request returns
+        if on_file_done:
+            for file_path, ok in res["done"]:
+                on_file_done(file_path, ok)
+        result = res["result"]
+        if result["added"] or result["replaced"]:
+            tool_cache.invalidate_provider("rag")
+        return result
+
+    def gc(self, include_unmanaged: bool = False, namespace: Optional[str] = None) -> int:
+        deleted = self.post("/gc", {"include_unmanaged": include_unmanaged, "namespace": namespace})["deleted"]
+        if deleted:
+            tool_cache.invalidate_provider("rag")
+        return deleted
+
+    def search(self, query: str, k: Optional[int] = None, namespace: Optional[str] = None) -> List[Document]:
+        return _to_documents(self.post("/search", {"query": query, "k": k, "namespace": namespace})["documents"])
+
+    def retrieve_many(self, queries: List[str], k: Optional[int] = None, namespace: Optional[str] = None) -> List[Tuple[str, list]]:
+        results = self.post("/search_many", {"queries": queries, "k": k, "namespace": namespace})["results"]
+        return [(_serialize(docs), docs) for docs in map(_to_documents, results)]
+
+    def documents_page(self, cursor: int = 0, limit: int = 100, include_content: bool = False, namespace: Optional[str] = None) -> dict:
+        return self.get("/documents", cursor=cursor, limit=limit, include_content=include_content, namespace=namespace)
+
+    def storage_stats(self, sample: int = 5000, k: int = 10, namespace: Optional[str] = None) -> dict:
+        return self.get("/documents/storage", sample=sample, k=k, namespace=namespace)
+
+    def stats(self) -> dict:
+        return {**self.get("/stats"), "rag_server": self.url}
+
+    def warmup(self) -> Optional[float]:
+        return self.post("/warmup", {})["seconds"]
+
+
+def _to_documents(items: List[dict]) -> List[Document]:
+    return [Document(page_content=item["page_content"], metadata=item["metadata"], id=item["id"]) for item in items]
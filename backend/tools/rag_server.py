@@ -0,0 +1,172 @@
+"""
+Shared RAG server: one process holding the embedding model and the vectorstores for all API workers.
+全APIワーカーで共有するRAGサーバー（埋め込みモデルとベクターストアを1プロセスで保持する）
+
+Run it next to `uvicorn main:app --workers N` with the same RAG_SERVER_URL in .env:
+    python -m tools.rag_server    # listens on RAG_SERVER_URL (unix:///path/to.sock or http://host:port)
+
+Concurrent embedding calls of all workers (searches, ingestion, fast path) are micro-batched
+into shared forward passes, queries and documents separately.
+
+The server has no authentication and /add_files reads any path on the server host, so it must only be
+reachable by the API workers: use a unix socket, or bind HTTP to localhost (127.0.0.1 / ::1), never to a public address.
+認証はなく、/add_filesはサーバーのホスト上の任意のパスを読み込むため、APIワーカーからのみ接続できるようにすること
+（unixソケットを使うか、HTTPはlocalhostにのみバインドし、公開アドレスにはバインドしない）
+"""
+import os
+import argparse
+import ipaddress
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+from fastapi import FastAPI
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+from tools.rag_tools import RAGToolClass
+from utils.lazy import Lazy
+from dotenv import load_dotenv
+load_dotenv()
+
+VECTORSTORE = os.getenv("VECTORSTORE_CLASS", "chroma").lower()
+MAX_BATCH = int(os.getenv("RAG_SERVER_MAX_BATCH", "64"))
+MAX_WAIT_SECONDS = float(os.getenv("RAG_SERVER_MAX_WAIT_MS", "5")) / 1000
+
+
+def _create_embeddings():
+    from utils.embedding_backends import create_embeddings
+    from utils.micro_batch import BatchedEmbeddings
+    return BatchedEmbeddings(create_embeddings(), max_batch=MAX_BATCH, max_wait=MAX_WAIT_SECONDS)
+
+
+embeddings = Lazy(_create_embeddings, name="embedding model")
+rag = RAGToolClass(vectorstore_class=VECTORSTORE, embeddings_factory=embeddings.get)
+app = FastAPI()
+
+
+class EmbedRequest(BaseModel):
+    texts: List[str]
+    kind: str = "document"
+
+
+class SearchRequest(BaseModel):
+    query: str
+    k: Optional[int] = None
+    namespace: Optional[str] = None
+
+
+class SearchManyRequest(BaseModel):
+    queries: List[str]
+    k: Optional[int] = None
+    namespace: Optional[str] = None
+
+
+class AddFilesRequest(BaseModel):
+    file_paths: List[str]
+    page_split: bool = False
+    sources: Optional[Dict[str, str]] = None
+    hashes: Optional[Dict[str, str]] = None
+    namespace: Optional[str] = None
+
+
+class GCRequest(BaseModel):
+    include_unmanaged: bool = False
+    namespace: Optional[str] = None
+
+
+def _documents(documents) -> list:
+    return [{"page_content": doc.page_content, "metadata": doc.metadata, "id": doc.id} for doc in documents]
+
+
+# endpoints are sync, so FastAPI runs them in its thread pool and concurrent calls meet in the micro-batcher
+@app.post("/embed")
+def embed(request: EmbedRequest):
+    emb = rag.emb
+    if request.kind == "query":
+        return {"vectors": emb.embed_queries(request.texts)}
+    return {"vectors": emb.engine.embed(request.texts)}
+
+
+@app.post("/search")
+def search(request: SearchRequest):
+    return jsonable_encoder({"documents": _documents(rag.search(request.query, k=request.k, namespace=request.namespace))})
+
+
+@app.post("/search_many")
+def search_many(request: SearchManyRequest):
+    results = rag.retrieve_many(request.queries, k=request.k, namespace=request.namespace)
+    return jsonable_encoder({"results": [_documents(documents) for _, documents in results]})
+
+
+@app.post("/add_files")
+def add_files(request: AddFilesRequest):
+    # workers run on the same host, so uploaded files are read from their paths (the reason the server stays local)
+    done = []
+    result = rag.add_files(
+        file_paths=request.file_paths,
+        page_split=request.page_split,
+        on_file_done=lambda file_path, ok: done.append([file_path, ok]),
+        sources=request.sources,
+        hashes=request.hashes,
+        namespace=request.namespace
+    )
+    return {"result": result, "done": done}
+
+
+@app.post("/gc")
+def gc(request: GCRequest):
+    return {"deleted": rag.gc(request.include_unmanaged, request.namespace)}
+
+
+@app.get("/documents")
+def documents(cursor: int = 0, limit: int = 100, include_content: bool = False, namespace: Optional[str] = None):
+    return jsonable_encoder(rag.documents_page(cursor, limit, include_content, namespace))
+
+
+@app.get("/documents/storage")
+def documents_storage(sample: int = 5000, k: int = 10, namespace: Optional[str] = None):
+    return jsonable_encoder(rag.storage_stats(sample, k, namespace))
+
+
+@app.get("/stats")
+def stats():
+    return jsonable_encoder({
+        **rag.stats(),
+        "micro_batch": embeddings.get().stats() if embeddings.loaded else None
+    })
+
+
+@app.post("/warmup")
+def warmup():
+    return {"seconds": rag.warmup()}
+
+
+def _is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared RAG server for the API workers.")
+    parser.add_argument("--url", default=os.getenv("RAG_SERVER_URL", "unix:///tmp/rag_server.sock"),
+                        help="unix:///path/to.sock or http://host:port")
+    parser.add_argument("--warmup", action="store_true", help="load the model and the store before accepting requests")
+    args = parser.parse_args()
+
+    import uvicorn
+    url = urlparse(args.url)
+    host = url.hostname or "127.0.0.1"
+    if url.scheme != "unix" and not _is_loopback(host):
+        raise SystemExit(f"RAG server must listen on localhost or a unix socket, not {host}: /add_files reads local files without authentication")
+    if args.warmup:
+        warmup()
+    if url.scheme == "unix":
+        uvicorn.run(app, uds=url.path)
+    else:
+        uvicorn.run(app, host=host, port=url.port or 8100)
+
+
+if __name__ == "__main__":
+    main()
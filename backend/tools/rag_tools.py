@@ -1,16 +1,112 @@
-from langchain.tools import tool
-from typing import List, Optional
-from utils.embedding import Embedding
+import os
+from contextlib import nullcontext
+from langchain.tools import tool, ToolRuntime
+from typing import Callable, Dict, List, Optional, Tuple
+from utils.embedding_registry import EmbeddingRegistry
+from utils.lazy import Lazy
+from tools.cache import tool_cache
+from tools.memory_tools import Context
+
+# every user (or tenant_id of the context) searches only its own documents
+TENANT_ISOLATION = os.getenv("RAG_TENANT_ISOLATION", "true").lower() == "true"
 
 
 class RAGToolClass:
-    def __init__(self, vectorstore_class="chroma"):
+    def __init__(self, vectorstore_class="chroma", embeddings_factory: Optional[Callable[[], object]] = None):
         """
         Initialize RAG tool with the specified vectorstore class.
         RAGツールを指定されたベクターストアで初期化します。
+
+        Args:
+            vectorstore_class: The vectorstore backend to use. / 使用するベクターストア
+            embeddings_factory: Creates the embedding model (default: EMBEDDING_BACKEND). / 埋め込みモデルを作成する関数
+        """
+        self.vectorstore_class = vectorstore_class
+        self.embeddings_factory = embeddings_factory
+        # the embedding model and the store are loaded on first use
+        self._emb = Lazy(self._load_store, name="vectorstore")
+        # tenant stores share the model and caches of the shared store
+        self.tenants = EmbeddingRegistry(
+            factory=self._load_tenant_store,
+            max_loaded=int(os.getenv("RAG_MAX_LOADED_TENANTS", "8")),
+            idle_seconds=float(os.getenv("RAG_TENANT_IDLE_SECONDS", "900"))
+        )
+        # a tool bound to this instance (@tool on the method would expose self as an argument)
+        self.rag_tool = tool("rag_tool", response_format="content_and_artifact")(self.retrieve)
+
+    def _load_store(self):
+        from utils.embedding import Embedding
+        embeddings = self.embeddings_factory() if self.embeddings_factory else None
+        emb = Embedding(embeddings=embeddings, vectorstore_class=self.vectorstore_class)
+        emb.load_store()
+        return emb
+
+    def _load_tenant_store(self, namespace: str):
+        from utils.embedding import Embedding
+        return Embedding(vectorstore_class=self.vectorstore_class, namespace=namespace, parent=self.emb)
+
+    @property
+    def emb(self):
+        """
+        Shared Embedding store (loaded on first access).
+        共有のEmbeddingストア（初回アクセス時に読み込みます）。
+        """
+        return self._emb.get()
+
+    @property
+    def embeddings(self):
+        return self.emb.embeddings
+
+    @property
+    def loaded(self) -> bool:
+        return self._emb.loaded
+
+    @property
+    def load_seconds(self) -> Optional[float]:
+        return self._emb.seconds
+
+    @staticmethod
+    def namespace_for(user_id: Optional[str], tenant_id: Optional[str] = None) -> Optional[str]:
+        """
+        Return the namespace of a user (None: the shared store).
+        ユーザーの名前空間を返します（None: 共有ストア）。
         """
-        self.emb = Embedding(vectorstore_class=vectorstore_class)
-        self.emb.load_store()
+        if not TENANT_ISOLATION:
+            return None
+        return tenant_id or user_id or None
+
+    def store(self, namespace: Optional[str] = None):
+        """
+        Context manager yielding the Embedding of the namespace (loaded on first use).
+        名前空間のEmbeddingを返すコンテキストマネージャ（初回利用時に読み込みます）。
+        """
+        if namespace is None:
+            return nullcontext(self.emb)
+        return self.tenants.use(namespace)
+
+    def add_files(self, file_paths: List[str], page_split: bool = False, on_file_done: Optional[Callable[[str, bool], None]] = None,
+                  sources: Optional[Dict[str, str]] = None, hashes: Optional[Dict[str, str]] = None, namespace: Optional[str] = None) -> dict:
+        """
+        Add files to the vectorstore incrementally. Unchanged files are skipped and changed files replace their old chunks.
+        ファイルを差分でベクターストアに追加します。変更のないファイルはスキップし、変更されたファイルは古いチャンクを置き換えます。
+
+        Args:
+            file_paths: List of file paths to add. / 追加するファイルパスのリスト
+            page_split: Whether to split pages when loading. / ページ分割するかどうか
+            on_file_done: Called with (file_path, ok) when each file finishes. / ファイル毎の完了時に呼ばれる関数
+            sources: Source name of each file path (defaults to the path). / ファイルパス毎のソース名
+            hashes: SHA-256 of each file path (computed when missing). / ファイルパス毎のSHA-256
+            namespace: Tenant store to add to (None: the shared store). / 追加先のテナント（None: 共有ストア）
+
+        Returns:
+            {"added": [...], "replaced": [...], "skipped": [...], "failed": [...]}
+        """
+        with self.store(namespace) as emb:
+            result = emb.upsert_files(file_paths=file_paths, page_split=page_split, sources=sources, hashes=hashes, on_file_done=on_file_done)
+        # cached search results are stale now
+        if result["added"] or result["replaced"]:
+            tool_cache.invalidate_provider("rag")
+        return result
 
     def add_document(self, file_paths: Optional[List[str]] = None, page_split: bool = False) -> str:
         """
@@ -25,14 +121,30 @@ class RAGToolClass:
             Status message indicating success or failure.
             成功または失敗のステータスメッセージ
         """
-        added = self.emb.add_documents(file_paths=file_paths, page_split=page_split)
-        if added:
-            return f"Files added successfully: {', '.join(file_paths)}"
-        else:
-            return "Failed to add files."
+        result = self.add_files(file_paths=file_paths, page_split=page_split)
+        if result["failed"]:
+            return f"Failed to add files: {', '.join(result['failed'])}"
+        return ", ".join(f"{key.capitalize()}: {', '.join(names)}" for key, names in result.items() if names) or "No files to add."
+
+    def gc(self, include_unmanaged: bool = False, namespace: Optional[str] = None) -> int:
+        """
+        Delete chunks not referenced by the manifest (e.g. left by interrupted re-ingestion).
+        管理情報から参照されていないチャンクを削除します。
+
+        Args:
+            include_unmanaged: Also delete chunks of sources never registered in the manifest. / 管理対象外のソースのチャンクも削除するかどうか
+            namespace: Tenant store (None: the shared store). / 対象のテナント（None: 共有ストア）
+
+        Returns:
+            Number of deleted chunks / 削除したチャンク数
+        """
+        with self.store(namespace) as emb:
+            orphans = emb.gc_orphans(include_unmanaged=include_unmanaged)
+        if orphans:
+            tool_cache.invalidate_provider("rag")
+        return len(orphans)
 
-    @tool(response_format="content_and_artifact")
-    def rag_tool(self, query: Optional[str] = None):
+    def retrieve(self, query: Optional[str] = None, k: Optional[int] = None, runtime: ToolRuntime[Context] = None):
         """
         Document retrieval tool.
         文書検索ツール
@@ -42,6 +154,7 @@ class RAGToolClass:
 
         Args:
             query: The search query string. / 検索するクエリ文字列
+            k: Number of chunks to retrieve (default: configured value). / 取得するチャンク数（省略時は設定値）
 
         Returns:
             Tuple of (serialized retrieved content, list of retrieved document objects)
@@ -50,24 +163,102 @@ class RAGToolClass:
         if not query:
             return "Please provide a query.", []
 
-        retrieved_docs = self.emb.vectorstore.similarity_search(query, k=3)
-        serialized = "\n\n".join(
-            (f"Source: {doc.metadata}\nContent: {doc.page_content}")
-            for doc in retrieved_docs
-        )
-        return serialized, retrieved_docs
+        context = getattr(runtime, "context", None)
+        namespace = self.namespace_for(getattr(context, "user_id", None), getattr(context, "tenant_id", None))
+        if TENANT_ISOLATION and namespace is None:
+            # never search the shared store (other tenants' older documents) in place of the user's
+            return "Cannot search documents: no user or tenant in the request context.", []
+        retrieved_docs = self.search(query, k=k, namespace=namespace)
+        return _serialize(retrieved_docs), retrieved_docs
+
+    def search(self, query: str, k: Optional[int] = None, namespace: Optional[str] = None) -> list:
+        """
+        Return the documents relevant to the query.
+        クエリに関連する文書を返します。
+        """
+        with self.store(namespace) as emb:
+            return emb.search(query, k=k)
+
+    def retrieve_many(self, queries: List[str], k: Optional[int] = None, namespace: Optional[str] = None) -> List[Tuple[str, list]]:
+        """
+        Retrieve documents for several queries at once (queries are embedded in one forward pass).
+        複数のクエリの文書をまとめて取得します（クエリは1回でまとめて埋め込みます）。
+
+        Args:
+            queries: Search query strings. / 検索するクエリ文字列のリスト
+            k: Number of chunks to retrieve per query. / クエリ毎に取得するチャンク数
+            namespace: Tenant store to search (None: the shared store). / 検索するテナント（None: 共有ストア）
+
+        Returns:
+            List of (serialized retrieved content, list of retrieved document objects) per query
+        """
+        with self.store(namespace) as emb:
+            results = emb.search_many(queries, k=k)
+        return [(_serialize(docs), docs) for docs in results]
+
+
+    def documents_page(self, cursor: int = 0, limit: int = 100, include_content: bool = False, namespace: Optional[str] = None) -> dict:
+        """
+        Return one page of the chunks in the vectorstore and the total number of chunks.
+        ベクターストアのチャンクの1ページ分と総数を返します。
+        """
+        with self.store(namespace) as emb:
+            return {"items": emb.get_documents_page(cursor, limit, include_content), "total": emb.count_documents()}
+
+    def storage_stats(self, sample: int = 5000, k: int = 10, namespace: Optional[str] = None) -> dict:
+        """
+        Return bytes per vector and recall@k of the vector storage.
+        ベクトル1件あたりのバイト数とrecall@kを返します。
+        """
+        with self.store(namespace) as emb:
+            return emb.storage_stats(sample=sample, k=k)
+
+    def stats(self) -> dict:
+        """
+        Return statistics of the embedding model and the shared store (the store is not loaded for it).
+        埋め込みモデルと共有ストアの統計を返します（統計のために読み込むことはしません）。
+        """
+        emb = self.emb if self.loaded else None
+        return {
+            "vectorstore_loaded": emb is not None,
+            "embedding": emb.engine.stats() if emb else None,
+            "embedding_cache": emb.embedding_cache.stats() if emb and emb.embedding_cache else None,
+            "faiss_index": emb.faiss_index.stats(emb.vectorstore.index) if emb and emb.faiss_index else None,
+            "retrieval_cache": emb.retrieval_cache.stats() if emb and emb.retrieval_cache else None,
+            "tenants": self.tenants.stats()
+        }
+
+    def warmup(self) -> Optional[float]:
+        """
+        Load the store and run the model once (kernel selection, ONNX session creation). Returns the load time in seconds.
+        ストアを読み込み、モデルを1回実行します。読み込み時間（秒）を返します。
+        """
+        self.emb.embed_queries(["warmup"])
+        return self.load_seconds
+
+
+def _serialize(documents) -> str:
+    return "\n\n".join(
+        (f"Source: {doc.metadata}\nContent: {doc.page_content}")
+        for doc in documents
+    )
 
 
-def create_rag_tool_instance(vectorstore_class="chroma") -> RAGToolClass:
+def create_rag_tool_instance(vectorstore_class="chroma"):
     """
-    Create an instance of RAGToolClass.
-    RAGToolClassのインスタンスを作成します。
+    Create an instance of RAGToolClass, or a client of the shared RAG server when RAG_SERVER_URL is set.
+    RAGToolClassのインスタンスを作成します（RAG_SERVER_URLが設定されている場合は共有RAGサーバーのクライアント）。
 
     Args:
         vectorstore_class: The vectorstore backend to use (default: "chroma").
         使用するベクターストアの種類（デフォルト: "chroma"）
 
     Returns:
-        RAGToolClass instance / RAGToolClassのインスタンス
+        RAGToolClass or RemoteRAGTool instance / RAGToolClassまたはRemoteRAGToolのインスタンス
     """
+    server_url = os.getenv("RAG_SERVER_URL")
+    if server_url:
+        # the model and the stores live in one server process shared by all workers
+        from tools.rag_client import RemoteRAGTool
+        return RemoteRAGTool(server_url)
     return RAGToolClass(vectorstore_class=vectorstore_class)
@@ -1,29 +1,130 @@
+import os
+from fnmatch import fnmatch
+from pydantic import BaseModel, Field
+from typing import Dict, List, Optional
+from dotenv import load_dotenv
+load_dotenv()
 
-from typing import List, Optional
+# max rows returned by list tools at once
+TOOL_OUTPUT_LIMIT = int(os.getenv("TOOL_OUTPUT_LIMIT", "50"))
 
 
-def get_cloud_tools(providers: Optional[List[str]]):
+# tools changing cloud resources or memory (never run concurrently, never cached)
+MUTATING_TOOL_NAMES = {
+    "start_vm",
+    "stop_vm",
+    "create_bucket",
+    "upload_file_to_bucket",
+    "save_user_info",
+}
+
+
+def is_mutating_tool(name: str) -> bool:
     """
-    Return tools of cloud operations.
-    クラウドサービスのツールを返す
+    Return whether the tool changes cloud resources or memory.
+    ツールがリソースやメモリを変更するかどうかを返す
+    """
+    return name in MUTATING_TOOL_NAMES
+
+
+def get_cloud_tools_by_provider(providers: Optional[List[str]]) -> Dict[str, Dict[str, object]]:
+    """
+    Return tools of cloud operations grouped by provider and tool name.
+    クラウドサービスのツールをプロバイダ・ツール名ごとに返す
 
     Args:
         providers: List of cloud providers("aws", "azure", "gcp", "ibmcloud").
 
     Returns:
-        tools: LangChain tools of cloud operations
+        tools: {"aws": {"list_vms": tool, ...}, "gcp": {...}, ...}
     """
-    tools = []
+    tools = {}
     if "gcp" in providers:
         from tools.gcp_tools import gcp_tools
-        tools.extend(gcp_tools)
+        tools["gcp"] = {t.name: t for t in gcp_tools}
     if "aws" in providers:
         from tools.aws_tools import aws_tools
-        tools.extend(aws_tools)
+        tools["aws"] = {t.name: t for t in aws_tools}
     if "azure" in providers:
         from tools.azure_tools import azure_tools
-        tools.extend(azure_tools)
+        tools["azure"] = {t.name: t for t in azure_tools}
     if "ibmcloud" in providers:
         from tools.ibmcloud_tools import ibmcloud_tools
-        tools.extend(ibmcloud_tools)
+        tools["ibmcloud"] = {t.name: t for t in ibmcloud_tools}
+    return tools
+
+
+def get_cloud_tools(providers: Optional[List[str]]):
+    """
+    Return tools of cloud operations.
+    クラウドサービスのツールを返す
+
+    Args:
+        providers: List of cloud providers("aws", "azure", "gcp", "ibmcloud").
+
+    Returns:
+        tools: LangChain tools of cloud operations
+    """
+    tools = []
+    for provider_tools in get_cloud_tools_by_provider(providers).values():
+        tools.extend(provider_tools.values())
     return tools
+
+
+# ----------------------------
+# Compact list outputs
+# ----------------------------
+class ListInput(BaseModel):
+    name_filter: Optional[str] = Field(None, description="Substring or glob pattern (e.g. 'web-*') to filter names")
+    sort: Optional[str] = Field(None, description="'asc' or 'desc' to sort by name")
+    limit: Optional[int] = Field(None, description=f"Max number of names to return (default {TOOL_OUTPUT_LIMIT})")
+    cursor: Optional[str] = Field(None, description="'next_cursor' of the previous result to get the next page")
+    summarize: bool = Field(False, description="Return only counts without names")
+
+
+def compact_list(items: List[str], name_filter: Optional[str] = None, sort: Optional[str] = None,
+                 limit: Optional[int] = None, cursor: Optional[str] = None, summarize: bool = False) -> dict:
+    """
+    Filter, sort and page a list of names so that only a compact result reaches the LLM.
+    名前のリストをフィルタ・ソート・ページングしてコンパクトな結果を返す
+
+    Args:
+        items: all names
+        name_filter: substring or glob pattern
+        sort: "asc" or "desc"
+        limit: page size
+        cursor: offset of the page (returned as next_cursor)
+        summarize: when True, return only counts
+
+    Returns:
+        {"total": int, "matched": int, "count": int, "items": [...], "next_cursor": str or None}
+    """
+    items = list(items or [])
+    total = len(items)
+    if name_filter:
+        pattern = name_filter.lower()
+        if any(c in pattern for c in "*?["):
+            items = [i for i in items if fnmatch(str(i).lower(), pattern)]
+        else:
+            items = [i for i in items if pattern in str(i).lower()]
+    if sort in ("asc", "desc"):
+        items.sort(key=lambda i: str(i).lower(), reverse=(sort == "desc"))
+
+    matched = len(items)
+    if summarize:
+        return {"total": total, "matched": matched}
+
+    try:
+        offset = max(int(cursor), 0) if cursor else 0
+    except ValueError:
+        offset = 0
+    limit = limit if limit and limit > 0 else TOOL_OUTPUT_LIMIT
+    page = items[offset:offset + limit]
+    next_offset = offset + len(page)
+    return {
+        "total": total,
+        "matched": matched,
+        "count": len(page),
+        "items": page,
+        "next_cursor": str(next_offset) if next_offset < matched else None,
+    }
@@ -0,0 +1,421 @@
+import os
+import time
+import logging
+import posixpath
+import zipfile
+from html.parser import HTMLParser
+from xml.etree import ElementTree
+from dataclasses import dataclass
+from functools import lru_cache
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional
+from langchain_core.documents import Document
+from langchain_core.document_loaders import BaseLoader
+from langchain_community.document_loaders import PyPDFLoader
+# from langchain_community.document_loaders import UnstructuredHTMLLoader
+# from langchain_community.document_loaders import BSHTMLLoader
+# from langchain_community.document_loaders import UnstructuredWordDocumentLoader
+from langchain_community.document_loaders import Docx2txtLoader
+from langchain_community.document_loaders import UnstructuredPowerPointLoader
+from langchain_community.document_loaders import UnstructuredExcelLoader
+# from langchain_text_splitter import HTMLHeaderTextSplitter
+# from langchain_text_splitter import CharacterTextSplitter
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+logger = logging.getLogger(__name__)
+
+# supported file extension
+supported_file_types = ['.pdf', '.html', '.doc', '.docx', '.ppt', '.pptx', '.xls', '.xlsx', '.txt']
+# max characters of a document handed to the splitter
+max_document_chars = 64 * 1024
+# formats without a streaming loader are parsed whole in memory, files larger than in_memory_max_bytes are rejected
+in_memory_file_types = {'.doc', '.ppt', '.xls'}
+in_memory_max_bytes = int(float(os.getenv('EMBEDDING_IN_MEMORY_MAX_MB', '50')) * 1024 * 1024)
+
+# OOXML namespaces
+_W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_A = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+_P = '{http://schemas.openxmlformats.org/presentationml/2006/main}'
+_R = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_PACKAGE_RELS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+
+@dataclass(frozen=True)
+class ChunkSettings:
+    """
+    Chunk size in tokens of the embedding model (picklable, passed to parser processes).
+    埋め込みモデルのトークン数で表したチャンクサイズ（パーサーのプロセスに渡す）
+    """
+    tokenizer_name: Optional[str] = None
+    chunk_tokens: int = 256
+    chunk_overlap: int = 32
+
+
+class TextStreamLoader(BaseLoader):
+    """
+    Stream a text file as documents of about block_chars characters.
+    テキストファイルを一定の文字数ごとのドキュメントとして逐次読み込む
+    """
+
+    def __init__(self, file_path: str, block_chars: int = max_document_chars, encoding: str = 'utf-8'):
+        self.file_path = file_path
+        self.block_chars = block_chars
+        self.encoding = encoding
+
+    def lazy_load(self) -> Iterator[Document]:
+        lines, size = [], 0
+        with open(self.file_path, 'r', encoding=self.encoding, errors='replace') as f:
+            for line in f:
+                lines.append(line)
+                size += len(line)
+                if size >= self.block_chars:
+                    yield Document(page_content=''.join(lines), metadata={'source': self.file_path})
+                    lines, size = [], 0
+        if lines:
+            yield Document(page_content=''.join(lines), metadata={'source': self.file_path})
+
+
+class XlsxRowLoader(BaseLoader):
+    """
+    Stream rows of .xlsx sheets in openpyxl read-only mode, rows_per_document rows per document.
+    .xlsxのシートの行をopenpyxlの読み取り専用モードで逐次読み込む
+    """
+
+    def __init__(self, file_path: str, rows_per_document: int = 50):
+        self.file_path = file_path
+        self.rows_per_document = rows_per_document
+
+    def _document(self, rows: List[str], sheet_number: int, sheet_name: str) -> Document:
+        return Document(
+            page_content='\n'.join(rows),
+            metadata={'source': self.file_path, 'page_number': sheet_number, 'page_name': sheet_name}
+        )
+
+    def lazy_load(self) -> Iterator[Document]:
+        from openpyxl import load_workbook
+        workbook = load_workbook(self.file_path, read_only=True, data_only=True)
+        try:
+            for sheet_number, sheet in enumerate(workbook.worksheets, start=1):
+                rows = []
+                for row in sheet.iter_rows(values_only=True):
+                    values = [str(value) for value in row if value is not None]
+                    if values:
+                        rows.append('\t'.join(values))
+                    if len(rows) >= self.rows_per_document:
+                        yield self._document(rows, sheet_number, sheet.title)
+                        rows = []
+                if rows:
+                    yield self._document(rows, sheet_number, sheet.title)
+        finally:
+            workbook.close()
+
+
+class DocxStreamLoader(BaseLoader):
+    """
+    Stream the paragraphs of a .docx file (parsed incrementally from the zip), about block_chars characters per document.
+    .docxの段落をzipから逐次解析し、一定の文字数ごとのドキュメントとして読み込む
+    """
+
+    def __init__(self, file_path: str, block_chars: int = max_document_chars):
+        self.file_path = file_path
+        self.block_chars = block_chars
+
+    @staticmethod
+    def _paragraph_text(paragraph) -> str:
+        texts = []
+        for element in paragraph.iter():
+            if element.tag == _W + 't' and element.text:
+                texts.append(element.text)
+            elif element.tag == _W + 'tab':
+                texts.append('\t')
+            elif element.tag in (_W + 'br', _W + 'cr'):
+                texts.append('\n')
+        return ''.join(texts)
+
+    def lazy_load(self) -> Iterator[Document]:
+        lines, size, body = [], 0, None
+        with zipfile.ZipFile(self.file_path) as package, package.open('word/document.xml') as f:
+            for event, element in ElementTree.iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    if element.tag == _W + 'body':
+                        body = element
+                    continue
+                if element.tag == _W + 'p':
+                    text = self._paragraph_text(element)
+                    element.clear()
+                    if text:
+                        lines.append(text)
+                        size += len(text)
+                # drop parsed paragraphs and tables, so the tree does not grow with the document
+                if body is not None and len(body) and body[-1] is element:
+                    body.remove(element)
+                if size >= self.block_chars:
+                    yield Document(page_content='\n'.join(lines), metadata={'source': self.file_path})
+                    lines, size = [], 0
+        if lines:
+            yield Document(page_content='\n'.join(lines), metadata={'source': self.file_path})
+
+
+class PptxSlideLoader(BaseLoader):
+    """
+    Stream the slides of a .pptx file one by one (read from the zip in presentation order), one document per slide.
+    .pptxのスライドを表示順にzipから1枚ずつ読み込み、スライド毎のドキュメントとして返す
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    @staticmethod
+    def _slide_paths(package: zipfile.ZipFile) -> List[str]:
+        presentation = ElementTree.fromstring(package.read('ppt/presentation.xml'))
+        relationships = ElementTree.fromstring(package.read('ppt/_rels/presentation.xml.rels'))
+        targets = {rel.get('Id'): rel.get('Target') for rel in relationships.iter(_PACKAGE_RELS + 'Relationship')}
+        paths = []
+        for slide_id in presentation.iter(_P + 'sldId'):
+            target = targets.get(slide_id.get(_R + 'id'))
+            if target:
+                paths.append(target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('ppt', target)))
+        return paths
+
+    def lazy_load(self) -> Iterator[Document]:
+        with zipfile.ZipFile(self.file_path) as package:
+            for slide_number, path in enumerate(self._slide_paths(package), start=1):
+                with package.open(path) as f:
+                    slide = ElementTree.parse(f).getroot()
+                paragraphs = [''.join(text.text or '' for text in paragraph.iter(_A + 't')) for paragraph in slide.iter(_A + 'p')]
+                text = '\n'.join(paragraph for paragraph in paragraphs if paragraph)
+                if text:
+                    yield Document(page_content=text, metadata={'source': self.file_path, 'page_number': slide_number})
+
+
+class _HTMLTextParser(HTMLParser):
+    # text outside script / style, block elements start a new line
+    skipped_tags = {'script', 'style', 'noscript', 'template'}
+    block_tags = {'p', 'div', 'br', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section', 'article', 'table', 'pre', 'blockquote'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.texts = []
+        self.size = 0
+        self.title = None
+        self._skipping = 0
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skipped_tags:
+            self._skipping += 1
+        elif tag == 'title':
+            self._in_title = True
+        elif tag in self.block_tags:
+            self.texts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.skipped_tags:
+            self._skipping = max(self._skipping - 1, 0)
+        elif tag == 'title':
+            self._in_title = False
+
+    def handle_data(self, data):
+        if self._skipping:
+            return
+        if self._in_title:
+            self.title = (self.title or '') + data
+        self.texts.append(data)
+        self.size += len(data)
+
+    def take(self) -> str:
+        text, self.texts, self.size = ''.join(self.texts), [], 0
+        return text
+
+
+class HTMLStreamLoader(BaseLoader):
+    """
+    Stream the text of an HTML file, fed to the parser in blocks, about block_chars characters per document.
+    HTMLファイルをブロック毎にパーサーへ渡してテキストを逐次抽出し、一定の文字数ごとのドキュメントとして読み込む
+    """
+
+    def __init__(self, file_path: str, block_chars: int = max_document_chars, encoding: str = 'utf-8', read_chars: int = 64 * 1024):
+        self.file_path = file_path
+        self.block_chars = block_chars
+        self.encoding = encoding
+        self.read_chars = read_chars
+
+    def _document(self, parser: _HTMLTextParser) -> Optional[Document]:
+        text = parser.take().strip()
+        if not text:
+            return None
+        metadata = {'source': self.file_path}
+        if parser.title:
+            metadata['title'] = parser.title.strip()
+        return Document(page_content=text, metadata=metadata)
+
+    def lazy_load(self) -> Iterator[Document]:
+        parser = _HTMLTextParser()
+        with open(self.file_path, 'r', encoding=self.encoding, errors='replace') as f:
+            while True:
+                block = f.read(self.read_chars)
+                if not block:
+                    break
+                parser.feed(block)
+                if parser.size >= self.block_chars:
+                    document = self._document(parser)
+                    if document is not None:
+                        yield document
+        parser.close()
+        document = self._document(parser)
+        if document is not None:
+            yield document
+
+
+# elements: the loader yields small elements which are merged per page before splitting
+class PDFLoader:
+    def __init__(self, file_path):
+        self.loader = PyPDFLoader(file_path)
+        self.elements = False
+
+
+class HTMLLoader:
+    def __init__(self, file_path):
+        self.loader = HTMLStreamLoader(file_path)
+        self.elements = False
+
+
+class WordLoader:
+    def __init__(self, file_path, mode='single'):
+        if os.path.splitext(file_path)[1] == '.docx':
+            self.loader = DocxStreamLoader(file_path)
+        else:
+            self.loader = Docx2txtLoader(file_path)
+        self.elements = False
+
+
+class PowerPointLoader:
+    def __init__(self, file_path, mode='elements'):
+        if os.path.splitext(file_path)[1] == '.pptx':
+            self.loader = PptxSlideLoader(file_path)
+            self.elements = False
+        else:
+            self.loader = UnstructuredPowerPointLoader(file_path, mode=mode)
+            self.elements = mode == 'elements'
+
+
+class ExcelLoader:
+    def __init__(self, file_path, mode='elements'):
+        if os.path.splitext(file_path)[1] == '.xlsx':
+            self.loader = XlsxRowLoader(file_path)
+            self.elements = False
+        else:
+            self.loader = UnstructuredExcelLoader(file_path, mode=mode)
+            self.elements = mode == 'elements'
+
+
+class TextLoader:
+    def __init__(self, file_path):
+        self.loader = TextStreamLoader(file_path)
+        self.elements = False
+
+
+def get_loader(file_path):
+    ext = os.path.splitext(file_path)[1]
+    if ext not in supported_file_types:
+        return None
+
+    if ext == '.pdf':
+        return PDFLoader(file_path=file_path)
+    elif ext == '.html':
+        return HTMLLoader(file_path=file_path)
+    elif ext == '.doc' or ext == '.docx':
+        return WordLoader(file_path=file_path)
+    elif ext == '.ppt' or ext == '.pptx':
+        return PowerPointLoader(file_path=file_path)
+    elif ext == '.xls' or ext == '.xlsx':
+        return ExcelLoader(file_path=file_path)
+    elif ext == '.txt':
+        return TextLoader(file_path=file_path)
+    # TODO implement other extensions
+
+    return None
+
+
+@lru_cache(maxsize=4)
+def get_text_splitter(settings: ChunkSettings):
+    """
+    Return a splitter measuring chunks with the tokenizer of the embedding model.
+    埋め込みモデルのトークナイザーでチャンク長を測る分割器を返す
+    """
+    if settings.tokenizer_name:
+        try:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(settings.tokenizer_name)
+            return RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+                tokenizer,
+                chunk_size=settings.chunk_tokens,
+                chunk_overlap=settings.chunk_overlap
+            )
+        except Exception as e:
+            logger.warning('tokenizer of %s is not available, splitting by characters: %s', settings.tokenizer_name, e)
+    # about 4 characters per token
+    return RecursiveCharacterTextSplitter(chunk_size=settings.chunk_tokens * 4, chunk_overlap=settings.chunk_overlap * 4)
+
+
+def _page_key(metadata: dict):
+    return metadata.get('page'), metadata.get('page_number'), metadata.get('page_name')
+
+
+# merge consecutive elements of the same page (bounded by max_document_chars)
+def _merge_elements(elements: Iterable[Document]) -> Iterator[Document]:
+    texts, size, key, metadata = [], 0, None, None
+    for element in elements:
+        element_key = _page_key(element.metadata)
+        if texts and (element_key != key or size >= max_document_chars):
+            yield Document(page_content='\n'.join(texts), metadata=metadata)
+            texts, size = [], 0
+        if not texts:
+            key = element_key
+            metadata = {name: value for name, value in element.metadata.items() if name in {'source', 'page', 'page_number', 'page_name'}}
+        texts.append(element.page_content)
+        size += len(element.page_content)
+    if texts:
+        yield Document(page_content='\n'.join(texts), metadata=metadata)
+
+
+def iter_chunks(file_path: str, settings: ChunkSettings = ChunkSettings()) -> Iterator[Document]:
+    """
+    Stream token-sized chunks of a file. Chunks never span pages.
+    Text, HTML, .docx, .pptx and .xlsx files are read incrementally, so memory does not grow with the file
+    (PDF pages are read one by one, but the parser may keep the page objects).
+    .doc, .ppt and .xls files are parsed whole in memory and rejected with ValueError over EMBEDDING_IN_MEMORY_MAX_MB.
+    ファイルをトークン数で分割したチャンクを逐次返す（チャンクはページをまたがない）。
+    テキスト・HTML・.docx・.pptx・.xlsxは逐次読み込むため、メモリはファイルサイズに比例しない。
+    .doc・.ppt・.xlsはファイル全体をメモリ上で解析するため、EMBEDDING_IN_MEMORY_MAX_MBを超えるとValueErrorとする
+    """
+    ext = os.path.splitext(file_path)[1]
+    if ext in in_memory_file_types and os.path.getsize(file_path) > in_memory_max_bytes:
+        raise ValueError(f'{os.path.basename(file_path)} is larger than {in_memory_max_bytes // (1024 * 1024)} MB, '
+                         f'the limit of {ext} files (convert it to {ext}x to ingest it)')
+    loader_class = get_loader(file_path=file_path)
+    if loader_class is None:
+        return
+    splitter = get_text_splitter(settings)
+    documents = loader_class.loader.lazy_load()
+    if loader_class.elements:
+        documents = _merge_elements(documents)
+    for document in documents:
+        yield from splitter.split_documents([document])
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+# parse a file (runs in a worker process, so it must stay picklable and free of the embedding model)
+# page_split is kept for compatibility: chunks never span pages
+def parse_file(file_path: str, page_split: bool = False, settings: ChunkSettings = ChunkSettings()):
+    start = time.perf_counter()
+    documents = list(iter_chunks(file_path, settings))
+    return file_path, documents, time.perf_counter() - start
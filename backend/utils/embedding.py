@@ -1,95 +1,181 @@
 import os
+import re
 import shutil
-from langchain_community.document_loaders import PyPDFLoader
-# from langchain_community.document_loaders import UnstructuredHTMLLoader
-from langchain_community.document_loaders import BSHTMLLoader
-# from langchain_community.document_loaders import UnstructuredWordDocumentLoader
-from langchain_community.document_loaders import Docx2txtLoader
-from langchain_community.document_loaders import UnstructuredPowerPointLoader
-from langchain_community.document_loaders import UnstructuredExcelLoader
-from langchain_community.document_loaders import TextLoader as TextFileLoader
-# from langchain_text_splitter import HTMLHeaderTextSplitter
-# from langchain_text_splitter import CharacterTextSplitter
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
+import hashlib
+import atexit
+import logging
+import time
+import uuid
+import pickle
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import replace
+from itertools import islice
+from threading import Lock, RLock
 from langchain_community.vectorstores.faiss import FAISS
 from langchain_community.vectorstores.chroma import Chroma
 from langchain_community.vectorstores import Milvus
-from typing import List
+from typing import Callable, Dict, List, Optional
+from langchain_core.documents import Document
+from utils.embedding_backends import create_embeddings
+from utils.embedding_engine import create_embedding_engine
+from utils.embedding_cache import CachedEmbeddings, create_embedding_cache
+from utils.manifest import DocumentManifest, file_sha256
+from utils.source_index import SourceIndex
+from utils.lexical_index import LexicalIndex, reciprocal_rank_fusion
+from utils.faiss_index import TOMBSTONE_ID, create_faiss_index_manager
+from utils.faiss_snapshot import FaissSnapshots, WriteBehind
+from utils.retrieval import SearchOptions, default_search_options, create_retrieval_cache, supported_vectorstore_class  # noqa: F401
+from utils.document_loader import (  # noqa: F401
+    supported_file_types,
+    PDFLoader,
+    HTMLLoader,
+    WordLoader,
+    PowerPointLoader,
+    ExcelLoader,
+    TextLoader,
+    get_loader,
+    parse_file,
+    iter_chunks,
+    batched,
+    ChunkSettings,
+)
 
+logger = logging.getLogger(__name__)
 
-# supported file extension
-supported_file_types = ['.pdf', '.html', '.doc', '.docx', '.ppt', '.pptx', '.xls', '.xlsx', '.txt']
-# supported vectorstore
-supported_vectorstore_class = ['chroma', 'faiss', 'milvus']
+# number of processes parsing files (0: parse in this process)
+default_parse_workers = int(os.getenv('EMBEDDING_PARSE_WORKERS', str(min(4, os.cpu_count() or 1))))
+# FAISS persistence
+faiss_mmap = os.getenv('FAISS_MMAP', 'true').lower() == 'true'
+faiss_snapshot_every = int(os.getenv('FAISS_SNAPSHOT_EVERY', '1000'))
+faiss_snapshot_interval = float(os.getenv('FAISS_SNAPSHOT_INTERVAL_SECONDS', '30'))
+faiss_snapshots_keep = int(os.getenv('FAISS_SNAPSHOTS_KEEP', '2'))
+# files at least this large are streamed in this process instead of parsed in the pool
+stream_min_bytes = int(float(os.getenv('EMBEDDING_STREAM_MIN_MB', '20')) * 1024 * 1024)
+# chunks embedded and added at a time
+ingest_batch_size = int(os.getenv('EMBEDDING_INGEST_BATCH', '256'))
 
 
-class PDFLoader:
-    def __init__(self, file_path):
-        self.loader = PyPDFLoader(file_path)
-        self.text_splitter = None
+# chunk size of the embedding model: its max sequence length unless EMBEDDING_CHUNK_TOKENS is smaller
+def _chunk_settings(embeddings) -> ChunkSettings:
+    client = getattr(embeddings, '_client', None)
+    # leave room for the special tokens added by the model
+    max_tokens = max((getattr(client, 'max_seq_length', None) or 256) - 2, 16)
+    chunk_tokens = int(os.getenv('EMBEDDING_CHUNK_TOKENS') or max_tokens)
+    return ChunkSettings(
+        tokenizer_name=getattr(embeddings, 'model_name', None),
+        chunk_tokens=min(chunk_tokens, max_tokens),
+        chunk_overlap=int(os.getenv('EMBEDDING_CHUNK_OVERLAP', '32'))
+    )
 
 
-class HTMLLoader:
-    def __init__(self, file_path):
-        self.loader = BSHTMLLoader(file_path)
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            # separators=['\n\n', '\n', ' ', ''],
-            chunk_size=2000,
-            chunk_overlap=20,
-            is_separator_regex=False,
-        )
-
-
-class WordLoader:
-    def __init__(self, file_path, mode='single'):
-        self.loader = Docx2txtLoader(file_path)
-        self.text_splitter = None
+# page number and sheet name of a chunk
+def _page_info(source: str, metadata: dict):
+    page = -1
+    ext = os.path.splitext(source)[1]
+    if ext == '.pdf':
+        page = metadata.get('page', -1)
+    elif ext in {'.doc', '.docx', '.ppt', '.pptx', '.xls', '.xlsx'}:
+        page = metadata.get('page_number', -1)
+    page_name = ''
+    if ext in {'.xls', '.xlsx'}:
+        page_name = metadata.get('page_name', '')
+    return page, page_name
 
 
-class PowerPointLoader:
-    def __init__(self, file_path, mode='single'):
-        self.loader = UnstructuredPowerPointLoader(file_path, mode=mode)
-        self.text_splitter = None
+def _document_dict(chunk_id, metadata: dict, content: Optional[str] = None) -> dict:
+    source = metadata.get('source', '')
+    page, page_name = _page_info(source, metadata)
+    res = {'id': chunk_id, 'source': source, 'page': page, 'page_name': page_name}
+    if content is not None:
+        res['content'] = content
+    return res
 
 
-class ExcelLoader:
-    def __init__(self, file_path, mode='single'):
-        self.loader = UnstructuredExcelLoader(file_path, mode=mode)
-        self.text_splitter = None
-
-
-class TextLoader:
-    def __init__(self, file_path):
-        self.loader = TextFileLoader(file_path)
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            # separators=['\n\n', '\n', ' ', ''],
-            chunk_size=300,
-            chunk_overlap=20,
-            is_separator_regex=False,
-        )
+# namespace usable in paths and collection names (Milvus allows letters, digits and "_").
+# The hash keeps namespaces apart which read the same once sanitized or truncated ("a.b@x.com" / "a_b_x_com")
+def safe_namespace(namespace: str) -> str:
+    slug = re.sub(r'[^A-Za-z0-9_]', '_', namespace)[:48]
+    return f"{slug}_{hashlib.sha256(namespace.encode('utf-8')).hexdigest()[:12]}"
 
 
 # TODO not tested for Milvus
 class Embedding:
-    def __init__(self, embeddings=HuggingFaceEmbeddings(), vectorstore_class='faiss', connection_args={}, use_saved_store=True):
-        self.embeddings = embeddings
+    # namespace: separate store of a tenant (None: the shared store)
+    # parent: Embedding whose model, caches and parse pool are shared
+    def __init__(self, embeddings=None, vectorstore_class='faiss', connection_args={}, use_saved_store=True, parse_workers: Optional[int] = None,
+                 namespace: Optional[str] = None, parent: Optional['Embedding'] = None):
+        self.namespace = namespace
+        self.parent = parent
+        if parent is not None:
+            self.embedding_cache = parent.embedding_cache
+            self.embeddings = parent.embeddings
+            self.engine = parent.engine
+            embeddings = parent.engine.embeddings
+        else:
+            if embeddings is None:
+                # backend (torch, onnx, int8) selected by EMBEDDING_BACKEND
+                embeddings = create_embeddings()
+            # document and query embeddings go through the content-addressed cache
+            self.embedding_cache = create_embedding_cache()
+            if self.embedding_cache is not None:
+                self.embeddings = CachedEmbeddings(embeddings, self.embedding_cache)
+                self.engine = create_embedding_engine(embeddings, cached_embeddings=self.embeddings)
+            else:
+                self.embeddings = embeddings
+                self.engine = create_embedding_engine(embeddings)
+        self.parse_workers = default_parse_workers if parse_workers is None else parse_workers
+        self.chunk_settings = _chunk_settings(embeddings)
+        # search results are cached per index version, bumped on every add and delete
+        self.retrieval_cache = create_retrieval_cache()
+        self.index_version = 0
+        self._parse_pool = None
+        self.parse_timings = {}
+        # guards the vectorstore against concurrent ingestion and search
+        self._lock = RLock()
         self.vectorstore_class = vectorstore_class.lower()
         self.persist_directory = './vectorstore_' + self.vectorstore_class
-        if not use_saved_store and os.path.exists(self.persist_directory):
-            shutil.rmtree(self.persist_directory)
+        if namespace is not None:
+            self.persist_directory += '_tenants/' + safe_namespace(namespace)
+        # manifest and indexes kept next to the vectorstore
+        self.metadata_directory = self.persist_directory + '_meta'
+        if not use_saved_store:
+            for directory in (self.persist_directory, self.metadata_directory):
+                if os.path.exists(directory):
+                    shutil.rmtree(directory)
+        self.manifest = DocumentManifest(os.path.join(self.metadata_directory, 'manifest.json'))
+        self.source_index = SourceIndex(os.path.join(self.metadata_directory, 'source_index.json'))
+        self.search_options = default_search_options()
+        # BM25 index of chunk texts for hybrid retrieval
+        self.lexical_index = None
+        if self.search_options.hybrid and self.vectorstore_class in {'faiss', 'chroma'}:
+            self.lexical_index = LexicalIndex(os.path.join(self.metadata_directory, 'lexical_index.json'))
+        # ANN index type of FAISS (flat until enough vectors exist to train it)
+        self.faiss_index = create_faiss_index_manager() if self.vectorstore_class == 'faiss' else None
+        if self.vectorstore_class != 'faiss' and os.getenv('VECTOR_STORAGE', 'float32').lower() != 'float32':
+            logger.warning('VECTOR_STORAGE is supported by FAISS only, %s stores float32 vectors', self.vectorstore_class)
+        self.faiss_snapshots = FaissSnapshots(self.persist_directory, keep=faiss_snapshots_keep) if self.vectorstore_class == 'faiss' else None
+        # snapshot the index is memory-mapped from (read-only until the first write)
+        self._faiss_mapped_path = None
+        # snapshot this process loaded or wrote last (another name in CURRENT means a second writer)
+        self._faiss_snapshot_name = None
+        self._snapshot_lock = Lock()
+        self._write_behind = None
         self.vectorstore = None
         if self.vectorstore_class == 'faiss':
-            if os.path.exists(self.persist_directory):
+            if self.faiss_snapshots.exists():
                 self.load_store()
             else:
                 dummy_text, dummy_id = '1', 1
                 self.vectorstore = FAISS.from_texts(texts=[dummy_text], embedding=self.embeddings, ids=[dummy_id])
                 self.vectorstore.delete([dummy_id])
+            # adds and deletes are snapshotted in the background
+            self._write_behind = WriteBehind(self._write_snapshot, every_changes=faiss_snapshot_every, interval=faiss_snapshot_interval)
         elif self.vectorstore_class == 'chroma':
-            self.vectorstore = Chroma(embedding_function=embeddings, persist_directory=self.persist_directory)
+            self.vectorstore = Chroma(embedding_function=self.embeddings, persist_directory=self.persist_directory)
         elif self.vectorstore_class == 'milvus':
-            self.milvus_collection_name = 'LangChainCollection'
+            self.milvus_collection_name = 'LangChainCollection' + ('_' + safe_namespace(namespace) if namespace is not None else '')
             self.milvus_connection_args = {
                 'host': connection_args.get('host', ''),
                 'port': connection_args.get('port', ''),
@@ -102,40 +188,93 @@ class Embedding:
             self.vectorstore = Milvus(
                 embeddings=self.embeddings,
                 connection_args=self.milvus_connection_args,
-                drop_old=True,
+                # stores are reopened when tenants are reloaded, keep their data
+                drop_old=not use_saved_store,
                 collection_name=self.milvus_collection_name
             )
+        if self.vectorstore_class in {'faiss', 'chroma'} and not self._indexes_in_sync():
+            # missing or stale (e.g. the store was written by an older version)
+            self.rebuild_indexes()
+        atexit.register(self.close)
+
+    def close(self):
+        """
+        Persist pending changes and stop background writers (the store is unloaded afterwards).
+        未保存の変更を書き込み、バックグラウンド処理を停止する
+        """
+        if self._write_behind is not None:
+            self._write_behind.close()
+        self._save_indexes()
+        atexit.unregister(self.close)
 
     def get_loader(self, file_path):
-        ext = os.path.splitext(file_path)[1]
-        if ext not in supported_file_types:
-            return None
-
-        if ext == '.pdf':
-            return PDFLoader(file_path=file_path)
-        elif ext == '.html':
-            return HTMLLoader(file_path=file_path)
-        elif ext == '.doc' or ext == '.docx':
-            return WordLoader(file_path=file_path)
-        elif ext == '.ppt' or ext == '.pptx':
-            return PowerPointLoader(file_path=file_path)
-        elif ext == '.xls' or ext == '.xlsx':
-            return ExcelLoader(file_path=file_path)
-        elif ext == '.txt':
-            return TextLoader(file_path=file_path)
-        # TODO implement other extensions
+        return get_loader(file_path=file_path)
 
-        return None
+    def _get_parse_pool(self):
+        if self.parent is not None:
+            return self.parent._get_parse_pool()
+        if self._parse_pool is None:
+            # spawn: forking a process holding torch / faiss threads can deadlock
+            self._parse_pool = ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._parse_pool
+
+    # parse files and yield (file_path, chunks) as each file becomes available
+    # large files are streamed in this process (chunks is a generator) while the pool parses the small ones
+    def iter_parsed_files(self, file_paths: List[str], page_split: bool = False, on_error: Optional[Callable[[str, Exception], None]] = None):
+        file_paths = [file_path for file_path in file_paths if os.path.splitext(file_path)[1] in supported_file_types]
+        streamed = [file_path for file_path in file_paths if self.parse_workers <= 0 or self._is_large(file_path)]
+        pooled = [file_path for file_path in file_paths if file_path not in streamed]
+
+        futures = {}
+        if pooled:
+            pool = self._get_parse_pool()
+            futures = {pool.submit(parse_file, file_path, page_split, self.chunk_settings): file_path for file_path in pooled}
+        for file_path in streamed:
+            yield file_path, self._stream_file(file_path)
+        for future in as_completed(futures):
+            try:
+                file_path, documents, elapsed = future.result()
+            except Exception as e:
+                if on_error:
+                    on_error(futures[future], e)
+                continue
+            self._record_parse(file_path, len(documents), elapsed)
+            yield file_path, documents
+
+    def _is_large(self, file_path: str) -> bool:
+        try:
+            return os.path.getsize(file_path) >= stream_min_bytes
+        except OSError:
+            return True
+
+    def _stream_file(self, file_path: str):
+        chunks = iter_chunks(file_path, self.chunk_settings)
+        count, elapsed = 0, 0.0
+        while True:
+            # time parsing only, not the consumer
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            elapsed += time.perf_counter() - start
+            if chunk is None:
+                break
+            count += 1
+            yield chunk
+        self._record_parse(file_path, count, elapsed)
+
+    def _record_parse(self, file_path, count, elapsed):
+        self.parse_timings[file_path] = {'seconds': round(elapsed, 3), 'documents': count}
+        logger.info('parsed %s: %d documents in %.3fs', file_path, count, elapsed)
 
     # build vectorstore with files
     def load_files(self, file_paths: List[str] = [], page_split: bool = False):
-        loader_classes = [self.get_loader(file_path=file_path) for file_path in file_paths if self.get_loader(file_path=file_path)]
         documents = []
-        for loader_class in loader_classes:
-            documents.extend(loader_class.loader.load_and_split(text_splitter=loader_class.text_splitter) if page_split else loader_class.loader.load())
+        for _, docs in self.iter_parsed_files(file_paths=file_paths, page_split=page_split):
+            documents.extend(docs)
 
         if self.vectorstore_class == 'faiss':
             self.vectorstore = FAISS.from_documents(documents=documents, embedding=self.embeddings)
+            self.faiss_index.maybe_upgrade(self.vectorstore)
+            self._faiss_mapped_path = None
         elif self.vectorstore_class == 'chroma':
             self.vectorstore = Chroma.from_documents(documents=documents, embedding=self.embeddings, persist_directory=self.persist_directory)
         elif self.vectorstore_class == 'milvus':
@@ -146,11 +285,15 @@ class Embedding:
                 drop_old=True,
                 collection_name=self.milvus_collection_name
             )
+        self._changed(len(documents))
+        self.rebuild_indexes()
 
     # build vectorstore with texts
     def load_texts(self, texts: List[str] = [], metadatas: List[dict] = None, ids: List[str] = None):
         if self.vectorstore_class == 'faiss':
             self.vectorstore = FAISS.from_texts(texts=texts, embedding=self.embeddings, metadatas=metadatas, ids=ids)
+            self.faiss_index.maybe_upgrade(self.vectorstore)
+            self._faiss_mapped_path = None
         elif self.vectorstore_class == 'chroma':
             self.vectorstore = Chroma.from_texts(texts=texts, embedding=self.embeddings, metadatas=metadatas, ids=ids, persist_directory=self.persist_directory)
         elif self.vectorstore_class == 'milvus':
@@ -162,21 +305,242 @@ class Embedding:
                 drop_old=True,
                 collection_name=self.milvus_collection_name
             )
+        self._changed(len(texts))
+        self.rebuild_indexes()
 
     # add files
-    def add_documents(self, file_paths: List[str], page_split: bool = False):
-        loader_classes = [self.get_loader(file_path=file_path) for file_path in file_paths if self.get_loader(file_path=file_path)]
-        documents = []
-        for loader_class in loader_classes:
-            documents.extend(loader_class.loader.load_and_split(text_splitter=loader_class.text_splitter) if page_split else loader_class.loader.load())
-        res = self.vectorstore.add_documents(documents=documents)
-        if not res:
+    # chunks are embedded in bounded batches as they are parsed, while other files are still parsed
+    def add_documents(self, file_paths: List[str], page_split: bool = False, on_file_done: Optional[Callable[[str, bool], None]] = None,
+                      sources: Optional[Dict[str, str]] = None, on_file_added: Optional[Callable[[str, List[str]], None]] = None):
+        failed = []
+
+        def on_error(file_path, e):
+            logger.warning('failed to parse %s: %s', file_path, e)
+            failed.append(file_path)
+            if on_file_done:
+                on_file_done(file_path, False)
+
+        # unsupported files are skipped
+        if on_file_done:
+            for file_path in file_paths:
+                if os.path.splitext(file_path)[1] not in supported_file_types:
+                    on_file_done(file_path, False)
+
+        added = 0
+        for file_path, documents in self.iter_parsed_files(file_paths=file_paths, page_split=page_split, on_error=on_error):
+            res = []
+            try:
+                for batch in batched(documents, ingest_batch_size):
+                    if sources and file_path in sources:
+                        # record the original name instead of the temporary path
+                        for doc in batch:
+                            doc.metadata['source'] = sources[file_path]
+                    res.extend(self._add_document_batch(batch) or [])
+            except Exception as e:
+                logger.warning('failed to ingest %s: %s', file_path, e)
+                if res:
+                    # a partially ingested file is removed
+                    self.delete_documents_from_ids(res)
+                res = []
+            if res:
+                added += len(res)
+                if on_file_added:
+                    on_file_added(file_path, res)
+            else:
+                failed.append(file_path)
+            if on_file_done:
+                on_file_done(file_path, bool(res))
+        if failed or not added:
             return False
         return True
 
+    # embed documents with the batching engine, then add the vectors
+    def _add_document_batch(self, documents, ids: List[str] = None) -> List[str]:
+        texts = [doc.page_content for doc in documents]
+        metadatas = [doc.metadata for doc in documents]
+        if self.vectorstore_class == 'milvus':
+            # precomputed vectors are not supported, the vectorstore embeds them
+            with self._lock:
+                ids = self.vectorstore.add_documents(documents=documents, ids=ids)
+                self._changed(len(ids))
+                return ids
+
+        vectors = self.engine.embed(texts)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        with self._lock:
+            if self.vectorstore_class == 'faiss':
+                self._ensure_writable()
+                ids = self.vectorstore.add_embeddings(text_embeddings=list(zip(texts, vectors)), metadatas=metadatas, ids=ids)
+                self.faiss_index.maybe_upgrade(self.vectorstore)
+            elif self.vectorstore_class == 'chroma':
+                self.vectorstore._collection.upsert(ids=ids, embeddings=vectors, documents=texts, metadatas=metadatas)
+            else:
+                return []
+            self._changed(len(ids))
+            self._index_chunks(ids, metadatas, texts)
+        return ids
+
+    # copy a memory-mapped index into RAM before modifying it
+    def _ensure_writable(self):
+        if self._faiss_mapped_path is None:
+            return
+        try:
+            index = FaissSnapshots.read_index(self._faiss_mapped_path, mmap=False)
+        except RuntimeError:
+            # the snapshot was pruned by another process
+            import faiss
+            index = faiss.clone_index(self.vectorstore.index)
+        self.faiss_index.tune(index)
+        self.vectorstore.index = index
+        self._faiss_mapped_path = None
+
+    def _changed(self, count: int):
+        if not count:
+            return
+        self.index_version += 1
+        if self.retrieval_cache is not None:
+            self.retrieval_cache.clear()
+        if self._write_behind is not None:
+            self._write_behind.mark(count)
+
+    # write a FAISS snapshot (serialized under the lock, written outside it)
+    # a store has a single writer: snapshots of other processes are replaced, not merged (see FaissSnapshots)
+    def _write_snapshot(self):
+        import faiss
+        with self._snapshot_lock:
+            current = self.faiss_snapshots.current_name()
+            if current != self._faiss_snapshot_name:
+                logger.warning('FAISS snapshot %s of %s was published by another process and is replaced; '
+                               'ingest in a single process (e.g. set RAG_SERVER_URL) when running several workers',
+                               current, self.persist_directory)
+            with self._lock:
+                index_bytes = faiss.serialize_index(self.vectorstore.index)
+                docstore_bytes = pickle.dumps((self.vectorstore.docstore, self.vectorstore.index_to_docstore_id))
+            path = self.faiss_snapshots.write(index_bytes, docstore_bytes)
+            self._faiss_snapshot_name = os.path.basename(path)
+        self._save_indexes()
+        logger.info('wrote FAISS snapshot %s', path)
+        return path
+
+    # keep the source and lexical indexes in step with the vectorstore
+    def _index_chunks(self, ids: List[str], metadatas: List[dict], texts: List[str]):
+        if self.vectorstore_class not in {'faiss', 'chroma'}:
+            return
+        for chunk_id, metadata, text in zip(ids, metadatas, texts):
+            source = (metadata or {}).get('source', '')
+            page, page_name = _page_info(source, metadata or {})
+            self.source_index.add(chunk_id, source, page, page_name)
+            if self.lexical_index is not None:
+                self.lexical_index.add(chunk_id, text)
+
+    def _indexes_in_sync(self) -> bool:
+        count = self._count()
+        for index in (self.source_index, self.lexical_index):
+            if index is not None and (not index.loaded or len(index) != count):
+                return False
+        return True
+
+    def _save_indexes(self):
+        self.source_index.save()
+        if self.lexical_index is not None:
+            self.lexical_index.save()
+
+    def _count(self) -> int:
+        if self.vectorstore is None:
+            return 0
+        if self.vectorstore_class == 'faiss':
+            return self.faiss_index.live_count(self.vectorstore)
+        elif self.vectorstore_class == 'chroma':
+            return self.vectorstore._collection.count()
+        elif self.vectorstore_class == 'milvus':
+            return self.vectorstore.col.num_entities if self.vectorstore.col is not None else 0
+        return 0
+
+    # rebuild the source and lexical indexes from the vectorstore (one full scan)
+    def rebuild_indexes(self):
+        if self.vectorstore_class not in {'faiss', 'chroma'}:
+            return
+        with self._lock:
+            self.source_index.clear()
+            if self.lexical_index is not None:
+                self.lexical_index.clear()
+            for page in batched(self.iter_documents(include_content=self.lexical_index is not None), ingest_batch_size):
+                self._index_chunks(
+                    [doc['id'] for doc in page],
+                    [{'source': doc['source'], 'page': doc['page'], 'page_number': doc['page'], 'page_name': doc['page_name']} for doc in page],
+                    [doc.get('content', '') for doc in page]
+                )
+            self._save_indexes()
+
+    # add files incrementally: unchanged files are skipped, changed files replace their old chunks
+    def upsert_files(self, file_paths: List[str], page_split: bool = False, sources: Optional[Dict[str, str]] = None,
+                     hashes: Optional[Dict[str, str]] = None, on_file_done: Optional[Callable[[str, bool], None]] = None):
+        sources = {file_path: (sources or {}).get(file_path, file_path) for file_path in file_paths}
+        hashes = {file_path: (hashes or {}).get(file_path) or file_sha256(file_path) for file_path in file_paths}
+        result = {'added': [], 'replaced': [], 'skipped': [], 'failed': []}
+
+        to_add = []
+        for file_path in file_paths:
+            source = sources[file_path]
+            entry = self.manifest.get(source)
+            if entry and entry['sha256'] == hashes[file_path]:
+                result['skipped'].append(source)
+                if on_file_done:
+                    on_file_done(file_path, True)
+                continue
+            to_add.append(file_path)
+
+        def on_file_added(file_path, ids):
+            source = sources[file_path]
+            old = self.manifest.get(source)
+            # old chunks are removed only after the new ones are searchable
+            if old:
+                old_ids = old['ids']
+            else:
+                # ingested before the manifest existed: every chunk of the source but the new ones
+                new_ids = set(ids)
+                old_ids = [chunk_id for chunk_id in self.get_document_ids_from_source(source) or [] if chunk_id not in new_ids]
+            if old_ids:
+                self.delete_documents_from_ids(old_ids)
+            self.manifest.set(source, hashes[file_path], ids)
+            result['replaced' if old else 'added'].append(source)
+
+        def on_added_file_done(file_path, ok):
+            if not ok:
+                result['failed'].append(sources[file_path])
+            if on_file_done:
+                on_file_done(file_path, ok)
+
+        if to_add:
+            self.add_documents(file_paths=to_add, page_split=page_split, on_file_done=on_added_file_done, sources=sources, on_file_added=on_file_added)
+            self.manifest.save()
+            self._save_indexes()
+        return result
+
+    # delete chunks not referenced by the manifest
+    def gc_orphans(self, include_unmanaged: bool = False):
+        referenced = self.manifest.referenced_ids()
+        managed_sources = set(referenced.values())
+        orphans = [
+            doc['id'] for doc in self.iter_documents(include_content=False)
+            if doc['id'] not in referenced and (include_unmanaged or doc['source'] in managed_sources)
+        ]
+        if orphans:
+            self.delete_documents_from_ids(orphans)
+            self._save_indexes()
+        return orphans
+
     # テキスト追加読み込み
     def add_texts(self, texts: List[str] = [], metadatas: List[dict] = None, ids: List[str] = None):
-        res = self.vectorstore.add_texts(texts=texts, metadatas=metadatas, ids=ids)
+        with self._lock:
+            if self.faiss_index:
+                self._ensure_writable()
+            res = self.vectorstore.add_texts(texts=texts, metadatas=metadatas, ids=ids)
+            if res:
+                self._index_chunks(res, metadatas or [{} for _ in res], texts)
+                if self.faiss_index:
+                    self.faiss_index.maybe_upgrade(self.vectorstore)
+                self._changed(len(res))
         if not res:
             return False
         return True
@@ -184,9 +548,10 @@ class Embedding:
     # なんかFAISSの時だけ必要っぽい
     # vectorsotre保存
     def save_store(self):
+        self._save_indexes()
         if self.vectorstore:
             if self.vectorstore_class == 'faiss':
-                self.vectorstore.save_local(self.persist_directory)
+                self._write_behind.flush(force=True)
                 return True
             elif self.vectorstore_class == 'chroma':
                 # Since Chroma 0.4.x the manual persistence method is no longer supported as docs are automatically persisted.
@@ -201,7 +566,12 @@ class Embedding:
     def load_store(self):
         if not self.vectorstore:
             if self.vectorstore_class == 'faiss':
-                self.vectorstore = FAISS.load_local(folder_path=self.persist_directory, embeddings=self.embeddings)
+                self.vectorstore, path = self.faiss_snapshots.load(self.embeddings, mmap=faiss_mmap)
+                if self.vectorstore is None:
+                    return False
+                self._faiss_mapped_path = path if faiss_mmap else None
+                self._faiss_snapshot_name = self.faiss_snapshots.current_name() if path != self.persist_directory else None
+                self.faiss_index.tune(self.vectorstore.index)
             elif self.vectorstore_class == 'chroma':
                 self.vectorstore = Chroma(persist_directory=self.persist_directory, embedding_function=self.embeddings)
             elif self.vectorstore_class == 'milvus':
@@ -213,77 +583,293 @@ class Embedding:
             return True
         return False
 
-    def get_similarity_search(self, query: str):
+    def search(self, query: str, k: Optional[int] = None, search_type: Optional[str] = None, score_threshold: Optional[float] = None) -> List[Document]:
+        """
+        Search chunks with the configured options (arguments override them). Results are cached until the store changes.
+        設定したオプションでチャンクを検索する（引数で上書き可）。結果はストアが変更されるまでキャッシュする
+        """
+        return self.search_many([query], k=k, search_type=search_type, score_threshold=score_threshold)[0]
+
+    def search_many(self, queries: List[str], k: Optional[int] = None, search_type: Optional[str] = None,
+                    score_threshold: Optional[float] = None) -> List[List[Document]]:
+        """
+        Search several queries. Queries missing from the cache are embedded in one forward pass.
+        複数のクエリを検索する。キャッシュにないクエリはまとめて1回で埋め込む
+        """
+        if not self.vectorstore or not queries:
+            return [[] for _ in queries]
+        options = self.search_options.override(k=k, search_type=search_type, score_threshold=score_threshold)
+        version = self.index_version
+        keys = [self.retrieval_cache.make_key(query, options, version) for query in queries] if self.retrieval_cache else []
+        results = [self.retrieval_cache.get(key) for key in keys] if self.retrieval_cache else [None] * len(queries)
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            # BM25-only search needs no query embedding
+            vectors = self.embed_queries([queries[i] for i in missing]) if options.search_type != 'lexical' else [None] * len(missing)
+            with self._lock:
+                for i, vector in zip(missing, vectors):
+                    results[i] = self._search(queries[i], vector, options)
+            if self.retrieval_cache:
+                for i in missing:
+                    self.retrieval_cache.set(keys[i], results[i])
+        return results
+
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        raw = self.engine.embeddings
+
+        def embed_func(texts):
+            if hasattr(raw, 'query_encode_kwargs') and not raw.query_encode_kwargs:
+                # queries are encoded like documents, so one forward pass serves them all
+                return raw.embed_documents(texts)
+            return [raw.embed_query(text) for text in texts]
+
+        if isinstance(self.embeddings, CachedEmbeddings):
+            return self.embeddings.embed_queries(queries, embed_func=embed_func)
+        return embed_func(queries)
+
+    def _search(self, query: str, vector: Optional[List[float]], options: SearchOptions) -> List[Document]:
+        k = max(options.k, 1)
+        if options.search_type == 'lexical':
+            return self._search_lexical(query, k)
+        if self.lexical_index is None or not options.hybrid:
+            return self._search_by_vector(vector, options)
+
+        # reciprocal rank fusion of vector and BM25 candidates
+        candidates = max(options.fetch_k, k)
+        dense = self._search_by_vector(vector, options if options.search_type == 'mmr' else replace(options, k=candidates))
+        lexical = self._search_lexical(query, candidates)
+        if options.score_threshold is not None and options.search_type != 'mmr':
+            # the vector leg is already thresholded; BM25 hits it did not return are dropped when their vector scores below
+            # the threshold. Only FAISS with the embedding cache can score them, elsewhere lexical-only hits bypass it
+            seen = {doc.id or doc.page_content for doc in dense}
+            scores = self._relevance_scores(vector, [doc for doc in lexical if (doc.id or doc.page_content) not in seen])
+            lexical = [doc for doc in lexical if scores.get(doc.id, options.score_threshold) >= options.score_threshold]
+        documents = {}
+        for doc in dense + lexical:
+            documents.setdefault(doc.id or doc.page_content, doc)
+        fused = reciprocal_rank_fusion([[doc.id or doc.page_content for doc in ranking] for ranking in (dense, lexical)], k=options.rrf_k)
+        return [
+            Document(page_content=documents[key].page_content, metadata={**documents[key].metadata, 'rrf_score': score}, id=documents[key].id)
+            for key, score in fused[:k]
+        ]
+
+    def _relevance_scores(self, vector: List[float], docs: List[Document]) -> Dict[str, float]:
+        """
+        Relevance scores of docs for the query vector, from their full precision vectors in the embedding cache (FAISS only).
+        Docs that cannot be scored are left out.
+        埋め込みキャッシュのフル精度ベクトルでクエリとの関連度を計算する（FAISSのみ、計算できない文書は含めない）
+        """
+        if not docs or self.faiss_index is None or not isinstance(self.embeddings, CachedEmbeddings):
+            return {}
+        try:
+            relevance = self.vectorstore._select_relevance_score_fn()
+        except NotImplementedError:
+            return {}
+        vectors = self.embeddings.cached_vectors([doc.page_content for doc in docs])
+        pairs = [(doc, 0.0) for doc, vec in zip(docs, vectors) if vec is not None]
+        scored = self.faiss_index.rescore(self.vectorstore, vector, pairs, [vec for vec in vectors if vec is not None])
+        return {doc.id: relevance(score) for doc, score in scored}
+
+    def _search_lexical(self, query: str, k: int) -> List[Document]:
+        if self.lexical_index is None:
+            return []
+        hits = self.lexical_index.search(query, k=k)
+        documents = self._get_documents_by_ids([chunk_id for chunk_id, _ in hits])
+        return [
+            Document(page_content=documents[chunk_id].page_content, metadata={**documents[chunk_id].metadata, 'bm25_score': score}, id=chunk_id)
+            for chunk_id, score in hits if chunk_id in documents
+        ]
+
+    def _get_documents_by_ids(self, ids: List[str]) -> Dict[str, Document]:
+        if not ids:
+            return {}
+        if self.vectorstore_class == 'faiss':
+            docs = self.vectorstore.docstore._dict
+            return {chunk_id: docs[chunk_id] for chunk_id in ids if chunk_id in docs}
+        elif self.vectorstore_class == 'chroma':
+            docs = self.vectorstore._collection.get(ids=ids, include=['documents', 'metadatas'])
+            return {
+                chunk_id: Document(page_content=content, metadata=metadata or {}, id=chunk_id)
+                for chunk_id, content, metadata in zip(docs['ids'], docs['documents'], docs['metadatas'])
+            }
+        return {}
+
+    def _search_by_vector(self, vector: List[float], options: SearchOptions) -> List[Document]:
+        k = max(options.k, 1)
+        if options.search_type == 'mmr':
+            documents = self.vectorstore.max_marginal_relevance_search_by_vector(vector, k=k, fetch_k=max(options.fetch_k, k), lambda_mult=options.lambda_mult)
+            return [Document(page_content=doc.page_content, metadata=dict(doc.metadata), id=doc.id) for doc in documents if doc.id != TOMBSTONE_ID]
+
+        if self.vectorstore_class == 'chroma':
+            # returns distances despite the name
+            pairs = self.vectorstore.similarity_search_by_vector_with_relevance_scores(vector, k=k)
+        elif self._rescoring():
+            # over-fetch from the compressed index and re-rank with the full precision vectors of the embedding cache
+            pairs = self.faiss_index.search(self.vectorstore, vector, k * self.faiss_index.rescore_factor)
+            vectors = self.embeddings.cached_vectors([doc.page_content for doc, _ in pairs])
+            pairs = self.faiss_index.rescore(self.vectorstore, vector, pairs, vectors)[:k]
+        elif self.faiss_index is not None:
+            pairs = self.faiss_index.search(self.vectorstore, vector, k)
+        else:
+            pairs = self.vectorstore.similarity_search_with_score_by_vector(vector, k=k)
+        try:
+            relevance = self.vectorstore._select_relevance_score_fn()
+        except NotImplementedError:
+            relevance = None
+        res = []
+        for doc, score in pairs:
+            if relevance is not None:
+                score = relevance(score)
+                if options.score_threshold is not None and score < options.score_threshold:
+                    continue
+            res.append(Document(page_content=doc.page_content, metadata={**doc.metadata, 'score': float(score)}, id=doc.id))
+        return res
+
+    def _rescoring(self) -> bool:
+        return (
+            self.faiss_index is not None and self.faiss_index.rescore_factor > 1
+            and isinstance(self.embeddings, CachedEmbeddings) and self.faiss_index.is_compressed(self.vectorstore.index)
+        )
+
+    def storage_stats(self, sample: int = 5000, k: int = 10) -> dict:
+        """
+        Return bytes per vector of the store and recall@k of its vector storage against exact float32 search.
+        Recall is measured on up to `sample` chunks whose full precision vectors are in the embedding cache.
+        ベクトル1件あたりのバイト数と、float32の全探索に対するrecall@kを返す（埋め込みキャッシュにあるチャンクで測定）
+        """
+        if self.faiss_index is None:
+            # Chroma and Milvus keep float32 vectors
+            return {'storage': 'float32', 'recall': None}
+        with self._lock:
+            index = self.vectorstore.index
+            stats = self.faiss_index.stats(index)
+            docstore = self.vectorstore.docstore._dict
+            chunk_ids = (chunk_id for chunk_id in self.vectorstore.index_to_docstore_id.values() if chunk_id != TOMBSTONE_ID)
+            texts = [docstore[chunk_id].page_content for chunk_id in islice(chunk_ids, sample)]
+        if not isinstance(self.embeddings, CachedEmbeddings) or not texts:
+            return {**stats, 'recall': None}
+        vectors = [vector for vector in self.embeddings.cached_vectors(texts) if vector is not None]
+        if not vectors:
+            return {**stats, 'recall': None}
+        return {**stats, **self.faiss_index.measure_recall(np.stack(vectors), index.metric_type, k=k)}
+
+    def get_similarity_search(self, query: str, k: int = 4):
         if self.vectorstore:
-            return self.vectorstore.similarity_search(query)
+            with self._lock:
+                return [doc for doc in self.vectorstore.similarity_search(query, k=k) if doc.id != TOMBSTONE_ID]
         return None
 
+    def count_documents(self) -> int:
+        with self._lock:
+            return self._count()
+
+    def get_documents_page(self, offset: int = 0, limit: int = 100, include_content: bool = True) -> List[dict]:
+        """
+        Return one page of chunks in store order.
+        ストア順のチャンクを1ページ分返す
+
+        Args:
+            offset: number of chunks to skip
+            limit: max number of chunks
+            include_content: False returns IDs and metadata only
+        """
+        if not self.vectorstore or limit <= 0:
+            return []
+        if self.vectorstore_class == 'faiss':
+            with self._lock:
+                # positions are dense (0..n-1), so a page is looked up directly instead of skipping `offset` entries
+                mapping = self.vectorstore.index_to_docstore_id
+                ids = [mapping[i] for i in range(offset, min(offset + limit, len(mapping)))]
+                docs = [(chunk_id, self.vectorstore.docstore._dict.get(chunk_id)) for chunk_id in ids]
+            return [
+                _document_dict(chunk_id, doc.metadata, doc.page_content if include_content else None)
+                for chunk_id, doc in docs if doc is not None and chunk_id != TOMBSTONE_ID
+            ]
+        elif self.vectorstore_class == 'chroma':
+            include = ['metadatas', 'documents'] if include_content else ['metadatas']
+            docs = self.vectorstore._collection.get(offset=offset, limit=limit, include=include)
+            contents = docs['documents'] if include_content else [None] * len(docs['ids'])
+            return [
+                _document_dict(chunk_id, metadata or {}, content)
+                for chunk_id, metadata, content in zip(docs['ids'], docs['metadatas'], contents)
+            ]
+        elif self.vectorstore_class == 'milvus':
+            if self.vectorstore.col is None:
+                return []
+            rows = self.vectorstore.col.query(expr='', output_fields=self._milvus_output_fields(include_content), offset=offset, limit=limit)
+            return [self._milvus_document_dict(row, include_content) for row in rows]
+        return []
+
+    def iter_documents(self, page_size: int = 1000, include_content: bool = True):
+        """
+        Yield chunks page by page without materializing the whole store.
+        ストア全体を展開せず、ページ単位でチャンクを返すジェネレータ
+        """
+        if self.vectorstore_class == 'milvus' and self.vectorstore and self.vectorstore.col is not None:
+            # offset paging of Milvus is capped, the query iterator is not
+            iterator = self.vectorstore.col.query_iterator(batch_size=page_size, expr='', output_fields=self._milvus_output_fields(include_content))
+            try:
+                while True:
+                    rows = iterator.next()
+                    if not rows:
+                        return
+                    for row in rows:
+                        yield self._milvus_document_dict(row, include_content)
+            finally:
+                iterator.close()
+        offset = 0
+        while True:
+            page = self.get_documents_page(offset=offset, limit=page_size, include_content=include_content)
+            yield from page
+            offset += page_size
+            # FAISS pages are ranges of positions, which may be short because of deleted (tombstoned) positions
+            if self.vectorstore_class == 'faiss' and self.vectorstore is not None:
+                if offset >= len(self.vectorstore.index_to_docstore_id):
+                    return
+            elif len(page) < page_size:
+                return
+
+    def _milvus_output_fields(self, include_content: bool) -> List[str]:
+        excluded = {self.vectorstore._vector_field}
+        if not include_content:
+            excluded.add(self.vectorstore._text_field)
+        return [field for field in self.vectorstore.fields if field not in excluded]
+
+    def _milvus_document_dict(self, row: dict, include_content: bool) -> dict:
+        metadata = {key: value for key, value in row.items() if key not in {self.vectorstore._primary_field, self.vectorstore._text_field}}
+        content = row.get(self.vectorstore._text_field) if include_content else None
+        return _document_dict(row[self.vectorstore._primary_field], metadata, content)
+
     def get_all_documents(self):
-        res = []
-        if self.vectorstore:
-            if self.vectorstore_class == 'faiss':
-                docs = self.vectorstore.docstore.__dict__
-                for key, value in docs['_dict'].items():
-                    source = value.metadata['source']
-                    page = -1
-                    ext = os.path.splitext(source)[1]
-                    if ext == '.pdf':
-                        page = value.metadata.get('page', -1)
-                    elif ext in {'.doc', '.docx', '.ppt', '.pptx', 'xls', 'xlsx'}:
-                        page = value.metadata.get('page_number', -1)
-                    page_name = ''
-                    if ext in {'.xls', '.xlsx'}:
-                        page_name = value.metadata.get('page_name', '')
-                    res.append(
-                        {
-                            'id': key,
-                            'source': source,
-                            'page': page,
-                            'content': value.page_content,
-                            'page_name': page_name
-                        }
-                    )
-            elif self.vectorstore_class == 'chroma':
-                docs = self.vectorstore.get()
-                for id, metadata, document in zip(docs['ids'], docs['metadatas'], docs['documents']):
-                    source = metadata['source']
-                    page = -1
-                    ext = os.path.splitext(source)[1]
-                    if ext == '.pdf':
-                        page = metadata.get('page', -1)
-                    elif ext in {'.doc', '.docx', '.ppt', '.pptx', '.xls', '.xlsx'}:
-                        page = metadata.get('page_number', -1)
-                    page_name = ''
-                    if ext in {'.xls', '.xlsx'}:
-                        page_name = metadata.get('page_name', '')
-                    res.append(
-                        {
-                            'id': id,
-                            'source': source,
-                            'page': page,
-                            'content': document,
-                            'page_name': page_name
-                        }
-                    )
-            elif self.vectorstore_class == 'milvus':
-                # 取得する方法調査中 get_pksで直接idを取って来れるが
-                pass
-        return res
+        return list(self.iter_documents())
 
     def get_document_ids_from_source(self, filename):
         ids = []
         if self.vectorstore_class in {'faiss', 'chroma'}:
-            docs = self.get_all_documents()
-            for doc in docs:
-                if doc['source'] == filename:
-                    ids.append(doc['id'])
+            ids = self.source_index.get_ids(filename)
         elif self.vectorstore_class == 'milvus':
             ids = self.vectorstore.get_pks('source == {filename}'.format(filename=filename))
         return ids
 
     def delete_documents_from_ids(self, ids):
-        return self.vectorstore.delete(ids)
+        with self._lock:
+            if self.faiss_index:
+                self._ensure_writable()
+                res = self.faiss_index.delete(self.vectorstore, ids)
+            else:
+                res = self.vectorstore.delete(ids)
+            self._changed(len(ids))
+            self.source_index.remove(ids)
+            if self.lexical_index is not None:
+                self.lexical_index.remove(ids)
+            return res
 
     def delete_document_from_source(self, filename):
         ids = self.get_document_ids_from_source(filename)
-        return self.delete_documents_from_ids(ids)
+        if self.manifest.remove(filename):
+            self.manifest.save()
+        if not ids:
+            return False
+        res = self.delete_documents_from_ids(ids)
+        self._save_indexes()
+        return res
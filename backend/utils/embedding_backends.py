@@ -0,0 +1,90 @@
+import os
+import logging
+from typing import Optional, Tuple
+from langchain_huggingface import HuggingFaceEmbeddings
+
+logger = logging.getLogger(__name__)
+
+# default model of HuggingFaceEmbeddings
+DEFAULT_MODEL = 'sentence-transformers/all-mpnet-base-v2'
+# torch: full precision PyTorch (default)
+# torch-int8: PyTorch with Linear layers dynamically quantized to int8
+# onnx: ONNX Runtime
+# onnx-int8: ONNX Runtime with a dynamically int8-quantized model
+BACKENDS = ('torch', 'torch-int8', 'onnx', 'onnx-int8')
+
+
+class BackendEmbeddings(HuggingFaceEmbeddings):
+    """
+    HuggingFaceEmbeddings remembering the inference backend, so vectors of different backends are cached separately.
+    推論バックエンドを保持するHuggingFaceEmbeddings（バックエンド毎にベクトルを別々にキャッシュする）
+    """
+    backend: str = 'torch'
+    model_id: Optional[str] = None
+
+
+def _onnx_session_options(num_threads: Optional[int]) -> dict:
+    if not num_threads:
+        return {}
+    import onnxruntime
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = num_threads
+    # one model runs at a time, threads are better spent inside operators
+    session_options.inter_op_num_threads = 1
+    return {'session_options': session_options}
+
+
+def _quantized_onnx_model(model_name: str, quantization: str) -> Tuple[str, str]:
+    """
+    Return (model directory, ONNX file name) of the int8-quantized model, exporting it on first use.
+    int8量子化したモデルの(ディレクトリ, ONNXファイル名)を返す（初回利用時にエクスポートする）
+    """
+    file_suffix = 'int8_' + quantization
+    file_name = os.path.join('onnx', f'model_{file_suffix}.onnx')
+    if os.path.isdir(model_name):
+        directory = model_name
+    else:
+        directory = os.path.join(os.getenv('EMBEDDING_ONNX_DIR', './onnx_models'), model_name.replace('/', '__'))
+    if os.path.exists(os.path.join(directory, file_name)):
+        return directory, file_name
+
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+    logger.info('exporting %s to int8 ONNX (%s) into %s', model_name, quantization, directory)
+    model = SentenceTransformer(model_name, backend='onnx')
+    if directory != model_name:
+        model.save(directory)
+    export_dynamic_quantized_onnx_model(model, quantization_config=quantization, model_name_or_path=directory, file_suffix=file_suffix)
+    return directory, file_name
+
+
+def create_embeddings(backend: Optional[str] = None, model_name: Optional[str] = None, num_threads: Optional[int] = None) -> BackendEmbeddings:
+    """
+    Create the embedding model of the backend configured by environment variables (arguments take precedence).
+    環境変数で設定されたバックエンドの埋め込みモデルを作成する（引数が優先）
+
+    Args:
+        backend: one of BACKENDS (EMBEDDING_BACKEND)
+        model_name: sentence-transformers model name or directory (EMBEDDING_MODEL)
+        num_threads: intra-op threads of ONNX Runtime (EMBEDDING_THREADS, torch threads are set by EmbeddingEngine)
+    """
+    backend = (backend or os.getenv('EMBEDDING_BACKEND', 'torch')).lower()
+    if backend not in BACKENDS:
+        raise ValueError(f'Unsupported embedding backend: {backend} (supported: {", ".join(BACKENDS)})')
+    model_name = model_name or os.getenv('EMBEDDING_MODEL') or DEFAULT_MODEL
+    if num_threads is None and os.getenv('EMBEDDING_THREADS'):
+        num_threads = int(os.getenv('EMBEDDING_THREADS'))
+    # full precision torch keeps the model name as cache key, so existing caches stay valid
+    model_id = model_name if backend == 'torch' else f'{model_name}:{backend}'
+
+    if backend.startswith('onnx'):
+        onnx_kwargs = _onnx_session_options(num_threads)
+        path = model_name
+        if backend == 'onnx-int8':
+            path, onnx_kwargs['file_name'] = _quantized_onnx_model(model_name, os.getenv('EMBEDDING_ONNX_QUANTIZATION', 'avx2'))
+        return BackendEmbeddings(model_name=path, model_kwargs={'backend': 'onnx', 'model_kwargs': onnx_kwargs}, backend=backend, model_id=model_id)
+
+    embeddings = BackendEmbeddings(model_name=model_name, backend=backend, model_id=model_id)
+    if backend == 'torch-int8':
+        import torch
+        embeddings._client = torch.quantization.quantize_dynamic(embeddings._client, {torch.nn.Linear}, dtype=torch.qint8)
+    return embeddings
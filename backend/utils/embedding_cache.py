@@ -0,0 +1,286 @@
+import os
+import time
+import atexit
+import hashlib
+import sqlite3
+from threading import RLock
+from typing import Dict, List, Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+def get_model_id(embeddings) -> str:
+    return getattr(embeddings, 'model_id', None) or getattr(embeddings, 'model_name', None) or type(embeddings).__name__
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache: hash(model id, text) -> vector, shareable by the workers of one host.
+    Vectors live in a memory-mapped NumPy file, with a fingerprint of the key of each slot in a second one,
+    and the key -> slot index in SQLite (WAL). Slots are assigned in SQLite transactions, and a vector is only
+    returned when the fingerprint of its slot matches the key, so a slot reused by another worker or left
+    half-written by a crash is a miss, never a wrong vector.
+    モデルIDとテキストのハッシュをキーにしたベクトルのキャッシュ（同じホストのワーカー間で共有可能）。
+    ベクトルとスロット毎のキーの指紋はメモリマップしたNumPyファイル、キーとスロットの対応はSQLite（WAL）に保存する。
+    スロットの割り当てはSQLiteのトランザクションで行い、指紋がキーと一致する場合のみベクトルを返すため、
+    他のワーカーが再利用したスロットやクラッシュで書きかけのスロットはヒットしない。
+
+    Args:
+        directory: directory of the cache files
+        max_entries: size cap. The least recently used entries are evicted beyond it
+        flush_every: record the use of hit entries (for the LRU order) after this number of hits
+    """
+
+    def __init__(self, directory: str = './embedding_cache', max_entries: int = 200000, flush_every: int = 1000):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.vectors_path = os.path.join(directory, 'vectors.npy')
+        self.fingerprints_path = os.path.join(directory, 'fingerprints.npy')
+        self.index_path = os.path.join(directory, 'index.db')
+        os.makedirs(directory, exist_ok=True)
+        self._lock = RLock()
+        self._conn = sqlite3.connect(self.index_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA busy_timeout=10000')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS slots (slot INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE, used_at REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS slots_used_at ON slots (used_at)')
+        self._vectors = None
+        self._fingerprints = None
+        self._dim = None
+        self._touched = {}  # key -> last hit (written with the next flush)
+        self._hits = 0
+        self._misses = 0
+        self._load()
+        atexit.register(self.flush)
+
+    @staticmethod
+    def make_key(model_id: str, text: str, kind: str = 'document') -> str:
+        return hashlib.sha256(f'{model_id}\0{kind}\0{text}'.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def fingerprint(key: str) -> int:
+        # 0 marks an empty (or being written) slot
+        return int(key[:16], 16) or 1
+
+    def _meta(self) -> Dict[str, int]:
+        return dict(self._conn.execute('SELECT name, value FROM meta'))
+
+    def _load(self):
+        meta = self._meta()
+        if meta.get('max_entries') != self.max_entries or not (os.path.exists(self.vectors_path) and os.path.exists(self.fingerprints_path)):
+            # size cap changed or not created yet (created with the first vectors)
+            return
+        self._open(meta['dim'])
+
+    def _open(self, dim: int):
+        self._vectors = np.load(self.vectors_path, mmap_mode='r+')
+        self._fingerprints = np.load(self.fingerprints_path, mmap_mode='r+')
+        self._dim = dim
+
+    def _create(self, dim: int):
+        # written next to the files and renamed, so workers still mapping old files are not truncated under them
+        for path, dtype, shape in ((self.vectors_path, np.float32, (self.max_entries, dim)), (self.fingerprints_path, np.uint64, (self.max_entries,))):
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape).flush()
+            os.replace(tmp_path, path)
+        self._conn.execute('DELETE FROM slots')
+        self._conn.execute('DELETE FROM meta')
+        self._conn.executemany('INSERT INTO meta (name, value) VALUES (?, ?)', [('dim', dim), ('max_entries', self.max_entries)])
+
+    def _ensure_vectors(self, dim: int):
+        if self._vectors is not None:
+            return
+        # BEGIN IMMEDIATE serializes the creation between workers
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            meta = self._meta()
+            if meta.get('max_entries') != self.max_entries or not os.path.exists(self.vectors_path):
+                self._create(dim)
+                meta = {'dim': dim}
+            self._conn.execute('COMMIT')
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._open(meta['dim'])
+
+    def _read(self, slot: int, key: str) -> Optional[np.ndarray]:
+        # the fingerprint is checked before and after copying, so a slot rewritten meanwhile is a miss
+        expected = self.fingerprint(key)
+        if int(self._fingerprints[slot]) != expected:
+            return None
+        vector = np.array(self._vectors[slot])
+        return vector if int(self._fingerprints[slot]) == expected else None
+
+    def _write(self, slot: int, key: str, vector):
+        self._fingerprints[slot] = 0
+        self._vectors[slot] = np.asarray(vector, dtype=np.float32)
+        self._fingerprints[slot] = self.fingerprint(key)
+
+    def _lookup(self, keys: List[str]) -> Dict[str, int]:
+        slots = {}
+        unique = list(dict.fromkeys(keys))
+        for i in range(0, len(unique), 500):
+            chunk = unique[i:i + 500]
+            slots.update(self._conn.execute(f'SELECT key, slot FROM slots WHERE key IN ({",".join("?" * len(chunk))})', chunk))
+        return slots
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Return cached vectors of the keys (missing keys are omitted).
+        キャッシュ済みのベクトルを返す（存在しないキーは含まない）
+        """
+        res = {}
+        with self._lock:
+            if self._vectors is None:
+                self._load()
+            slots = self._lookup(keys) if self._vectors is not None else {}
+            now = time.time()
+            for key in keys:
+                slot = slots.get(key)
+                vector = self._read(slot, key) if slot is not None and slot < self.max_entries else None
+                if vector is None:
+                    self._misses += 1
+                    continue
+                res[key] = vector
+                self._touched[key] = now
+                self._hits += 1
+            if len(self._touched) >= self.flush_every:
+                self.flush()
+        return res
+
+    def put_many(self, keys: List[str], vectors: List[List[float]]):
+        """
+        Store vectors. The least recently used entries are evicted when the cache is full.
+        ベクトルを保存する。上限を超える場合は最も使われていないものから削除する
+        """
+        if not keys:
+            return
+        with self._lock:
+            self._ensure_vectors(len(vectors[0]))
+            items = {key: vector for key, vector in zip(keys, vectors) if len(vector) == self._dim}
+            if not items:
+                return
+            now = time.time()
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                assigned = self._lookup(list(items))
+                new_keys = [key for key in items if key not in assigned]
+                if new_keys:
+                    used = self._conn.execute('SELECT COUNT(*) FROM slots').fetchone()[0]
+                    free = list(range(used, min(used + len(new_keys), self.max_entries)))
+                    # the least recently used slots are reused beyond the cap
+                    evicted = [row[0] for row in self._conn.execute(
+                        'SELECT slot FROM slots ORDER BY used_at LIMIT ?', (len(new_keys) - len(free),)
+                    )] if len(free) < len(new_keys) else []
+                    self._conn.executemany('DELETE FROM slots WHERE slot = ?', [(slot,) for slot in evicted])
+                    for key, slot in zip(new_keys, free + evicted):
+                        assigned[key] = slot
+                    self._conn.executemany(
+                        'INSERT INTO slots (slot, key, used_at) VALUES (?, ?, ?)', [(assigned[key], key, now) for key in new_keys if key in assigned]
+                    )
+                # invalidated while the transaction holds the write lock, so no other worker hands out these slots meanwhile
+                for key, vector in items.items():
+                    if key in assigned:
+                        self._write(assigned[key], key, vector)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def flush(self):
+        """
+        Persist vectors and record the use of hit entries.
+        ベクトルを保存し、ヒットしたエントリの利用を記録する
+        """
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+                self._fingerprints.flush()
+            if self._touched:
+                touched, self._touched = self._touched, {}
+                self._conn.execute('BEGIN IMMEDIATE')
+                try:
+                    self._conn.executemany('UPDATE slots SET used_at = ? WHERE key = ?', [(used_at, key) for key, used_at in touched.items()])
+                    self._conn.execute('COMMIT')
+                except Exception:
+                    self._conn.execute('ROLLBACK')
+                    raise
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                'entries': self._conn.execute('SELECT COUNT(*) FROM slots').fetchone()[0],
+                'max_entries': self.max_entries,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / total, 4) if total else 0.0,
+            }
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper which skips model inference for cached texts.
+    キャッシュ済みのテキストはモデル推論を省略するEmbeddingsのラッパー
+    """
+
+    def __init__(self, embeddings, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_id = get_model_id(embeddings)
+
+    def __getattr__(self, name):
+        # expose attributes of the wrapped model (model_name, _client, ...)
+        if name in {'embeddings', 'cache', 'model_id'}:
+            raise AttributeError(name)
+        return getattr(self.embeddings, name)
+
+    def embed_documents(self, texts: List[str], embed_func=None) -> List[List[float]]:
+        return self._embed(texts, 'document', embed_func or self.embeddings.embed_documents)
+
+    def embed_queries(self, texts: List[str], embed_func=None) -> List[List[float]]:
+        """
+        Embed several queries, reusing cached query vectors.
+        複数のクエリを埋め込む（キャッシュ済みのクエリベクトルは再利用）
+        """
+        return self._embed(texts, 'query', embed_func or (lambda missing: [self.embeddings.embed_query(text) for text in missing]))
+
+    def cached_vectors(self, texts: List[str], kind: str = 'document') -> List[Optional[np.ndarray]]:
+        """
+        Return cached vectors of texts without running the model (None for texts not cached).
+        モデルを実行せずにキャッシュ済みのベクトルを返す（キャッシュにない場合None）
+        """
+        keys = [self.cache.make_key(self.model_id, text, kind=kind) for text in texts]
+        cached = self.cache.get_many(keys)
+        return [cached.get(key) for key in keys]
+
+    def _embed(self, texts: List[str], kind: str, embed_func) -> List[List[float]]:
+        keys = [self.cache.make_key(self.model_id, text, kind=kind) for text in texts]
+        cached = self.cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        vectors = [cached[key].tolist() if key in cached else None for key in keys]
+        if missing:
+            new_vectors = embed_func([texts[i] for i in missing])
+            for i, vector in zip(missing, new_vectors):
+                vectors[i] = list(vector)
+            self.cache.put_many([keys[i] for i in missing], new_vectors)
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_queries([text])[0]
+
+
+def create_embedding_cache(directory: Optional[str] = None) -> Optional[EmbeddingCache]:
+    """
+    Create an EmbeddingCache configured by environment variables (None when disabled).
+    環境変数の設定でEmbeddingCacheを作成する（無効の場合None）
+    """
+    if os.getenv('EMBEDDING_CACHE_ENABLED', 'true').lower() != 'true':
+        return None
+    return EmbeddingCache(
+        directory=directory or os.getenv('EMBEDDING_CACHE_DIR', './embedding_cache'),
+        max_entries=int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', '200000'))
+    )
@@ -0,0 +1,162 @@
+import os
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# embedding model of a worker process
+_worker_embeddings = None
+
+
+def _set_num_threads(num_threads: Optional[int]):
+    if not num_threads:
+        return
+    try:
+        import torch
+        torch.set_num_threads(num_threads)
+    except ImportError:
+        pass
+
+
+def _init_worker(model_name: str, backend: str, num_threads: Optional[int]):
+    global _worker_embeddings
+    from utils.embedding_backends import create_embeddings
+    _set_num_threads(num_threads)
+    _worker_embeddings = create_embeddings(backend=backend, model_name=model_name, num_threads=num_threads)
+
+
+def _embed_in_worker(texts: List[str]) -> List[List[float]]:
+    return _worker_embeddings.embed_documents(texts)
+
+
+class EmbeddingEngine:
+    """
+    Embed chunks in length-sorted batches to minimize padding.
+    チャンクを長さ順にバッチ化して埋め込み、パディングを最小化する
+
+    Args:
+        embeddings: LangChain embeddings
+        batch_size: number of chunks per forward pass
+        num_threads: intra-op threads of torch (None: library default)
+        num_processes: shard batches across this number of processes (0: embed in this process)
+        cached_embeddings: CachedEmbeddings of the model. Cached chunks skip inference
+    """
+
+    def __init__(self, embeddings, batch_size: int = 32, num_threads: Optional[int] = None, num_processes: int = 0, cached_embeddings=None):
+        self.embeddings = embeddings
+        self.cached_embeddings = cached_embeddings
+        self.batch_size = max(batch_size, 1)
+        self.num_threads = num_threads
+        self.num_processes = num_processes
+        self._pool = None
+        self._lock = Lock()
+        self._chunks = 0
+        self._seconds = 0.0
+        self._last_chunks_per_sec = 0.0
+        _set_num_threads(num_threads)
+
+    def _get_tokenizer(self):
+        client = getattr(self.embeddings, '_client', None)
+        return getattr(client, 'tokenizer', None)
+
+    def _lengths(self, texts: List[str]) -> List[int]:
+        tokenizer = self._get_tokenizer()
+        if tokenizer is not None:
+            try:
+                return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)['input_ids']]
+            except Exception:
+                pass
+        return [len(text) for text in texts]
+
+    def _get_pool(self):
+        model_name = getattr(self.embeddings, 'model_name', None)
+        if self.num_processes <= 0 or not model_name:
+            return None
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.num_processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(model_name, getattr(self.embeddings, 'backend', 'torch'), self.num_threads)
+            )
+        return self._pool
+
+    def make_batches(self, texts: List[str]) -> List[List[int]]:
+        """
+        Return batches of text indices sorted by token length.
+        トークン長でソートしたテキストのインデックスのバッチを返す
+        """
+        lengths = self._lengths(texts)
+        order = sorted(range(len(texts)), key=lambda i: lengths[i])
+        return [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed texts and return vectors in the original order.
+        テキストを埋め込み、元の順序でベクトルを返す
+        """
+        if not texts:
+            return []
+        if self.cached_embeddings is not None:
+            # only cache misses reach the model
+            return self.cached_embeddings.embed_documents(texts, embed_func=self._embed_batches)
+        return self._embed_batches(texts)
+
+    def _embed_batches(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        start = time.perf_counter()
+        batches = self.make_batches(texts)
+        vectors = [None] * len(texts)
+        pool = self._get_pool()
+        if pool is not None and len(batches) > 1:
+            results = pool.map(_embed_in_worker, [[texts[i] for i in batch] for batch in batches])
+        else:
+            results = (self.embeddings.embed_documents([texts[i] for i in batch]) for batch in batches)
+        for batch, batch_vectors in zip(batches, results):
+            for i, vector in zip(batch, batch_vectors):
+                vectors[i] = vector
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._chunks += len(texts)
+            self._seconds += elapsed
+            self._last_chunks_per_sec = len(texts) / elapsed if elapsed else 0.0
+        logger.info('embedded %d chunks in %.3fs (%.1f chunks/sec)', len(texts), elapsed, self._last_chunks_per_sec)
+        return vectors
+
+    def stats(self) -> dict:
+        """
+        Return throughput of the engine.
+        スループットを返す
+        """
+        with self._lock:
+            return {
+                'chunks': self._chunks,
+                'seconds': round(self._seconds, 3),
+                'chunks_per_sec': round(self._chunks / self._seconds, 2) if self._seconds else 0.0,
+                'last_chunks_per_sec': round(self._last_chunks_per_sec, 2),
+                'backend': getattr(self.embeddings, 'backend', 'torch'),
+                'batch_size': self.batch_size,
+                'num_threads': self.num_threads,
+                'num_processes': self.num_processes,
+            }
+
+
+def create_embedding_engine(embeddings, cached_embeddings=None) -> EmbeddingEngine:
+    """
+    Create an EmbeddingEngine configured by environment variables.
+    環境変数の設定でEmbeddingEngineを作成する
+    """
+    num_threads = os.getenv('EMBEDDING_THREADS')
+    return EmbeddingEngine(
+        embeddings=embeddings,
+        batch_size=int(os.getenv('EMBEDDING_BATCH_SIZE', '32')),
+        num_threads=int(num_threads) if num_threads else None,
+        num_processes=int(os.getenv('EMBEDDING_PROCESSES', '0')),
+        cached_embeddings=cached_embeddings
+    )
@@ -0,0 +1,139 @@
+import time
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from threading import Event, Lock
+from typing import Callable, Dict, Iterator, List
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Entry:
+    embedding: object
+    refs: int = 0
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class EmbeddingRegistry:
+    """
+    Per-tenant Embedding stores, loaded on first use and unloaded when idle or least recently used.
+    テナント毎のEmbeddingストア。初回利用時に読み込み、アイドル状態または最も使われていないものから解放する
+
+    Args:
+        factory: function(namespace) creating the Embedding of a tenant
+        max_loaded: max number of loaded tenants (stores in use are never unloaded)
+        idle_seconds: unload tenants unused for this number of seconds
+    """
+
+    def __init__(self, factory: Callable[[str], object], max_loaded: int = 8, idle_seconds: float = 900.0):
+        self.factory = factory
+        self.max_loaded = max(max_loaded, 1)
+        self.idle_seconds = idle_seconds
+        self._entries = OrderedDict()  # namespace -> _Entry (LRU order)
+        self._load_locks: Dict[str, list] = {}
+        # namespace -> set once its unloaded instance is closed (persisted)
+        self._closing: Dict[str, Event] = {}
+        self._lock = Lock()
+        self._loads = 0
+        self._unloads = 0
+
+    def _acquire(self, namespace: str) -> _Entry:
+        with self._lock:
+            entry = self._entries.get(namespace)
+            if entry is not None:
+                entry.refs += 1
+                self._entries.move_to_end(namespace)
+                return entry
+            # [lock, number of threads using it], dropped with the last one (also when loading fails)
+            load_lock = self._load_locks.setdefault(namespace, [Lock(), 0])
+            load_lock[1] += 1
+
+        try:
+            # load outside the registry lock, other tenants stay available meanwhile
+            with load_lock[0]:
+                with self._lock:
+                    entry = self._entries.get(namespace)
+                    if entry is not None:
+                        entry.refs += 1
+                        self._entries.move_to_end(namespace)
+                        return entry
+                    closing = self._closing.get(namespace)
+                # an unloaded instance may still be persisting, reload only once it is on disk
+                if closing is not None:
+                    closing.wait()
+                start = time.perf_counter()
+                embedding = self.factory(namespace)
+                logger.info('loaded vectorstore of tenant %s in %.3fs', namespace, time.perf_counter() - start)
+                with self._lock:
+                    entry = _Entry(embedding=embedding, refs=1)
+                    self._entries[namespace] = entry
+                    self._loads += 1
+        finally:
+            with self._lock:
+                load_lock[1] -= 1
+                if load_lock[1] == 0 and self._load_locks.get(namespace) is load_lock:
+                    del self._load_locks[namespace]
+        self._evict()
+        return entry
+
+    def _release(self, entry: _Entry):
+        with self._lock:
+            entry.refs -= 1
+            entry.last_used = time.monotonic()
+        self._evict()
+
+    @contextmanager
+    def use(self, namespace: str) -> Iterator[object]:
+        """
+        Yield the Embedding of the tenant, which is not unloaded while in use.
+        テナントのEmbeddingを返す（利用中は解放されない）
+        """
+        entry = self._acquire(namespace)
+        try:
+            yield entry.embedding
+        finally:
+            self._release(entry)
+
+    def _evict(self):
+        now = time.monotonic()
+        victims = []
+        with self._lock:
+            for namespace, entry in list(self._entries.items()):
+                if entry.refs > 0:
+                    continue
+                if len(self._entries) > self.max_loaded or now - entry.last_used >= self.idle_seconds:
+                    victims.append((namespace, self._entries.pop(namespace)))
+                    self._closing[namespace] = Event()
+            self._unloads += len(victims)
+        # persisting may take a while, close outside the lock
+        for namespace, entry in victims:
+            try:
+                entry.embedding.close()
+            except Exception:
+                logger.exception('failed to unload a tenant vectorstore')
+            finally:
+                with self._lock:
+                    self._closing.pop(namespace).set()
+
+    def loaded(self) -> List[str]:
+        with self._lock:
+            return list(self._entries)
+
+    def close(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            entry.embedding.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'loaded': len(self._entries),
+                'max_loaded': self.max_loaded,
+                'idle_seconds': self.idle_seconds,
+                'loads': self._loads,
+                'unloads': self._unloads,
+            }
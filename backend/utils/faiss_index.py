@@ -0,0 +1,384 @@
+import os
+import re
+import logging
+from typing import Dict, List, Optional, Set
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# vector storage -> FAISS scalar quantizer
+STORAGE_CODECS = {'float32': None, 'float16': 'SQfp16', 'int8': 'SQ8'}
+# docstore id of deleted positions of indexes which cannot remove vectors (HNSW); they are excluded from searches
+TOMBSTONE_ID = '__faiss_tombstone__'
+
+
+def apply_storage(factory: str, storage: str) -> str:
+    """
+    Return the factory string storing vectors as float16 / int8 ("Flat" -> "SQ8", "IVF1024,Flat" -> "IVF1024,SQ8", "HNSW32" -> "HNSW32,SQ8").
+    Factories with their own codec (PQ, SQ) are kept as is.
+    float16 / int8でベクトルを保存するファクトリ文字列を返す（PQ・SQを指定済みの場合はそのまま）
+    """
+    if storage not in STORAGE_CODECS:
+        raise ValueError(f'Unsupported vector storage: {storage} (supported: {", ".join(STORAGE_CODECS)})')
+    codec = STORAGE_CODECS[storage]
+    factory = factory.strip() or 'Flat'
+    if codec is None or re.search(r'PQ|SQ', factory):
+        return factory
+    if factory.lower() == 'flat':
+        return codec
+    if factory.endswith(',Flat'):
+        return factory[:-len('Flat')] + codec
+    if re.fullmatch(r'HNSW\d*', factory):
+        return factory + ',' + codec
+    return factory
+
+
+def bytes_per_vector(index) -> int:
+    """
+    Return the size of one stored vector code (HNSW links and IVF list ids are not included).
+    保存されたベクトル1件のコードサイズを返す（HNSWのリンク・IVFのIDは含まない）
+    """
+    import faiss
+    index = faiss.downcast_index(index)
+    storage = getattr(index, 'storage', None)
+    if storage is not None:
+        # HNSW keeps the vectors in a flat-coded storage index
+        index = faiss.downcast_index(storage)
+    code_size = getattr(index, 'code_size', None)
+    return int(code_size) if code_size else index.d * 4
+
+
+class FaissIndexManager:
+    """
+    Build and tune the FAISS index of a LangChain FAISS vectorstore from an index factory string.
+    インデックスファクトリ文字列からLangChain FAISSのインデックスを構築・調整する
+
+    The store starts with a flat index. Once it holds enough vectors to train the configured index
+    (IVF centroids, PQ / SQ codebooks), the vectors are moved into it in the same order, so
+    index_to_docstore_id stays valid.
+    ストアはフラットインデックスで開始し、学習に十分なベクトルが集まった時点で設定したインデックスへ同じ順序で移し替える
+
+    Args:
+        factory: FAISS index factory string, e.g. "Flat", "HNSW32", "IVF1024,Flat", "IVF1024,PQ32", "SQ8", "HNSW32,SQ8"
+        nprobe: number of IVF lists visited per query
+        ef_search: HNSW candidate list size per query
+        train_min_vectors: vectors needed before moving to the configured index (None: derived from the factory)
+        storage: "float32", "float16" or "int8" (scalar quantized) vector codes
+        rescore_factor: candidates fetched per result and re-ranked with full precision vectors when storage is compressed
+        max_tombstone_ratio: share of deleted (tombstoned) HNSW vectors which triggers a rebuild without them
+    """
+
+    def __init__(self, factory: str = 'Flat', nprobe: int = 16, ef_search: int = 64, train_min_vectors: Optional[int] = None,
+                 storage: str = 'float32', rescore_factor: int = 4, max_tombstone_ratio: float = 0.2):
+        self.storage = storage
+        self.max_tombstone_ratio = max_tombstone_ratio
+        self.factory = apply_storage(factory, storage)
+        self.rescore_factor = max(rescore_factor, 1)
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.train_min_vectors = train_min_vectors if train_min_vectors is not None else self._default_train_min_vectors()
+
+    @property
+    def is_flat(self) -> bool:
+        return self.factory.lower() == 'flat'
+
+    def _default_train_min_vectors(self) -> int:
+        # FAISS warns below ~39 training points per centroid
+        minimum = 0
+        ivf = re.search(r'IVF(\d+)', self.factory)
+        if ivf:
+            minimum = max(minimum, 39 * int(ivf.group(1)))
+        pq = re.search(r'PQ\d+(?:x(\d+))?', self.factory)
+        if pq:
+            minimum = max(minimum, 39 * 2 ** int(pq.group(1) or 8))
+        if re.search(r'SQ\d', self.factory):
+            minimum = max(minimum, 1000)
+        return minimum
+
+    def is_upgraded(self, index) -> bool:
+        import faiss
+        return not isinstance(faiss.downcast_index(index), faiss.IndexFlat)
+
+    def is_compressed(self, index) -> bool:
+        return self.storage != 'float32' and self.is_upgraded(index)
+
+    def _build(self, vectors: np.ndarray, metric_type):
+        import faiss
+        index = faiss.index_factory(vectors.shape[1], self.factory, metric_type)
+        if not index.is_trained:
+            index.train(vectors)
+        self._enable_reconstruct(index)
+        index.add(vectors)
+        self.tune(index)
+        return index
+
+    def maybe_upgrade(self, vectorstore) -> bool:
+        """
+        Move the vectors of a flat index into the configured index once enough vectors exist.
+        十分なベクトルが集まったら、フラットインデックスのベクトルを設定したインデックスへ移す
+        """
+        index = vectorstore.index
+        if self.is_flat or self.is_upgraded(index) or index.ntotal == 0 or index.ntotal < self.train_min_vectors:
+            return False
+        new_index = self._build(index.reconstruct_n(0, index.ntotal), index.metric_type)
+        vectorstore.index = new_index
+        logger.info('moved %d vectors into a %s index', index.ntotal, self.factory)
+        return True
+
+    def _enable_reconstruct(self, index):
+        import faiss
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+            # IVF indexes need a direct map to reconstruct vectors on delete
+            ivf.make_direct_map()
+
+    def tune(self, index):
+        """
+        Apply nprobe / efSearch to the index (parameters the index does not have are ignored).
+        nprobe / efSearchをインデックスに設定する（該当しないパラメータは無視）
+        """
+        import faiss
+        params = faiss.ParameterSpace()
+        for name, value in (('nprobe', self.nprobe), ('efSearch', self.ef_search)):
+            try:
+                params.set_index_parameter(index, name, value)
+            except RuntimeError:
+                pass
+
+    # ----------------------------
+    # deletion
+    # ----------------------------
+    def _state(self, vectorstore) -> dict:
+        # position lookup and tombstones of the store, derived once and kept up to date by add (appends) and delete
+        mapping = vectorstore.index_to_docstore_id
+        state = getattr(vectorstore, '_faiss_index_state', None)
+        if state is None or state['mapping'] is not mapping:
+            state = {'mapping': mapping, 'positions': {}, 'tombstones': set(), 'scanned': 0, 'selector': None}
+            vectorstore._faiss_index_state = state
+        # chunks added since the last call were appended at the next positions
+        for position in range(state['scanned'], len(mapping)):
+            chunk_id = mapping[position]
+            if chunk_id == TOMBSTONE_ID:
+                state['tombstones'].add(position)
+            else:
+                state['positions'][chunk_id] = position
+        state['scanned'] = len(mapping)
+        return state
+
+    def tombstones(self, vectorstore) -> Set[int]:
+        return self._state(vectorstore)['tombstones']
+
+    def live_count(self, vectorstore) -> int:
+        """
+        Return the number of chunks in the store (tombstoned positions excluded).
+        ストアのチャンク数を返す（削除済みの位置は含まない）
+        """
+        return len(vectorstore.index_to_docstore_id) - len(self.tombstones(vectorstore))
+
+    def search(self, vectorstore, vector: List[float], k: int) -> list:
+        """
+        similarity_search_with_score_by_vector of the store, skipping tombstoned positions.
+        削除済みの位置を除いてsimilarity_search_with_score_by_vectorを実行する
+        """
+        state = self._state(vectorstore)
+        if not state['tombstones']:
+            return vectorstore.similarity_search_with_score_by_vector(vector, k=k)
+        import faiss
+        if state['selector'] is None:
+            removed = np.array(sorted(state['tombstones']), dtype=np.int64)
+            state['selector'] = (faiss.IDSelectorNot(faiss.IDSelectorBatch(removed)), removed)
+        params = faiss.SearchParametersHNSW()
+        params.sel = state['selector'][0]
+        params.efSearch = self.ef_search
+        query = np.array([vector], dtype=np.float32)
+        if getattr(vectorstore, '_normalize_L2', False):
+            faiss.normalize_L2(query)
+        scores, positions = vectorstore.index.search(query, k, params=params)
+        docstore = vectorstore.docstore._dict
+        return [
+            (docstore[state['mapping'][position]], float(score))
+            for score, position in zip(scores[0], positions[0]) if position != -1
+        ]
+
+    def delete(self, vectorstore, ids: List[str]):
+        """
+        Delete chunks from the vectorstore without touching the other vectors.
+        Flat-coded indexes (Flat, PQ, SQ) remove in place. IVF indexes remove the vectors by id and move as many
+        vectors from the end into the freed positions. HNSW cannot remove vectors, so their positions are tombstoned
+        and excluded from searches, and the index is rebuilt once tombstones exceed max_tombstone_ratio.
+        ベクターストアからチャンクを削除する。IVFはIDで削除し末尾のベクトルを空いた位置へ移す。
+        HNSWは削除した位置を墓標として検索から除外し、一定の割合を超えたら再構築する
+        """
+        import faiss
+        index = faiss.downcast_index(vectorstore.index)
+        if isinstance(index, faiss.IndexFlatCodes):
+            return vectorstore.delete(ids)
+
+        state = self._state(vectorstore)
+        missing = [chunk_id for chunk_id in ids if chunk_id not in state['positions']]
+        if missing:
+            raise ValueError(f'Some specified ids do not exist in the current store. Ids not found: {missing}')
+        removed = sorted({state['positions'][chunk_id] for chunk_id in ids})
+        if faiss.try_extract_index_ivf(vectorstore.index) is not None:
+            self._delete_ivf(vectorstore, state, removed)
+        elif isinstance(index, faiss.IndexHNSW):
+            self._tombstone(vectorstore, state, removed)
+        else:
+            self._rebuild(vectorstore, set(removed))
+        vectorstore.docstore.delete(ids)
+        return True
+
+    def _delete_ivf(self, vectorstore, state: dict, removed: List[int]):
+        import faiss
+        index = vectorstore.index
+        ivf = faiss.extract_index_ivf(index)
+        self._enable_reconstruct(index)
+        mapping = state['mapping']
+        # positions stay 0..n-1 (LangChain appends at len(index_to_docstore_id)):
+        # the last vectors are moved into the freed positions below the new size
+        size = index.ntotal - len(removed)
+        removed_set = set(removed)
+        holes = [position for position in removed if position < size]
+        tail = [position for position in range(size, index.ntotal) if position not in removed_set]
+        moved = index.reconstruct_batch(np.array(tail, dtype=np.int64)) if tail else None
+        # the array direct map supports neither remove_ids nor add_with_ids: removal scans the ids of the lists
+        # (no vector is decoded or re-encoded) and the map is rebuilt from them afterwards
+        ivf.set_direct_map_type(faiss.DirectMap.NoMap)
+        index.remove_ids(faiss.IDSelectorBatch(np.array(removed + tail, dtype=np.int64)))
+        if tail:
+            index.add_with_ids(moved, np.array(holes, dtype=np.int64))
+        ivf.make_direct_map()
+        for position in removed:
+            del state['positions'][mapping[position]]
+        for hole, position in zip(holes, tail):
+            mapping[hole] = mapping[position]
+            state['positions'][mapping[hole]] = hole
+        for position in range(size, size + len(removed)):
+            del mapping[position]
+        state['scanned'] = len(mapping)
+
+    def _tombstone(self, vectorstore, state: dict, removed: List[int]):
+        from langchain_core.documents import Document
+        mapping = state['mapping']
+        for position in removed:
+            state['positions'].pop(mapping[position], None)
+            mapping[position] = TOMBSTONE_ID
+        state['tombstones'].update(removed)
+        state['selector'] = None
+        if TOMBSTONE_ID not in vectorstore.docstore._dict:
+            vectorstore.docstore.add({TOMBSTONE_ID: Document(page_content='', id=TOMBSTONE_ID)})
+        if len(state['tombstones']) > self.max_tombstone_ratio * vectorstore.index.ntotal:
+            self._rebuild(vectorstore, set(state['tombstones']))
+
+    def _rebuild(self, vectorstore, removed: Set[int]):
+        import faiss
+        index = vectorstore.index
+        keep = [position for position in range(index.ntotal) if position not in removed]
+        new_index = faiss.clone_index(index)
+        new_index.reset()
+        self._enable_reconstruct(new_index)
+        if keep:
+            new_index.add(index.reconstruct_batch(np.array(keep, dtype=np.int64)))
+        self.tune(new_index)
+        mapping = vectorstore.index_to_docstore_id
+        vectorstore.index_to_docstore_id = {i: mapping[position] for i, position in enumerate(keep)}
+        vectorstore.index = new_index
+        if TOMBSTONE_ID in vectorstore.docstore._dict:
+            vectorstore.docstore.delete([TOMBSTONE_ID])
+        logger.info('rebuilt the %s index without %d deleted vectors', self.factory, len(removed))
+
+    def rescore(self, vectorstore, query: List[float], pairs: list, vectors: list) -> list:
+        """
+        Re-rank (document, score) pairs of a compressed index with full precision vectors (None: keep the approximate score).
+        Scores are raw FAISS scores as returned by similarity_search_with_score_by_vector.
+        圧縮したインデックスの検索結果を、フル精度のベクトルで再スコアリングする（Noneの場合は近似スコアのまま）
+        """
+        import faiss
+        inner_product = vectorstore.index.metric_type == faiss.METRIC_INNER_PRODUCT
+        normalize = getattr(vectorstore, '_normalize_L2', False)
+        query = np.asarray(query, dtype=np.float32)
+        if normalize:
+            query = query / max(np.linalg.norm(query), 1e-12)
+        res = []
+        for (doc, score), vector in zip(pairs, vectors):
+            if vector is not None:
+                vector = np.asarray(vector, dtype=np.float32)
+                if normalize:
+                    vector = vector / max(np.linalg.norm(vector), 1e-12)
+                score = float(query @ vector) if inner_product else float(np.sum((query - vector) ** 2))
+            res.append((doc, score))
+        res.sort(key=lambda pair: pair[1], reverse=inner_product)
+        return res
+
+    def measure_recall(self, vectors: np.ndarray, metric_type, k: int = 10, queries: int = 50) -> dict:
+        """
+        Measure recall@k of the configured index against exact float32 search, using sampled vectors as queries
+        (each query is excluded from its own results).
+        サンプルしたベクトルをクエリとして、設定したインデックスのrecall@kをfloat32の全探索と比較して測定する
+        """
+        import faiss
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        count = vectors.shape[0]
+        if count <= k or count < self.train_min_vectors:
+            return {'sample': count, 'recall': None, 'recall_rescored': None}
+        query_ids = np.random.default_rng(0).choice(count, size=min(queries, count), replace=False)
+        query_vectors = vectors[query_ids]
+        exact = faiss.IndexFlat(vectors.shape[1], metric_type)
+        exact.add(vectors)
+        _, expected = exact.search(query_vectors, k + 1)
+        _, candidates = self._build(vectors, metric_type).search(query_vectors, (k + 1) * self.rescore_factor)
+
+        def top(ids: np.ndarray, query_id: int) -> List[int]:
+            return [i for i in ids if i >= 0 and i != query_id][:k]
+
+        def exact_order(ids: np.ndarray, query: np.ndarray) -> np.ndarray:
+            ids = ids[ids >= 0]
+            if metric_type == faiss.METRIC_INNER_PRODUCT:
+                return ids[np.argsort(-(vectors[ids] @ query))]
+            return ids[np.argsort(np.sum((vectors[ids] - query) ** 2, axis=1))]
+
+        recall, recall_rescored = [], []
+        for query_id, query, truth, ids in zip(query_ids, query_vectors, expected, candidates):
+            truth = set(top(truth, query_id))
+            recall.append(len(truth & set(top(ids[:k + 1], query_id))) / k)
+            recall_rescored.append(len(truth & set(top(exact_order(ids, query), query_id))) / k)
+        return {
+            'sample': count,
+            'k': k,
+            'recall': round(float(np.mean(recall)), 4),
+            'recall_rescored': round(float(np.mean(recall_rescored)), 4),
+        }
+
+    def stats(self, index) -> dict:
+        import faiss
+        return {
+            'factory': self.factory,
+            'storage': self.storage,
+            'bytes_per_vector': bytes_per_vector(index) if index is not None else None,
+            'float32_bytes_per_vector': index.d * 4 if index is not None else None,
+            'rescore_factor': self.rescore_factor,
+            'index_type': type(faiss.downcast_index(index)).__name__ if index is not None else None,
+            'upgraded': index is not None and self.is_upgraded(index),
+            'ntotal': index.ntotal if index is not None else 0,
+            'max_tombstone_ratio': self.max_tombstone_ratio,
+            'train_min_vectors': self.train_min_vectors,
+            'nprobe': self.nprobe,
+            'ef_search': self.ef_search,
+        }
+
+
+def create_faiss_index_manager() -> FaissIndexManager:
+    """
+    Create a FaissIndexManager configured by environment variables.
+    環境変数の設定でFaissIndexManagerを作成する
+    """
+    train_min_vectors = os.getenv('FAISS_TRAIN_MIN_VECTORS')
+    return FaissIndexManager(
+        factory=os.getenv('FAISS_INDEX_FACTORY', 'Flat'),
+        nprobe=int(os.getenv('FAISS_NPROBE', '16')),
+        ef_search=int(os.getenv('FAISS_EF_SEARCH', '64')),
+        train_min_vectors=int(train_min_vectors) if train_min_vectors else None,
+        storage=os.getenv('VECTOR_STORAGE', 'float32').lower(),
+        rescore_factor=int(os.getenv('VECTOR_RESCORE_FACTOR', '4')),
+        max_tombstone_ratio=float(os.getenv('FAISS_MAX_TOMBSTONE_RATIO', '0.2'))
+    )
@@ -0,0 +1,199 @@
+import os
+import time
+import pickle
+import shutil
+import logging
+from threading import Condition, Thread
+from typing import Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = 'index.faiss'
+DOCSTORE_FILE = 'index.pkl'
+
+
+class FaissSnapshots:
+    """
+    Versioned snapshots of a FAISS store: snapshots/<name>/{index.faiss, index.pkl} plus a CURRENT file naming the live one.
+    A snapshot is written to a temporary directory, renamed into place and then published by replacing CURRENT,
+    so readers never see a partially written store.
+    Snapshots are whole stores, so a store must have a single writer: with several uvicorn workers, the last snapshot
+    published wins and the changes of the other workers are lost on reload. Run ingestion in one process
+    (e.g. the RAG server, RAG_SERVER_URL); the other processes may load the snapshots read-only.
+    FAISSストアのスナップショット。一時ディレクトリに書き込んでから名前を変更し、CURRENTを置き換えて公開するため、
+    書き込み途中のストアが読まれることはない。
+    スナップショットはストア全体のため、書き込みは1プロセスに限ること（複数のワーカーが書き込むと最後に公開したものが残り、
+    他のワーカーの変更は失われる）。取り込みはRAGサーバー（RAG_SERVER_URL）などの1プロセスで行う
+
+    Args:
+        directory: persist directory of the store
+        keep: number of snapshots kept
+    """
+
+    def __init__(self, directory: str, keep: int = 2):
+        self.directory = directory
+        self.keep = max(keep, 1)
+        self.snapshots_directory = os.path.join(directory, 'snapshots')
+        self.current_file = os.path.join(directory, 'CURRENT')
+
+    def current_name(self) -> Optional[str]:
+        """
+        Return the name of the live snapshot (None for stores saved by save_local or not saved yet).
+        公開中のスナップショットの名前を返す（save_localで保存された旧形式、または未保存の場合はNone）
+        """
+        try:
+            with open(self.current_file, 'r', encoding='utf-8') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def current_path(self) -> Optional[str]:
+        """
+        Return the directory of the live snapshot (the persist directory itself for stores saved by save_local).
+        公開中のスナップショットのディレクトリを返す（save_localで保存された旧形式は永続化ディレクトリ）
+        """
+        name = self.current_name()
+        if name is not None:
+            path = os.path.join(self.snapshots_directory, name)
+            if os.path.exists(os.path.join(path, INDEX_FILE)):
+                return path
+        if os.path.exists(os.path.join(self.directory, INDEX_FILE)):
+            return self.directory
+        return None
+
+    def exists(self) -> bool:
+        return self.current_path() is not None
+
+    def write(self, index_bytes, docstore_bytes: bytes) -> str:
+        """
+        Write serialized index and docstore as a new snapshot and publish it.
+        シリアライズ済みのインデックスとdocstoreを新しいスナップショットとして書き込み、公開する
+        """
+        name = str(time.time_ns())
+        path = os.path.join(self.snapshots_directory, name)
+        tmp_path = os.path.join(self.snapshots_directory, '.' + name + '.tmp')
+        os.makedirs(tmp_path, exist_ok=True)
+        for file_name, data in ((INDEX_FILE, index_bytes), (DOCSTORE_FILE, docstore_bytes)):
+            with open(os.path.join(tmp_path, file_name), 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        tmp_current = self.current_file + '.tmp'
+        with open(tmp_current, 'w', encoding='utf-8') as f:
+            f.write(name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_current, self.current_file)
+        self._prune(name)
+        return path
+
+    def _prune(self, current: str):
+        names = sorted((name for name in os.listdir(self.snapshots_directory) if not name.startswith('.')), key=int)
+        for name in names[:max(len(names) - self.keep, 0)]:
+            if name != current:
+                shutil.rmtree(os.path.join(self.snapshots_directory, name), ignore_errors=True)
+
+    @staticmethod
+    def read_index(path: str, mmap: bool = False):
+        """
+        Read the index of a snapshot. mmap=True maps it read-only, so processes loading the same snapshot share pages.
+        スナップショットのインデックスを読み込む。mmap=Trueでは読み取り専用でメモリマップし、同じスナップショットを読むプロセス間でページを共有する
+        """
+        import faiss
+        index_path = os.path.join(path, INDEX_FILE)
+        if mmap:
+            flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, 'IO_FLAG_MMAP_IFC', 0)
+            try:
+                return faiss.read_index(index_path, flags)
+            except RuntimeError as e:
+                # index types without mmap support are read into memory
+                logger.info('could not mmap %s: %s', index_path, e)
+        return faiss.read_index(index_path)
+
+    def load(self, embeddings, mmap: bool = False) -> Tuple[object, Optional[str]]:
+        """
+        Load the live snapshot as a LangChain FAISS store and return (store, snapshot path).
+        公開中のスナップショットをLangChainのFAISSストアとして読み込み、(ストア, スナップショットのパス)を返す
+        """
+        from langchain_community.vectorstores.faiss import FAISS
+        path = self.current_path()
+        if path is None:
+            return None, None
+        index = self.read_index(path, mmap=mmap)
+        # written by this class or FAISS.save_local, never by users
+        with open(os.path.join(path, DOCSTORE_FILE), 'rb') as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        return FAISS(embedding_function=embeddings, index=index, docstore=docstore, index_to_docstore_id=index_to_docstore_id), path
+
+
+class WriteBehind:
+    """
+    Run a snapshot function in the background after a number of changes or an interval since the first unsaved change.
+    一定数の変更、または最初の未保存の変更から一定時間が経過した時点で、バックグラウンドでスナップショット関数を実行する
+
+    Args:
+        snapshot_func: function writing a snapshot
+        every_changes: snapshot after this number of changed chunks
+        interval: snapshot at the latest this number of seconds after the first unsaved change
+    """
+
+    def __init__(self, snapshot_func: Callable[[], object], every_changes: int = 1000, interval: float = 30.0):
+        self.snapshot_func = snapshot_func
+        self.every_changes = max(every_changes, 1)
+        self.interval = interval
+        self._condition = Condition()
+        self._changes = 0
+        self._dirty_since = None
+        self._closed = False
+        self._thread = Thread(target=self._run, name='faiss-write-behind', daemon=True)
+        self._thread.start()
+
+    def mark(self, changes: int = 1):
+        with self._condition:
+            self._changes += changes
+            if self._dirty_since is None:
+                # wake the writer to start the interval timer
+                self._dirty_since = time.monotonic()
+                self._condition.notify()
+            elif self._changes >= self.every_changes:
+                self._condition.notify()
+
+    def _due(self) -> bool:
+        if not self._changes:
+            return False
+        return self._changes >= self.every_changes or time.monotonic() - self._dirty_since >= self.interval
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and not self._due():
+                    timeout = None if self._dirty_since is None else max(self.interval - (time.monotonic() - self._dirty_since), 0.0)
+                    self._condition.wait(timeout)
+                if self._closed:
+                    return
+                self._changes = 0
+                self._dirty_since = None
+            try:
+                self.snapshot_func()
+            except Exception:
+                logger.exception('failed to write snapshot')
+                self.mark()
+
+    def flush(self, force: bool = False):
+        """
+        Write pending changes now (force: even without changes).
+        未保存の変更を直ちに書き込む（force: 変更がなくても書き込む）
+        """
+        with self._condition:
+            pending = self._changes
+            self._changes = 0
+            self._dirty_since = None
+        if pending or force:
+            self.snapshot_func()
+
+    def close(self):
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
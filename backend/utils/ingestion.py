@@ -0,0 +1,228 @@
+import os
+import json
+import queue
+import sqlite3
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field, asdict, fields
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Optional
+
+
+class IngestionQueueFull(Exception):
+    pass
+
+
+@dataclass
+class IngestionJob:
+    job_id: str
+    file_paths: List[str]
+    status: str = "queued"  # queued, running, succeeded, failed
+    options: dict = field(default_factory=dict)
+    files_total: int = 0
+    files_done: int = 0
+    files_failed: List[str] = field(default_factory=list)
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    @property
+    def progress(self) -> float:
+        return round(self.files_done / self.files_total, 4) if self.files_total else 1.0
+
+    def to_dict(self) -> dict:
+        res = asdict(self)
+        res.pop("options")
+        res["progress"] = self.progress
+        return res
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "IngestionJob":
+        names = {f.name for f in fields(cls)}
+        return cls(**{name: value for name, value in data.items() if name in names})
+
+
+# ----------------------------
+# Job Store
+# ----------------------------
+class IngestionJobStore:
+    """
+    Job states in SQLite (WAL), so any uvicorn worker answers status and progress of jobs run by another one.
+    ジョブの状態をSQLite（WAL）に保存し、別のワーカーが実行中のジョブの状態・進捗にもどのワーカーからでも応答する
+
+    Args:
+        path: SQLite database file
+    """
+
+    def __init__(self, path: str = "./ingestion_jobs/jobs.db"):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, status TEXT NOT NULL, data TEXT NOT NULL, created_at REAL NOT NULL, finished_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at) WHERE finished_at IS NOT NULL")
+        self._lock = Lock()
+
+    def save(self, job: IngestionJob):
+        data = asdict(job)
+        # options hold arguments of the ingestion, not its state
+        data.pop("options")
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, status, data, created_at, finished_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (job_id) DO UPDATE SET status = excluded.status, data = excluded.data, finished_at = excluded.finished_at",
+                (job.job_id, job.status, json.dumps(data, ensure_ascii=False), job.created_at, job.finished_at)
+            )
+
+    def load(self, job_id: str) -> Optional[IngestionJob]:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return IngestionJob.from_dict(json.loads(row[0])) if row else None
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def trim(self, max_finished_jobs: int):
+        # keep the latest finished jobs
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM jobs WHERE finished_at IS NOT NULL AND job_id NOT IN "
+                "(SELECT job_id FROM jobs WHERE finished_at IS NOT NULL ORDER BY finished_at DESC LIMIT ?)",
+                (max_finished_jobs,)
+            )
+
+
+def create_ingestion_job_store() -> Optional[IngestionJobStore]:
+    """
+    Create the shared job store configured by INGESTION_JOBS_PATH (empty: jobs are kept in each process).
+    INGESTION_JOBS_PATHの設定で共有ジョブストアを作成する（空の場合はプロセス毎に保持）
+    """
+    path = os.getenv("INGESTION_JOBS_PATH", "./ingestion_jobs/jobs.db")
+    return IngestionJobStore(path) if path else None
+
+
+# ----------------------------
+# Ingestion Queue
+# ----------------------------
+class IngestionQueue:
+    """
+    Bounded job queue which loads, splits and embeds uploaded files off the request path.
+    アップロードされたファイルの読み込み・分割・埋め込みをリクエスト処理外で行うジョブキュー
+
+    Args:
+        ingest_func: function(file_paths, on_file_done, **options) adding files to the vectorstore.
+            on_file_done(file_path, ok) must be called when each file finishes
+        max_queue_size: max number of waiting jobs. submit() raises IngestionQueueFull beyond it
+        num_workers: number of worker threads
+        max_finished_jobs: number of finished jobs kept for the status API
+        job_store: store shared by the API workers; jobs of other workers are read from it (None: this process only)
+    """
+
+    def __init__(self, ingest_func: Callable[..., object], max_queue_size: int = 16, num_workers: int = 1, max_finished_jobs: int = 1000,
+                 job_store: Optional[IngestionJobStore] = None):
+        self.ingest_func = ingest_func
+        self.max_finished_jobs = max_finished_jobs
+        self.job_store = job_store
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._jobs = OrderedDict()
+        self._lock = Lock()
+        self._workers = [Thread(target=self._work, name=f"ingestion-{i}", daemon=True) for i in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, file_paths: List[str], **options) -> IngestionJob:
+        """
+        Queue files for ingestion and return the job at once. options are passed to ingest_func.
+        ファイルを取り込みキューに追加し、ジョブを即座に返す。optionsはingest_funcに渡す
+        """
+        job = IngestionJob(job_id=uuid.uuid4().hex, file_paths=list(file_paths), options=options, files_total=len(file_paths))
+        with self._lock:
+            try:
+                self._queue.put_nowait(job.job_id)
+            except queue.Full:
+                raise IngestionQueueFull(f"Ingestion queue is full ({self._queue.maxsize} jobs).")
+            self._jobs[job.job_id] = job
+            self._trim()
+        self._save(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        """
+        Return the job, also when another worker runs it (with a job store).
+        ジョブを返す（ジョブストアがあれば別のワーカーが実行中のジョブも返す）
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.job_store is not None:
+            job = self.job_store.load(job_id)
+        return job
+
+    def _save(self, job: IngestionJob):
+        if self.job_store is not None:
+            self.job_store.save(job)
+
+    def stats(self) -> dict:
+        # job counts of all workers with a job store, the queue is this worker's
+        store_counts = self.job_store.counts() if self.job_store is not None else None
+        with self._lock:
+            counts = store_counts
+            if counts is None:
+                counts = {}
+                for job in self._jobs.values():
+                    counts[job.status] = counts.get(job.status, 0) + 1
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue_size": self._queue.maxsize,
+                "workers": len(self._workers),
+                "jobs": counts,
+            }
+
+    def _trim(self):
+        finished = [jid for jid, job in self._jobs.items() if job.status in {"succeeded", "failed"}]
+        for jid in finished[:max(len(finished) - self.max_finished_jobs, 0)]:
+            del self._jobs[jid]
+        if self.job_store is not None and finished:
+            self.job_store.trim(self.max_finished_jobs)
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            job = self.get(job_id)
+            try:
+                if job is not None:
+                    self._run(job)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job: IngestionJob):
+        job.status = "running"
+        job.started_at = time.time()
+        self._save(job)
+        done = set()
+
+        def on_file_done(file_path: str, ok: bool):
+            done.add(file_path)
+            job.files_done = len(done)
+            if not ok:
+                job.files_failed.append(file_path)
+            self._save(job)
+
+        try:
+            self.ingest_func(job.file_paths, on_file_done, **job.options)
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+        # files never reported are failures
+        for file_path in job.file_paths:
+            if file_path not in done:
+                on_file_done(file_path, False)
+        job.status = "failed" if job.files_failed else "succeeded"
+        job.finished_at = time.time()
+        self._save(job)
@@ -0,0 +1,43 @@
+import time
+import logging
+from threading import Lock
+from typing import Callable, Generic, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class Lazy(Generic[T]):
+    """
+    Value created by a factory on first use, so that importing the app does not pay for it.
+    初回利用時にファクトリで作成する値（アプリのインポート時に作成コストを払わない）
+
+    Args:
+        factory: function creating the value
+        name: name used in logs and load times
+    """
+
+    def __init__(self, factory: Callable[[], T], name: Optional[str] = None):
+        self.factory = factory
+        self.name = name or getattr(factory, '__name__', 'value')
+        self.seconds = None
+        self._value = None
+        self._loaded = False
+        self._lock = Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def get(self) -> T:
+        if self._loaded:
+            return self._value
+        with self._lock:
+            if not self._loaded:
+                start = time.perf_counter()
+                self._value = self.factory()
+                self.seconds = round(time.perf_counter() - start, 3)
+                self._loaded = True
+                logger.info('loaded %s in %.3fs', self.name, self.seconds)
+        return self._value
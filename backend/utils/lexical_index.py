@@ -0,0 +1,156 @@
+import os
+import re
+import json
+import math
+from collections import Counter
+from threading import RLock
+from typing import Dict, Iterable, List, Tuple
+
+# identifiers such as i-0abc123, my-bucket.logs, ERR_CONNECTION_RESET are kept whole
+WORD_PATTERN = re.compile(r'[a-z0-9](?:[a-z0-9_.:/\-]*[a-z0-9])?')
+WORD_SEPARATORS = re.compile(r'[_.:/\-]+')
+# Japanese / Chinese runs are indexed as character bigrams
+CJK_PATTERN = re.compile(r'[぀-ヿ㐀-䶿一-鿿豈-﫿]+')
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into BM25 terms: lower-cased words and identifiers (plus their parts) and CJK bigrams.
+    BM25の単語に分割する（小文字化した単語・識別子とその構成要素、日本語などは文字bigram）
+    """
+    text = text.lower()
+    tokens = []
+    for word in WORD_PATTERN.findall(text):
+        tokens.append(word)
+        parts = [part for part in WORD_SEPARATORS.split(word) if part]
+        if len(parts) > 1:
+            tokens.extend(parts)
+    for run in CJK_PATTERN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class LexicalIndex:
+    """
+    In-process BM25 inverted index of chunk texts, maintained alongside the vectorstore.
+    ベクターストアと並行して管理するチャンクのBM25転置インデックス
+
+    Only the term frequencies of each chunk are persisted; postings are rebuilt on load.
+    永続化するのはチャンク毎の単語頻度のみで、転置リストは読み込み時に再構築する
+
+    Args:
+        path: JSON file of the index
+        k1: BM25 term frequency saturation
+        b: BM25 length normalization
+    """
+
+    def __init__(self, path: str, k1: float = 1.5, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._lock = RLock()
+        self._documents = {}  # chunk ID -> {term: tf}
+        self._lengths = {}
+        self._postings = {}  # term -> {chunk ID: tf}
+        self._total_length = 0
+        self._dirty = False
+        self.loaded = False
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for chunk_id, terms in json.load(f).items():
+                    self._add_terms(chunk_id, terms)
+            self._dirty = False
+            self.loaded = True
+
+    def __len__(self):
+        with self._lock:
+            return len(self._documents)
+
+    def _add_terms(self, chunk_id: str, terms: Dict[str, int]):
+        self._documents[chunk_id] = terms
+        length = sum(terms.values())
+        self._lengths[chunk_id] = length
+        self._total_length += length
+        for term, tf in terms.items():
+            self._postings.setdefault(term, {})[chunk_id] = tf
+        self._dirty = True
+
+    def _discard(self, chunk_id: str):
+        terms = self._documents.pop(chunk_id, None)
+        if terms is None:
+            return
+        self._total_length -= self._lengths.pop(chunk_id, 0)
+        for term in terms:
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(chunk_id, None)
+            if not postings:
+                del self._postings[term]
+        self._dirty = True
+
+    def add(self, chunk_id: str, text: str):
+        with self._lock:
+            self._discard(chunk_id)
+            self._add_terms(chunk_id, dict(Counter(tokenize(text))))
+
+    def remove(self, chunk_ids: Iterable[str]):
+        with self._lock:
+            for chunk_id in chunk_ids:
+                self._discard(chunk_id)
+
+    def search(self, query: str, k: int = 4) -> List[Tuple[str, float]]:
+        """
+        Return up to k (chunk ID, BM25 score) pairs. Only the postings of the query terms are visited.
+        最大k件の(チャンクID, BM25スコア)を返す。クエリの単語の転置リストのみを走査する
+        """
+        terms = set(tokenize(query))
+        with self._lock:
+            count = len(self._documents)
+            if not count or not terms:
+                return []
+            average_length = self._total_length / count
+            scores = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for chunk_id, tf in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._lengths[chunk_id] / average_length)
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def clear(self):
+        with self._lock:
+            self._documents = {}
+            self._lengths = {}
+            self._postings = {}
+            self._total_length = 0
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._documents, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """
+    Fuse ranked ID lists: score(id) = sum of 1 / (k + rank).
+    複数の順位付きIDリストをRRFで統合する
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,64 @@
+import os
+import json
+import time
+import hashlib
+from threading import RLock
+from typing import Dict, Iterator, Optional, Tuple
+
+
+def file_sha256(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class DocumentManifest:
+    """
+    Manifest of ingested documents: source -> content hash -> chunk IDs.
+    取り込み済み文書の管理情報（ソース名 -> 内容のハッシュ -> チャンクID）
+
+    Stored as JSON and replaced atomically on save.
+    JSONで保存し、保存時はアトミックに置き換える
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = RLock()
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+
+    def get(self, source: str) -> Optional[dict]:
+        with self._lock:
+            return self._entries.get(source)
+
+    def set(self, source: str, sha256: str, ids: list):
+        with self._lock:
+            self._entries[source] = {'sha256': sha256, 'ids': list(ids), 'updated_at': time.time()}
+
+    def remove(self, source: str) -> Optional[dict]:
+        with self._lock:
+            return self._entries.pop(source, None)
+
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        with self._lock:
+            return iter(list(self._entries.items()))
+
+    def referenced_ids(self) -> Dict[str, str]:
+        """
+        Return chunk ID -> source of all entries.
+        全エントリのチャンクID -> ソース名を返す
+        """
+        with self._lock:
+            return {chunk_id: source for source, entry in self._entries.items() for chunk_id in entry['ids']}
+
+    def save(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
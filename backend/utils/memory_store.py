@@ -0,0 +1,502 @@
+import os
+import json
+import time
+import uuid
+import atexit
+import asyncio
+import logging
+import sqlite3
+from collections import OrderedDict
+from datetime import datetime, timezone
+from threading import Condition, RLock, Thread
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langgraph.store.base import BaseStore, GetOp, Item, ListNamespacesOp, PutOp, SearchItem, SearchOp
+
+logger = logging.getLogger(__name__)
+
+# separator of namespace labels in the namespace column
+NS_SEPARATOR = '\x1f'
+# cache marker of keys known to be missing
+_MISSING = object()
+# seconds changed keys are kept in the changelog read by the other processes
+CHANGELOG_SECONDS = 3600
+
+
+def _join(namespace: Tuple[str, ...]) -> str:
+    return NS_SEPARATOR.join(namespace)
+
+
+def _split(ns: str) -> Tuple[str, ...]:
+    return tuple(ns.split(NS_SEPARATOR)) if ns else ()
+
+
+def _datetime(timestamp: float) -> datetime:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+
+def _index_text(value: dict, fields: List[str]) -> str:
+    # text of the indexed fields ("$" is the whole value)
+    texts = []
+    for field in fields:
+        text = json.dumps(value, ensure_ascii=False, default=str) if field == '$' else value.get(field)
+        if text not in (None, ''):
+            texts.append(text if isinstance(text, str) else json.dumps(text, ensure_ascii=False, default=str))
+    return '\n'.join(texts)
+
+
+def _normalize(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class LazyEmbeddings(Embeddings):
+    """
+    Embeddings created by factory on first use, so the store starts without loading the model.
+    初回利用時にfactoryで作成するEmbeddings（ストアの起動時にモデルを読み込まない）
+    """
+
+    def __init__(self, factory: Callable[[], Embeddings]):
+        from utils.lazy import Lazy
+        self._embeddings = Lazy(factory, name='memory embedding model')
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embeddings.get().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embeddings.get().embed_query(text)
+
+
+def parse_ttls(value: Optional[str]) -> Dict[str, float]:
+    """
+    Parse "users=7776000,sessions=86400" into {namespace: seconds}.
+    "users=7776000,sessions=86400"を{名前空間: 秒}に変換する
+    """
+    ttls = {}
+    for item in (value or '').split(','):
+        name, _, seconds = item.partition('=')
+        if name.strip() and seconds.strip():
+            ttls[name.strip()] = float(seconds)
+    return ttls
+
+
+class SQLiteStore(BaseStore):
+    """
+    LangGraph store persisted in SQLite (WAL), shared by the processes using the same file.
+    Reads go through a bounded LRU cache, writes are batched into one transaction in the background,
+    and items of namespaces with a TTL expire after that many seconds without a write (or a read refreshing them).
+    Written keys are logged in a changelog table, so the other processes evict only those keys from their caches.
+    SQLite（WAL）に永続化するLangGraphのストア。同じファイルを使うプロセス間で共有する。
+    読み込みは上限付きのLRUキャッシュを通し、書き込みはバックグラウンドで1トランザクションにまとめる。
+    書き込んだキーは変更履歴テーブルに記録し、他のプロセスはそのキーだけをキャッシュから削除する。
+    TTLを設定した名前空間の項目は、書き込み（または読み込みによる延長）から一定時間で期限切れとなる
+
+    Args:
+        path: SQLite database file
+        cache_entries: size cap of the read cache
+        flush_every: write pending changes once this many are queued
+        flush_interval: ... or at the latest this many seconds after the first one
+        ttls: seconds items live per top-level namespace label, e.g. {"users": 7776000}
+        sweep_interval: seconds between deletions of expired rows
+        index: semantic search config like LangGraph's: {"embed": Embeddings, "fields": ["text"]}.
+            Values are embedded when written and their vectors stored with them, so searches only embed the query
+    """
+
+    supports_ttl = True
+
+    def __init__(self, path: str = './memory_store/memory.db', cache_entries: int = 10000, flush_every: int = 100,
+                 flush_interval: float = 1.0, ttls: Optional[Dict[str, float]] = None, sweep_interval: float = 300.0,
+                 index: Optional[dict] = None):
+        self.path = path
+        self.cache_entries = max(cache_entries, 0)
+        self.flush_every = max(flush_every, 1)
+        self.flush_interval = flush_interval
+        self.ttls = ttls or {}
+        self.sweep_interval = sweep_interval
+        self.index_config = index
+        self.embeddings = index['embed'] if index else None
+        self.index_fields = (index or {}).get('fields') or ['$']
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS items ('
+            'ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+            'created_at REAL NOT NULL, updated_at REAL NOT NULL, expires_at REAL, vector BLOB, '
+            'PRIMARY KEY (ns, key))'
+        )
+        if 'vector' not in {row[1] for row in self._conn.execute('PRAGMA table_info(items)')}:
+            # databases created before semantic search
+            self._conn.execute('ALTER TABLE items ADD COLUMN vector BLOB')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS items_expires_at ON items (expires_at) WHERE expires_at IS NOT NULL')
+        # keys written by each process, read by the others to invalidate their caches
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS changes ('
+            'seq INTEGER PRIMARY KEY AUTOINCREMENT, ns TEXT NOT NULL, key TEXT NOT NULL, writer TEXT NOT NULL, at REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS changes_at ON changes (at)')
+        self._writer = uuid.uuid4().hex
+        self._lock = RLock()
+        self._cache = OrderedDict()  # (ns, key) -> (Item or _MISSING, expires_at) (LRU order)
+        # (ns, key) -> (action, Item or None, expires_at, vector) written by the flusher; action: put, delete or touch (extend the TTL)
+        self._pending = {}
+        self._pending_since = None
+        self._data_version = self._read_data_version()
+        self._last_change = self._read_last_change()
+        self._hits = 0
+        self._misses = 0
+        self._flushes = 0
+        self._invalidations = 0
+        self._closed = False
+        self._last_sweep = time.monotonic()
+        self._condition = Condition(self._lock)
+        self._thread = Thread(target=self._run, name='memory-store-flush', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # ----------------------------
+    # cache
+    # ----------------------------
+    def _read_data_version(self) -> int:
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def _read_last_change(self) -> int:
+        row = self._conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        return row[0] if row else 0
+
+    def _check_external_writes(self):
+        # data_version changes when another connection (e.g. another worker) commits
+        version = self._read_data_version()
+        if version == self._data_version:
+            return
+        self._data_version = version
+        # one read transaction, so the log and its bounds are consistent
+        self._conn.execute('BEGIN')
+        try:
+            last_change = self._read_last_change()
+            if last_change <= self._last_change:
+                # sweeps and TTL extensions only: cached items carry their own expiry
+                return
+            first = self._conn.execute('SELECT MIN(seq) FROM changes').fetchone()[0]
+            if first is None or first > self._last_change + 1:
+                # changes this process has not seen were already pruned from the log
+                self._cache.clear()
+                self._invalidations += 1
+            else:
+                for ns, key in self._conn.execute('SELECT ns, key FROM changes WHERE seq > ? AND writer != ?', (self._last_change, self._writer)):
+                    if self._cache.pop((ns, key), None) is not None:
+                        self._invalidations += 1
+            self._last_change = last_change
+        finally:
+            self._conn.execute('COMMIT')
+
+    def _cache_set(self, cache_key, item, expires_at: Optional[float] = None):
+        if not self.cache_entries:
+            return
+        self._cache[cache_key] = (item, expires_at)
+        self._cache.move_to_end(cache_key)
+        while len(self._cache) > self.cache_entries:
+            self._cache.popitem(last=False)
+
+    def _ttl(self, namespace: Tuple[str, ...], ttl_minutes: Optional[float] = None) -> Optional[float]:
+        if ttl_minutes is not None:
+            return ttl_minutes * 60
+        return self.ttls.get(namespace[0]) if namespace else None
+
+    # ----------------------------
+    # operations
+    # ----------------------------
+    def batch(self, ops: Iterable) -> list:
+        ops = list(ops)
+        vectors = self._embed_puts([op for op in ops if isinstance(op, PutOp)])
+        results = []
+        for op in ops:
+            if isinstance(op, GetOp):
+                results.append(self._get(op))
+            elif isinstance(op, PutOp):
+                self._put(op, vectors.get(id(op)))
+                results.append(None)
+            elif isinstance(op, SearchOp):
+                results.append(self._search(op))
+            elif isinstance(op, ListNamespacesOp):
+                results.append(self._list_namespaces(op))
+            else:
+                raise ValueError(f'Unsupported operation: {type(op).__name__}')
+        return results
+
+    async def abatch(self, ops: Iterable) -> list:
+        return await asyncio.get_running_loop().run_in_executor(None, self.batch, list(ops))
+
+    def _embed_puts(self, ops: List[PutOp]) -> Dict[int, bytes]:
+        # vectors of the written values (id(op) -> float32 bytes), embedded in one call outside the lock
+        if self.embeddings is None:
+            return {}
+        texts = {}
+        for op in ops:
+            if op.value is None or op.index is False:
+                continue
+            text = _index_text(op.value, op.index or self.index_fields)
+            if text:
+                texts[id(op)] = text
+        if not texts:
+            return {}
+        vectors = self.embeddings.embed_documents(list(texts.values()))
+        return {op_id: _normalize(vector).tobytes() for op_id, vector in zip(texts, vectors)}
+
+    def _lookup(self, cache_key, namespace: Tuple[str, ...], key: str, now: float):
+        # (Item or None, expires_at) from pending writes, the cache or the database
+        pending = self._pending.get(cache_key)
+        if pending is not None and pending[0] != 'touch':
+            return pending[1], pending[2]
+        cached = self._cache.get(cache_key)
+        if cached is not None and (cached[1] is None or cached[1] > now):
+            self._hits += 1
+            self._cache.move_to_end(cache_key)
+            item, expires_at = cached
+            return (None if item is _MISSING else item), expires_at
+        self._misses += 1
+        row = self._conn.execute(
+            'SELECT value, created_at, updated_at, expires_at FROM items WHERE ns = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (cache_key[0], key, now)
+        ).fetchone()
+        if row is None:
+            self._cache_set(cache_key, _MISSING)
+            return None, None
+        item = Item(value=json.loads(row[0]), key=key, namespace=namespace, created_at=_datetime(row[1]), updated_at=_datetime(row[2]))
+        self._cache_set(cache_key, item, row[3])
+        return item, row[3]
+
+    def _get(self, op: GetOp) -> Optional[Item]:
+        namespace = tuple(op.namespace)
+        cache_key = (_join(namespace), op.key)
+        now = time.time()
+        with self._lock:
+            self._check_external_writes()
+            item, expires_at = self._lookup(cache_key, namespace, op.key, now)
+            ttl = self._ttl(namespace)
+            # reading keeps the item alive; extended once half of its TTL has passed, so reads rarely write
+            if item is not None and op.refresh_ttl and ttl and expires_at is not None and expires_at - now < ttl / 2:
+                pending = self._pending.get(cache_key)
+                action = pending[0] if pending is not None else 'touch'
+                self._queue(cache_key, (action, item, now + ttl, pending[3] if pending is not None else None))
+                self._cache_set(cache_key, item, now + ttl)
+        return item
+
+    def _put(self, op: PutOp, vector: Optional[bytes] = None):
+        namespace = tuple(op.namespace)
+        cache_key = (_join(namespace), op.key)
+        now = time.time()
+        with self._lock:
+            if op.value is None:
+                self._queue(cache_key, ('delete', None, None, None))
+                self._cache_set(cache_key, _MISSING)
+                return
+            # created_at of an existing row is kept by the upsert, here it only matters for the cached item
+            pending = self._pending.get(cache_key)
+            cached = pending[1] if pending is not None else self._cache.get(cache_key, (None,))[0]
+            created_at = cached.created_at if isinstance(cached, Item) else _datetime(now)
+            ttl = self._ttl(namespace, op.ttl)
+            expires_at = now + ttl if ttl else None
+            item = Item(value=op.value, key=op.key, namespace=namespace, created_at=created_at, updated_at=_datetime(now))
+            self._queue(cache_key, ('put', item, expires_at, vector))
+            self._cache_set(cache_key, item, expires_at)
+
+    def _queue(self, cache_key, change):
+        self._pending[cache_key] = change
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+            self._condition.notify()
+        elif len(self._pending) >= self.flush_every:
+            self._condition.notify()
+
+    def _search(self, op: SearchOp) -> List[SearchItem]:
+        # pending writes are flushed first, so the query sees them
+        self.flush()
+        query = _normalize(self.embeddings.embed_query(op.query)) if op.query and self.embeddings is not None else None
+        prefix = _join(tuple(op.namespace_prefix))
+        sql = 'SELECT ns, key, value, created_at, updated_at, vector FROM items WHERE (expires_at IS NULL OR expires_at > ?)'
+        params = [time.time()]
+        if prefix:
+            # the namespace itself or the ones below it, as ranges of the primary key
+            # (every label below starts with prefix + NS_SEPARATOR, the character after it ends the range)
+            sql += ' AND (ns = ? OR (ns >= ? AND ns < ?))'
+            params += [prefix, prefix + NS_SEPARATOR, prefix + chr(ord(NS_SEPARATOR) + 1)]
+        sql += ' ORDER BY updated_at DESC'
+        matches = []
+        with self._lock:
+            for ns, key, value, created_at, updated_at, vector in self._conn.execute(sql, params):
+                value = json.loads(value)
+                if op.filter and any(value.get(name) != expected for name, expected in op.filter.items()):
+                    continue
+                score = None
+                if query is not None and vector is not None:
+                    score = float(np.dot(np.frombuffer(vector, dtype=np.float32), query))
+                matches.append(SearchItem(namespace=_split(ns), key=key, value=value, created_at=_datetime(created_at),
+                                          updated_at=_datetime(updated_at), score=score))
+                if query is None and len(matches) >= op.offset + op.limit:
+                    break
+        if query is not None:
+            # most similar first, items without a vector (not indexed) last
+            matches.sort(key=lambda item: (item.score is None, -(item.score or 0.0)))
+        return matches[op.offset:op.offset + op.limit]
+
+    def _list_namespaces(self, op: ListNamespacesOp) -> List[Tuple[str, ...]]:
+        self.flush()
+        with self._lock:
+            namespaces = [_split(row[0]) for row in self._conn.execute('SELECT DISTINCT ns FROM items WHERE (expires_at IS NULL OR expires_at > ?)', (time.time(),))]
+
+        def matches(namespace, condition) -> bool:
+            path = tuple(condition.path)
+            if len(namespace) < len(path):
+                return False
+            labels = namespace[:len(path)] if condition.match_type == 'prefix' else namespace[-len(path):]
+            return all(expected == '*' or expected == label for expected, label in zip(path, labels))
+
+        res = []
+        for namespace in namespaces:
+            if op.match_conditions and not all(matches(namespace, condition) for condition in op.match_conditions):
+                continue
+            namespace = namespace[:op.max_depth] if op.max_depth is not None else namespace
+            if namespace not in res:
+                res.append(namespace)
+        res.sort()
+        return res[op.offset:op.offset + op.limit]
+
+    # ----------------------------
+    # write-behind
+    # ----------------------------
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._closed and not self._due():
+                    sweep_in = max(self.sweep_interval - (time.monotonic() - self._last_sweep), 0.0)
+                    flush_in = None if self._pending_since is None else max(self.flush_interval - (time.monotonic() - self._pending_since), 0.0)
+                    self._condition.wait(sweep_in if flush_in is None else min(flush_in, sweep_in))
+                if self._closed:
+                    return
+                due = self._due()
+            try:
+                if due:
+                    self.flush()
+                if time.monotonic() - self._last_sweep >= self.sweep_interval:
+                    self.sweep()
+            except Exception:
+                logger.exception('failed to write the memory store')
+                time.sleep(self.flush_interval)
+
+    def _due(self) -> bool:
+        if self._pending_since is None:
+            return False
+        return len(self._pending) >= self.flush_every or time.monotonic() - self._pending_since >= self.flush_interval
+
+    def flush(self):
+        """
+        Write pending changes in one transaction.
+        未保存の変更を1トランザクションで書き込む
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            # pending changes are dropped only after the commit, so a failed flush (e.g. another worker holding
+            # the write lock past busy_timeout) keeps them for the next one
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                for (ns, key), (action, item, expires_at, vector) in self._pending.items():
+                    if action != 'touch':
+                        self._conn.execute('INSERT INTO changes (ns, key, writer, at) VALUES (?, ?, ?, ?)', (ns, key, self._writer, now))
+                    if action == 'delete':
+                        self._conn.execute('DELETE FROM items WHERE ns = ? AND key = ?', (ns, key))
+                    elif action == 'touch':
+                        self._conn.execute('UPDATE items SET expires_at = ? WHERE ns = ? AND key = ?', (expires_at, ns, key))
+                    else:
+                        self._conn.execute(
+                            'INSERT INTO items (ns, key, value, created_at, updated_at, expires_at, vector) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                            'ON CONFLICT (ns, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at, '
+                            'expires_at = excluded.expires_at, vector = excluded.vector',
+                            (ns, key, json.dumps(item.value, ensure_ascii=False, default=str), item.created_at.timestamp(),
+                             item.updated_at.timestamp(), expires_at, vector)
+                        )
+                self._conn.execute('COMMIT')
+            except Exception:
+                if self._conn.in_transaction:
+                    self._conn.execute('ROLLBACK')
+                raise
+            self._pending, self._pending_since = {}, None
+            # own commits do not change data_version, so commits of other processes in between are still noticed
+            self._flushes += 1
+
+    def sweep(self) -> int:
+        """
+        Delete expired rows. Returns the number of deleted rows.
+        期限切れの行を削除し、削除した件数を返す
+        """
+        with self._lock:
+            self._last_sweep = time.monotonic()
+            now = time.time()
+            deleted = self._conn.execute('DELETE FROM items WHERE expires_at IS NOT NULL AND expires_at <= ?', (now,)).rowcount
+            self._conn.execute('DELETE FROM changes WHERE at < ?', (now - CHANGELOG_SECONDS,))
+            for cache_key, (_, expires_at) in list(self._cache.items()):
+                if expires_at is not None and expires_at <= now:
+                    del self._cache[cache_key]
+        if deleted:
+            logger.info('deleted %d expired memory items', deleted)
+        return deleted
+
+    def close(self):
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        self.flush()
+        atexit.unregister(self.close)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                'cache_entries': len(self._cache),
+                'max_cache_entries': self.cache_entries,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / total, 4) if total else 0.0,
+                'pending': len(self._pending),
+                'flushes': self._flushes,
+                'invalidations': self._invalidations,
+                'semantic_search': self.embeddings is not None,
+            }
+
+
+def create_memory_store(embeddings_factory: Optional[Callable[[], Embeddings]] = None):
+    """
+    Create the agent memory store configured by environment variables (MEMORY_STORE: sqlite or memory).
+    With embeddings_factory, the "text" field of the values is indexed for semantic search (model loaded on first use).
+    環境変数の設定でエージェントのメモリストアを作成する（MEMORY_STORE: sqlite または memory）。
+    embeddings_factoryを指定すると値の"text"フィールドを意味検索用に索引する（モデルは初回利用時に読み込む）
+
+    Args:
+        embeddings_factory: creates the embedding model of semantic search
+    """
+    backend = os.getenv('MEMORY_STORE', 'sqlite').lower()
+    index = None
+    if embeddings_factory is not None and os.getenv('MEMORY_SEMANTIC_SEARCH', 'true').lower() == 'true':
+        index = {'embed': LazyEmbeddings(embeddings_factory), 'fields': ['text']}
+    if backend == 'memory':
+        from langgraph.store.memory import InMemoryStore
+        return InMemoryStore(index=index)
+    if backend != 'sqlite':
+        raise ValueError(f'Unsupported memory store: {backend}')
+    return SQLiteStore(
+        path=os.getenv('MEMORY_STORE_PATH', './memory_store/memory.db'),
+        cache_entries=int(os.getenv('MEMORY_STORE_CACHE_ENTRIES', '10000')),
+        flush_every=int(os.getenv('MEMORY_STORE_FLUSH_EVERY', '100')),
+        flush_interval=float(os.getenv('MEMORY_STORE_FLUSH_INTERVAL_SECONDS', '1')),
+        ttls=parse_ttls(os.getenv('MEMORY_STORE_TTLS')),
+        sweep_interval=float(os.getenv('MEMORY_STORE_SWEEP_INTERVAL_SECONDS', '300')),
+        index=index
+    )
@@ -0,0 +1,153 @@
+import time
+import queue
+from threading import Event, Lock, Thread
+from typing import Callable, List
+from langchain_core.embeddings import Embeddings
+
+
+class _Request:
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.result = None
+        self.error = None
+        self.done = Event()
+
+
+class MicroBatcher:
+    """
+    Merge concurrent calls into single calls of func: the first call waits up to max_wait seconds
+    for others, then all their texts are run together (up to max_batch texts).
+    同時に来た呼び出しをまとめて1回の関数呼び出しにする。最初の呼び出しから最大max_wait秒の間に来た呼び出しを
+    max_batch件までまとめて実行する
+
+    Args:
+        func: function mapping a list of texts to a list of results
+        max_batch: max number of texts run together
+        max_wait: seconds the first call waits for others
+    """
+
+    def __init__(self, func: Callable[[List[str]], list], max_batch: int = 64, max_wait: float = 0.005, name: str = 'micro-batch'):
+        self.func = func
+        self.max_batch = max(max_batch, 1)
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._lock = Lock()
+        self._calls = 0
+        self._batches = 0
+        self._texts = 0
+        self._largest = 0
+        self._thread = Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, texts: List[str]) -> list:
+        """
+        Run func on texts together with concurrent calls and return its results for texts.
+        同時の呼び出しとまとめてfuncを実行し、textsの結果を返す
+        """
+        if not texts:
+            return []
+        request = _Request(list(texts))
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _collect(self, first: _Request) -> List[_Request]:
+        batch, size = [first], len(first.texts)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # closed, run what was collected and stop
+                self._queue.put(None)
+                break
+            batch.append(request)
+            size += len(request.texts)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            texts = [text for request in batch for text in request.texts]
+            try:
+                results = self.func(texts)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            else:
+                offset = 0
+                for request in batch:
+                    request.result = results[offset:offset + len(request.texts)]
+                    offset += len(request.texts)
+            for request in batch:
+                request.done.set()
+            with self._lock:
+                self._calls += len(batch)
+                self._batches += 1
+                self._texts += len(texts)
+                self._largest = max(self._largest, len(texts))
+
+    def close(self):
+        self._queue.put(None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'calls': self._calls,
+                'batches': self._batches,
+                'texts': self._texts,
+                'calls_per_batch': round(self._calls / self._batches, 2) if self._batches else 0.0,
+                'texts_per_batch': round(self._texts / self._batches, 2) if self._batches else 0.0,
+                'largest_batch': self._largest,
+                'max_batch': self.max_batch,
+                'max_wait_ms': self.max_wait * 1000,
+            }
+
+
+class BatchedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper running concurrent embed calls (e.g. from several API workers) in shared forward passes.
+    Queries have their own batcher, so a search never waits behind the forward pass of an ingestion batch.
+    同時の埋め込み呼び出し（複数のAPIワーカーなど）をまとめて1回の推論で実行するEmbeddingsのラッパー。
+    クエリは専用のバッチ処理で実行するため、検索が取り込みのバッチの推論を待つことはない
+    """
+
+    def __init__(self, embeddings, max_batch: int = 64, max_wait: float = 0.005):
+        self.embeddings = embeddings
+        self._documents = MicroBatcher(embeddings.embed_documents, max_batch=max_batch, max_wait=max_wait, name='embed-documents')
+        if hasattr(embeddings, 'query_encode_kwargs') and not embeddings.query_encode_kwargs:
+            # queries are encoded like documents, so concurrent queries are embedded in one forward pass
+            embed_queries = embeddings.embed_documents
+        else:
+            def embed_queries(texts):
+                return [embeddings.embed_query(text) for text in texts]
+        self._queries = MicroBatcher(embed_queries, max_batch=max_batch, max_wait=max_wait, name='embed-queries')
+
+    def __getattr__(self, name):
+        # expose attributes of the wrapped model (model_name, model_id, _client, ...)
+        if name in {'embeddings', '_documents', '_queries'}:
+            raise AttributeError(name)
+        return getattr(self.embeddings, name)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._documents.submit(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._queries.submit([text])[0]
+
+    def stats(self) -> dict:
+        return {'documents': self._documents.stats(), 'queries': self._queries.stats()}
+
+    def close(self):
+        self._documents.close()
+        self._queries.close()
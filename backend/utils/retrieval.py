@@ -0,0 +1,129 @@
+import os
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from threading import Lock
+from typing import Optional
+
+# supported vectorstore (light module, so the app can check it without loading the vectorstore libraries)
+supported_vectorstore_class = ['chroma', 'faiss', 'milvus']
+
+
+@dataclass(frozen=True)
+class SearchOptions:
+    """
+    Retrieval options of Embedding.search.
+    Embedding.searchの検索オプション
+
+    Args:
+        k: number of chunks returned
+        search_type: "similarity", "mmr" (max marginal relevance) or "lexical" (BM25 only)
+        score_threshold: minimum relevance score in [0, 1] (similarity only). With hybrid, BM25 hits are held to it
+            only when their vector can be scored (FAISS with the embedding cache)
+        fetch_k: candidates re-ranked by MMR or fused with BM25
+        lambda_mult: MMR trade-off between relevance (1) and diversity (0)
+        hybrid: fuse vector results with BM25 results by reciprocal rank
+        rrf_k: rank constant of reciprocal rank fusion
+    """
+    k: int = 3
+    search_type: str = 'similarity'
+    score_threshold: Optional[float] = None
+    fetch_k: int = 20
+    lambda_mult: float = 0.5
+    hybrid: bool = False
+    rrf_k: int = 60
+
+    def override(self, **changes) -> 'SearchOptions':
+        return replace(self, **{name: value for name, value in changes.items() if value is not None})
+
+
+def default_search_options() -> SearchOptions:
+    """
+    Return the SearchOptions configured by environment variables.
+    環境変数で設定された検索オプションを返す
+    """
+    score_threshold = os.getenv('RETRIEVAL_SCORE_THRESHOLD')
+    return SearchOptions(
+        k=int(os.getenv('RETRIEVAL_K', '3')),
+        search_type=os.getenv('RETRIEVAL_SEARCH_TYPE', 'similarity').lower(),
+        score_threshold=float(score_threshold) if score_threshold else None,
+        fetch_k=int(os.getenv('RETRIEVAL_FETCH_K', '20')),
+        lambda_mult=float(os.getenv('RETRIEVAL_MMR_LAMBDA', '0.5')),
+        hybrid=os.getenv('RETRIEVAL_HYBRID', 'true').lower() == 'true',
+        rrf_k=int(os.getenv('RETRIEVAL_RRF_K', '60'))
+    )
+
+
+def normalize_query(query: str) -> str:
+    # full-width / half-width, case and whitespace differences hit the same entry
+    return ' '.join(unicodedata.normalize('NFKC', query).lower().split())
+
+
+class RetrievalCache:
+    """
+    LRU + TTL cache of search results keyed on the normalized query, search options and index version.
+    正規化したクエリ・検索オプション・インデックスのバージョンをキーにした検索結果のキャッシュ
+
+    Args:
+        max_entries: size cap. The least recently used entries are evicted beyond it
+        ttl: seconds an entry stays valid
+    """
+
+    def __init__(self, max_entries: int = 256, ttl: float = 600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, documents)
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def make_key(query: str, options: SearchOptions, index_version: int) -> tuple:
+        return normalize_query(query), options, index_version
+
+    def get(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+    def set(self, key: tuple, documents: list):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, documents)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / total, 4) if total else 0.0,
+            }
+
+
+def create_retrieval_cache() -> Optional[RetrievalCache]:
+    """
+    Create a RetrievalCache configured by environment variables (None when disabled).
+    環境変数の設定でRetrievalCacheを作成する（無効の場合None）
+    """
+    if os.getenv('RETRIEVAL_CACHE_ENABLED', 'true').lower() != 'true':
+        return None
+    return RetrievalCache(
+        max_entries=int(os.getenv('RETRIEVAL_CACHE_MAX_ENTRIES', '256')),
+        ttl=float(os.getenv('RETRIEVAL_CACHE_TTL_SECONDS', '600'))
+    )
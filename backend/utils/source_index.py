@@ -0,0 +1,88 @@
+import os
+import json
+from threading import RLock
+from typing import Dict, Iterable, List, Optional
+
+
+class SourceIndex:
+    """
+    Secondary index of the vectorstore: source -> chunk IDs (with page / sheet metadata).
+    ベクターストアの副インデックス（ソース名 -> チャンクID、ページ・シート情報付き）
+
+    Lookups and deletes cost O(chunks of the source) instead of scanning the whole store.
+    ソース単位の検索・削除をストア全体の走査なしで行う
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = RLock()
+        self._sources = {}  # source -> {id: {'page': int, 'page_name': str}}
+        self._id_to_source = {}
+        self._dirty = False
+        self.loaded = False
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self._sources = json.load(f)
+            self._id_to_source = {chunk_id: source for source, chunks in self._sources.items() for chunk_id in chunks}
+            self.loaded = True
+
+    def __len__(self):
+        with self._lock:
+            return len(self._id_to_source)
+
+    def add(self, chunk_id: str, source: str, page: int = -1, page_name: str = ''):
+        with self._lock:
+            old_source = self._id_to_source.get(chunk_id)
+            if old_source is not None and old_source != source:
+                self._discard(chunk_id)
+            self._sources.setdefault(source, {})[chunk_id] = {'page': page, 'page_name': page_name}
+            self._id_to_source[chunk_id] = source
+            self._dirty = True
+
+    def _discard(self, chunk_id: str):
+        source = self._id_to_source.pop(chunk_id, None)
+        if source is None:
+            return
+        chunks = self._sources.get(source, {})
+        chunks.pop(chunk_id, None)
+        if not chunks:
+            self._sources.pop(source, None)
+        self._dirty = True
+
+    def remove(self, chunk_ids: Iterable[str]):
+        with self._lock:
+            for chunk_id in chunk_ids:
+                self._discard(chunk_id)
+
+    def get_ids(self, source: str) -> List[str]:
+        with self._lock:
+            return list(self._sources.get(source, {}))
+
+    def get_chunks(self, source: str) -> Dict[str, dict]:
+        with self._lock:
+            return dict(self._sources.get(source, {}))
+
+    def get_source(self, chunk_id: str) -> Optional[str]:
+        with self._lock:
+            return self._id_to_source.get(chunk_id)
+
+    def sources(self) -> List[str]:
+        with self._lock:
+            return list(self._sources)
+
+    def clear(self):
+        with self._lock:
+            self._sources = {}
+            self._id_to_source = {}
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._sources, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
@@ -0,0 +1,83 @@
+import hashlib
+import os
+import shutil
+import uuid
+from dataclasses import dataclass
+from typing import Optional
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+@dataclass
+class SavedUpload:
+    path: str
+    filename: str
+    sha256: str
+    size: int
+
+
+def _safe_filename(filename: Optional[str]) -> str:
+    name = os.path.basename((filename or "").replace("\\", "/")).strip()
+    return name if name not in {"", ".", ".."} else "upload"
+
+
+async def save_upload(upload, upload_dir: str = "./temp_uploads", chunk_size: int = 1024 * 1024,
+                      max_file_bytes: Optional[int] = None, max_total_bytes: Optional[int] = None) -> SavedUpload:
+    """
+    Stream an UploadFile to a unique path in fixed-size chunks, hashing it on the way.
+    アップロードファイルを固定サイズのチャンク単位で一意なパスに書き出し、同時にハッシュを計算する
+
+    Args:
+        upload: fastapi.UploadFile
+        upload_dir: root directory of uploads
+        chunk_size: bytes read at once
+        max_file_bytes: size cap of the file
+        max_total_bytes: remaining size cap of the request
+
+    Returns:
+        SavedUpload(path, filename, sha256, size)
+
+    Raises:
+        UploadTooLarge: the file exceeds a cap (the partial file is removed)
+    """
+    filename = _safe_filename(upload.filename)
+    save_dir = os.path.join(upload_dir, uuid.uuid4().hex)
+    os.makedirs(save_dir, exist_ok=True)
+    save_path = os.path.join(save_dir, filename)
+
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with open(save_path, "wb") as buffer:
+            while True:
+                chunk = await upload.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_file_bytes is not None and size > max_file_bytes:
+                    raise UploadTooLarge(f"'{filename}' exceeds the size limit of {max_file_bytes} bytes per file.")
+                if max_total_bytes is not None and size > max_total_bytes:
+                    raise UploadTooLarge(f"Uploaded files exceed the size limit per request at '{filename}'.")
+                sha256.update(chunk)
+                buffer.write(chunk)
+    except Exception:
+        shutil.rmtree(save_dir, ignore_errors=True)
+        raise
+    finally:
+        await upload.close()
+
+    return SavedUpload(path=save_path, filename=filename, sha256=sha256.hexdigest(), size=size)
+
+
+def remove_upload(file_path: str, upload_dir: str = "./temp_uploads"):
+    """
+    Remove the uploaded file and its unique directory.
+    アップロードされたファイルと一意なディレクトリを削除する
+    """
+    save_dir = os.path.dirname(os.path.abspath(file_path))
+    if os.path.dirname(save_dir) == os.path.abspath(upload_dir):
+        shutil.rmtree(save_dir, ignore_errors=True)
+    elif os.path.exists(file_path):
+        os.remove(file_path)